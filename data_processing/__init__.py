@@ -1,21 +1,45 @@
+import importlib
+
 from .dummy_data import DummyDataProcessor
 from .com2sense_data import Com2SenseDataProcessor
-from .semeval_data import SemEvalDataProcessor
-
-from .processors import DummyDataset
-from .processors import Com2SenseDataset
-from .processors import SemEvalDataset
+from .semeval_data import SemEvalDataProcessor, SemEvalMultipleChoiceProcessor
 
 
 data_processors = {
     "dummy": DummyDataProcessor,
     "com2sense": Com2SenseDataProcessor,
     "semeval": SemEvalDataProcessor,
+    "semeval_b": SemEvalMultipleChoiceProcessor,
 }
 
+# Tasks whose examples have several choices, for multiple-choice models.
+MULTIPLE_CHOICE_TASKS = ["semeval_b"]
+
 
-data_classes = {
-    "dummy": DummyDataset,
-    "com2sense": Com2SenseDataset,
-    "semeval": SemEvalDataset,
+# The dataset classes need torch, which takes seconds to import, so they are
+# only imported on first access and the processors stay fast to import.
+_LAZY_ATTRIBUTES = {
+    "DummyDataset": ".processors",
+    "Com2SenseDataset": ".processors",
+    "SemEvalDataset": ".processors",
+    "SemEvalMultipleChoiceDataset": ".processors",
+    "PackedDataset": ".packing",
 }
+
+
+def __getattr__(name):
+    if name == "data_classes":
+        value = {
+            "dummy": __getattr__("DummyDataset"),
+            "com2sense": __getattr__("Com2SenseDataset"),
+            "semeval": __getattr__("SemEvalDataset"),
+            "semeval_b": __getattr__("SemEvalMultipleChoiceDataset"),
+        }
+    elif name in _LAZY_ATTRIBUTES:
+        module = importlib.import_module(_LAZY_ATTRIBUTES[name], __name__)
+        value = getattr(module, name)
+    else:
+        raise AttributeError("module {!r} has no attribute {!r}".format(
+            __name__, name))
+    globals()[name] = value
+    return value
@@ -10,9 +10,6 @@ import argparse
 from tqdm import tqdm
 from .utils import DataProcessor
 from .utils import Coms2SenseSingleSentenceExample
-from transformers import (
-    AutoTokenizer,
-)
 
 
 class Com2SenseDataProcessor(DataProcessor):
@@ -10,9 +10,6 @@ import argparse
 from tqdm import tqdm
 from .utils import DataProcessor
 from .utils import Coms2SenseSingleSentenceExample
-from transformers import (
-    AutoTokenizer,
-)
 
 
 class Com2SenseDataProcessor(DataProcessor):
@@ -20,12 +17,15 @@ class Com2SenseDataProcessor(DataProcessor):
     Args:
         data_dir: string. Root directory for the dataset.
         args: argparse class, may be optional.
+        fields: example fields to load, the others are left to None (the
+            guid, text and label are always loaded). Defaults to all.
     """
 
-    def __init__(self, data_dir=None, args=None, **kwargs):
+    def __init__(self, data_dir=None, args=None, fields=None, **kwargs):
         """Initialization."""
         self.args = args
         self.data_dir = data_dir
+        self.fields = fields
 
         # TODO: Label to Int mapping, dict type.
         self.label2int = {"True": 1, "False": 0}
@@ -34,12 +34,17 @@ class Com2SenseDataProcessor(DataProcessor):
         """See base class."""
         return 2  # Binary.
 
-    def _read_data(self, data_dir=None, split="train"):
+    def _read_data(self, data_dir=None, split="train", fields=None):
         """Reads in data files to create the dataset."""
         if data_dir is None:
             data_dir = self.data_dir
+        if fields is None:
+            fields = self.fields
 
-        examples = []   # Store your examples in this list
+        # Store your examples in this list
+        examples = self._new_examples(
+            Coms2SenseSingleSentenceExample,
+            categorical=["label", "domain", "scenario", "numeracy"])
 
         ##################################################
         # TODO:
@@ -63,7 +68,10 @@ class Com2SenseDataProcessor(DataProcessor):
         # This is useful for loading test data
         json_path = os.path.join(data_dir, split+".json")
         data = json.load(open(json_path, "r"))
-        
+        # Only the requested metadata is copied into the examples.
+        metadata = [name for name in ["domain", "scenario", "numeracy"]
+                    if fields is None or name in fields]
+
         for i in range(len(data)):
             datum = data[i]
             guid = i
@@ -72,22 +80,19 @@ class Com2SenseDataProcessor(DataProcessor):
             if split != "test":
                 label1 = 1 if datum['label_1'] == "True" else 0
                 label2 = 1 if datum['label_2'] == "True" else 0
+            kwargs = {name: datum[name] for name in metadata}
             example1 = Coms2SenseSingleSentenceExample(
                 guid=guid,
                 text=datum['sent_1'],
                 label=label1,
-                domain=datum['domain'],
-                scenario=datum['scenario'],
-                numeracy=datum['numeracy']
+                **kwargs
             )
 
             example2 = Coms2SenseSingleSentenceExample(
                 guid=guid,
                 text=datum['sent_2'],
                 label=label2,
-                domain=datum['domain'],
-                scenario=datum['scenario'],
-                numeracy=datum['numeracy']
+                **kwargs
             )
             
             examples.append(example1)
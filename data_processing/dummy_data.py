@@ -10,9 +10,6 @@ import argparse
 from tqdm import tqdm
 from .utils import DataProcessor
 from .utils import DummyExample
-from transformers import (
-    AutoTokenizer,
-)
 
 
 class DummyDataProcessor(DataProcessor):
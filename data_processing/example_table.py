@@ -0,0 +1,187 @@
+import json
+import logging
+import dataclasses
+from array import array
+
+logger = logging.getLogger(__name__)
+
+
+class ExampleView(object):
+    """Read-only view of one row of an `ExampleTable`, with the attributes
+    of the example dataclass (`example.text`, `example.label`, ...)."""
+
+    __slots__ = ("_table", "_index")
+
+    def __init__(self, table, index):
+        self._table = table
+        self._index = index
+
+    def __getattr__(self, name):
+        try:
+            return self._table.value(name, self._index)
+        except KeyError:
+            raise AttributeError(name)
+
+    def to_dict(self):
+        return {name: self._table.value(name, self._index)
+                for name in self._table.fields}
+
+    def to_example(self):
+        """The row as an instance of the example dataclass."""
+        return self._table.example_class(**self.to_dict())
+
+    def to_json_string(self):
+        """Serializes this instance to a JSON string."""
+        return json.dumps(self.to_dict(), indent=2) + "\n"
+
+    def __eq__(self, other):
+        if isinstance(other, ExampleView):
+            other = other.to_dict()
+        elif dataclasses.is_dataclass(other):
+            other = dataclasses.asdict(other)
+        else:
+            return NotImplemented
+        return self.to_dict() == other
+
+    def __repr__(self):
+        return "{}({})".format(self._table.example_class.__name__, ", ".join(
+            "{}={!r}".format(name, value)
+            for name, value in self.to_dict().items()))
+
+
+class ExampleTable(object):
+    """Examples of a split stored column by column.
+
+    * `categorical` fields (labels, domains, ...) hold one 32-bit code per
+      example into a list of their distinct values, each stored once.
+    * `integer` fields (guids) are packed 64-bit integers.
+    * The other fields are plain lists of the (shared) Python objects.
+
+    There is no object per example: indexing returns an `ExampleView`, with
+    the attributes of `example_class`, so the table can replace the list of
+    examples of a processor. `append` takes either the field values or an
+    example instance.
+    """
+
+    def __init__(self, example_class, categorical=(), integer=("guid",)):
+        self.example_class = example_class
+        self.fields = [field.name
+                       for field in dataclasses.fields(example_class)]
+        self.categorical = [name for name in self.fields
+                            if name in categorical]
+        self.integer = [name for name in self.fields if name in integer]
+        self.columns = {}
+        for name in self.fields:
+            if name in self.categorical:
+                self.columns[name] = array("i")
+            elif name in self.integer:
+                self.columns[name] = array("q")
+            else:
+                self.columns[name] = []
+        # Distinct values of the categorical fields, and their codes.
+        self.categories = {name: [] for name in self.categorical}
+        self._codes = {name: {} for name in self.categorical}
+        self._appenders = [(name, self.columns[name].append,
+                            self._codes.get(name)) for name in self.fields]
+        self._length = 0
+
+    def __len__(self):
+        return self._length
+
+    def append(self, example=None, **values):
+        if example is not None:
+            values = example.__dict__
+        for name, append, codes in self._appenders:
+            value = values.get(name)
+            if codes is not None:
+                code = codes.get(value)
+                if code is None:
+                    code = codes[value] = len(codes)
+                    self.categories[name].append(value)
+                value = code
+            append(value)
+        self._length += 1
+
+    def extend(self, examples):
+        for example in examples:
+            self.append(example)
+
+    def value(self, name, index):
+        column = self.columns[name]
+        if name in self._codes:
+            return self.categories[name][column[index]]
+        return column[index]
+
+    def column(self, name):
+        """All the values of a field, as a list."""
+        if name in self._codes:
+            categories = self.categories[name]
+            return [categories[code] for code in self.columns[name]]
+        return list(self.columns[name])
+
+    def codes(self, name):
+        """Codes of a categorical field, indices into `categories[name]`."""
+        return self.columns[name]
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [ExampleView(self, i)
+                    for i in range(*index.indices(self._length))]
+        if index < 0:
+            index += self._length
+        if not 0 <= index < self._length:
+            raise IndexError("example index out of range")
+        return ExampleView(self, index)
+
+    def __iter__(self):
+        for index in range(self._length):
+            yield ExampleView(self, index)
+
+    def __repr__(self):
+        return "ExampleTable({}, {} examples)".format(
+            self.example_class.__name__, self._length)
+
+
+if __name__ == "__main__":
+
+    import gc
+    import time
+    import argparse
+    import tracemalloc
+    from . import data_processors
+
+    parser = argparse.ArgumentParser(
+        description="Load time and memory of the examples of a split, as "
+                    "dataclass instances and as an `ExampleTable`.")
+    parser.add_argument("--task_name", default="semeval", type=str)
+    parser.add_argument("--data_dir", default="datasets/semeval_2020_task4",
+                        type=str)
+    parser.add_argument("--split", default="train", type=str)
+    parser.add_argument("--repeats", default=5, type=int)
+    cli_args = parser.parse_args()
+
+    results = {}
+    for compact in [False, True]:
+        processor = data_processors[cli_args.task_name](
+            data_dir=cli_args.data_dir,
+            args=argparse.Namespace(compact_examples=compact))
+        times = []
+        for _ in range(cli_args.repeats):
+            gc.collect()
+            start = time.perf_counter()
+            examples = processor._read_data(split=cli_args.split)
+            times.append(time.perf_counter() - start)
+            del examples
+        gc.collect()
+        tracemalloc.start()
+        examples = processor._read_data(split=cli_args.split)
+        retained, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        results[compact] = examples
+        print("{:>12}: {} examples, load {:.3f}s (best of {}), retained "
+              "{:.1f} MB, peak {:.1f} MB".format(
+                  "table" if compact else "dataclasses", len(examples),
+                  min(times), cli_args.repeats, retained / 2 ** 20,
+                  peak / 2 ** 20))
+    assert all(view == example
+               for view, example in zip(results[True], results[False]))
@@ -0,0 +1,315 @@
+import os
+import json
+import shutil
+import hashlib
+import logging
+import tempfile
+import multiprocessing
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+def tokenizer_fingerprint(tokenizer):
+    """A content hash of a tokenizer (vocabulary, normalization and special
+    tokens), so that two checkpoints sharing a tokenizer share features."""
+    hasher = hashlib.sha1()
+    hasher.update(type(tokenizer).__name__.encode("utf-8"))
+    if getattr(tokenizer, "is_fast", False):
+        # Without the truncation and padding of the last call, which the
+        # backend keeps in its state.
+        backend = json.loads(tokenizer.backend_tokenizer.to_str())
+        backend.pop("truncation", None)
+        backend.pop("padding", None)
+        hasher.update(json.dumps(backend, sort_keys=True).encode("utf-8"))
+    else:
+        vocab = sorted(tokenizer.get_vocab().items())
+        hasher.update(json.dumps(vocab).encode("utf-8"))
+        hasher.update(str(getattr(tokenizer, "do_lower_case", None))
+                      .encode("utf-8"))
+    hasher.update(json.dumps(tokenizer.all_special_tokens).encode("utf-8"))
+    return hasher.hexdigest()
+
+
+def texts_fingerprint(texts):
+    """A content hash of the list of input texts."""
+    hasher = hashlib.sha1()
+    for text in texts:
+        hasher.update(text.encode("utf-8"))
+        hasher.update(b"\0")
+    return hasher.hexdigest()
+
+
+def special_tokens_layout(tokenizer):
+    """Returns the numbers of special tokens a tokenizer puts before and after
+    a single sequence, e.g. `(1, 1)` for `[CLS] ... [SEP]`."""
+    marker = -1
+    ids = tokenizer.build_inputs_with_special_tokens([marker])
+    prefix_len = ids.index(marker)
+    return prefix_len, len(ids) - prefix_len - 1
+
+
+class TokenizedFeatures(object):
+    """Untruncated token ids of a list of single-sentence examples.
+
+    The ids are stored flat with row offsets, so the same features serve
+    every `max_seq_length`: `encode` truncates the content (keeping the
+    special tokens, as the tokenizer's own truncation does) and pads.
+    """
+
+    def __init__(self, input_ids, offsets, prefix_len, suffix_len, pad_id):
+        self.input_ids = input_ids
+        self.offsets = offsets
+        self.prefix_len = prefix_len
+        self.suffix_len = suffix_len
+        self.pad_id = pad_id
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    @property
+    def lengths(self):
+        """Untruncated lengths (with special tokens) of all the examples."""
+        return np.diff(self.offsets)
+
+    def token_ids(self, idx, max_seq_length=None):
+        """Token ids of one example, truncated to `max_seq_length`."""
+        ids = self.input_ids[self.offsets[idx]:self.offsets[idx + 1]]
+        if max_seq_length is not None and len(ids) > max_seq_length:
+            keep = max_seq_length - self.suffix_len
+            ids = np.concatenate([ids[:keep], ids[len(ids) - self.suffix_len:]])
+        return ids
+
+    def encode(self, idx, max_seq_length):
+        """Returns `(input_ids, attention_mask)` padded to `max_seq_length`."""
+        ids = self.token_ids(idx, max_seq_length)
+        input_ids = np.full(max_seq_length, self.pad_id, dtype=np.int64)
+        attention_mask = np.zeros(max_seq_length, dtype=np.int64)
+        input_ids[:len(ids)] = ids
+        attention_mask[:len(ids)] = 1
+        return input_ids, attention_mask
+
+    def save(self, path):
+        """Saves the features into the directory `path` atomically."""
+        tmp_dir = _features_tmp_dir(path)
+        np.save(os.path.join(tmp_dir, "input_ids.npy"), self.input_ids)
+        _publish_features(tmp_dir, path, self.offsets, self.prefix_len,
+                          self.suffix_len, self.pad_id)
+
+    @classmethod
+    def load(cls, path):
+        """Loads the features memory-mapped, so that processes share them."""
+        with open(os.path.join(path, "meta.json")) as f:
+            meta = json.load(f)
+        input_ids = np.load(os.path.join(path, "input_ids.npy"), mmap_mode="r")
+        offsets = np.load(os.path.join(path, "offsets.npy"), mmap_mode="r")
+        return cls(input_ids, offsets, meta["prefix_len"], meta["suffix_len"],
+                   meta["pad_id"])
+
+
+def _features_tmp_dir(path):
+    parent = os.path.dirname(os.path.abspath(path))
+    os.makedirs(parent, exist_ok=True)
+    return tempfile.mkdtemp(dir=parent, prefix=".tmp-features-")
+
+
+def _publish_features(tmp_dir, path, offsets, prefix_len, suffix_len,
+                      pad_id):
+    """Writes the offsets and metadata next to `input_ids.npy` in `tmp_dir`
+    and renames it to `path`."""
+    np.save(os.path.join(tmp_dir, "offsets.npy"), offsets)
+    meta = {"prefix_len": prefix_len, "suffix_len": suffix_len,
+            "pad_id": pad_id, "num_examples": len(offsets) - 1}
+    with open(os.path.join(tmp_dir, "meta.json"), "w") as f:
+        json.dump(meta, f)
+    try:
+        os.rename(tmp_dir, path)
+    except OSError:
+        # Another process (e.g. a parallel sweep trial) got there first.
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+def tokenize_texts(texts, tokenizer, batch_size=1024):
+    """Tokenizes `texts` without truncation into `TokenizedFeatures`."""
+    prefix_len, suffix_len = special_tokens_layout(tokenizer)
+    all_ids, lengths = [], []
+    for start in range(0, len(texts), batch_size):
+        batch_encoding = tokenizer(list(texts[start:start + batch_size]),
+                                   add_special_tokens=True, truncation=False)
+        for ids in batch_encoding["input_ids"]:
+            all_ids.append(np.asarray(ids, dtype=np.int32))
+            lengths.append(len(ids))
+    offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    input_ids = np.concatenate(all_ids) if all_ids \
+                else np.zeros(0, dtype=np.int32)
+    return TokenizedFeatures(input_ids, offsets, prefix_len, suffix_len,
+                             tokenizer.pad_token_id)
+
+
+# Texts, tokenizer and output directory of a tokenization worker process.
+_worker_state = {}
+
+
+def _init_tokenization_worker(texts, tokenizer, tmp_dir):
+    _worker_state.update(texts=texts, tokenizer=tokenizer, tmp_dir=tmp_dir)
+
+
+def _tokenize_shard(shard):
+    """Tokenizes the texts `[start, end)` into a memory-mapped shard file,
+    returns the token counts of the texts."""
+    index, start, end = shard
+    features = tokenize_texts(_worker_state["texts"][start:end],
+                              _worker_state["tokenizer"])
+    np.save(os.path.join(_worker_state["tmp_dir"],
+                         "shard-{:06d}.npy".format(index)),
+            features.input_ids)
+    return features.lengths
+
+
+def build_features_parallel(texts, tokenizer, path, num_workers,
+                            shard_size=20000):
+    """Tokenizes `texts` with a pool of `num_workers` processes into the
+    feature directory `path` (the format of `TokenizedFeatures.save`).
+
+    The texts are cut into shards of `shard_size`, tokenized by the workers
+    in any order, and each worker writes its token ids to a shard file.
+    Shards are then copied in order into the memory-mapped `input_ids.npy`
+    at their offsets, so the features are the same as `tokenize_texts`'
+    whatever the number of workers, and never all in memory at once.
+    """
+    tmp_dir = _features_tmp_dir(path)
+    try:
+        _build_shards(texts, tokenizer, tmp_dir, path, num_workers,
+                      shard_size)
+    except BaseException:
+        # A failed worker (or an interrupt) leaves no partial shards.
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
+
+
+def _build_shards(texts, tokenizer, tmp_dir, path, num_workers, shard_size):
+    shards = [(index, start, min(start + shard_size, len(texts)))
+              for index, start in enumerate(range(0, len(texts),
+                                                  shard_size))]
+    # Forked workers inherit the texts and tokenizer instead of unpickling
+    # them.
+    context = multiprocessing.get_context(
+        "fork" if "fork" in multiprocessing.get_all_start_methods()
+        else None)
+    # One process per core already, the tokenizer's own threads would only
+    # compete with the other workers (the forked workers get this setting).
+    parallelism = os.environ.get("TOKENIZERS_PARALLELISM")
+    os.environ["TOKENIZERS_PARALLELISM"] = "false"
+    try:
+        pool = context.Pool(num_workers, initializer=_init_tokenization_worker,
+                            initargs=(texts, tokenizer, tmp_dir))
+    finally:
+        if parallelism is None:
+            del os.environ["TOKENIZERS_PARALLELISM"]
+        else:
+            os.environ["TOKENIZERS_PARALLELISM"] = parallelism
+    with pool:
+        lengths = list(pool.imap(_tokenize_shard, shards))
+
+    offsets = np.zeros(len(texts) + 1, dtype=np.int64)
+    if lengths:
+        np.cumsum(np.concatenate(lengths), out=offsets[1:])
+    input_ids = np.lib.format.open_memmap(
+        os.path.join(tmp_dir, "input_ids.npy"), mode="w+", dtype=np.int32,
+        shape=(int(offsets[-1]),))
+    for index, start, end in shards:
+        shard_path = os.path.join(tmp_dir, "shard-{:06d}.npy".format(index))
+        input_ids[offsets[start]:offsets[end]] = np.load(shard_path,
+                                                         mmap_mode="r")
+        os.remove(shard_path)
+    input_ids.flush()
+    del input_ids
+    prefix_len, suffix_len = special_tokens_layout(tokenizer)
+    _publish_features(tmp_dir, path, offsets, prefix_len, suffix_len,
+                      tokenizer.pad_token_id)
+
+
+def feature_cache_path(cache_dir, texts, tokenizer):
+    return os.path.join(cache_dir, "{}-{}".format(
+        tokenizer_fingerprint(tokenizer)[:16], texts_fingerprint(texts)[:16]))
+
+
+def load_or_build_features(texts, tokenizer, cache_dir, num_workers=1):
+    """Returns the features of `texts`, tokenizing them only on cache miss
+    (with `num_workers` processes if more than one)."""
+    path = feature_cache_path(cache_dir, texts, tokenizer)
+    if os.path.isdir(path):
+        logger.info("Loading cached features from %s", path)
+        return TokenizedFeatures.load(path)
+
+    logger.info("Building features into %s", path)
+    if num_workers > 1:
+        build_features_parallel(texts, tokenizer, path, num_workers)
+    else:
+        features = tokenize_texts(texts, tokenizer)
+        features.save(path)
+    return TokenizedFeatures.load(path)
+
+
+if __name__ == "__main__":
+
+    import time
+    import argparse
+    from transformers import AutoTokenizer
+    from . import data_processors
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--task_name", default="com2sense", type=str)
+    parser.add_argument("--data_dir", default="datasets/com2sense", type=str)
+    parser.add_argument("--tokenizer_name", default="bert-base-cased", type=str)
+    parser.add_argument("--cache_dir", default="outputs/feature_cache", type=str)
+    parser.add_argument("--splits", default=["train", "dev", "test"], nargs="+")
+    parser.add_argument("--num_workers", default=1, type=int)
+    parser.add_argument("--scaling_copies", default=0, type=int,
+                        help="If set, times the parallel tokenization of the "
+                             "first split repeated this many times, for 1 to "
+                             "`num_workers` processes, instead.")
+    cache_args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    tokenizer = AutoTokenizer.from_pretrained(cache_args.tokenizer_name)
+    processor = data_processors[cache_args.task_name](
+        data_dir=cache_args.data_dir)
+    if cache_args.scaling_copies:
+        examples = processor._read_data(split=cache_args.splits[0])
+        texts = [e.text for e in examples] * cache_args.scaling_copies
+        reference = None
+        workers = 1
+        while workers <= cache_args.num_workers:
+            path = tempfile.mkdtemp()
+            start = time.time()
+            if workers == 1:
+                tokenize_texts(texts, tokenizer).save(
+                    os.path.join(path, "features"))
+            else:
+                build_features_parallel(texts, tokenizer,
+                                        os.path.join(path, "features"),
+                                        workers)
+            seconds = time.time() - start
+            features = TokenizedFeatures.load(os.path.join(path, "features"))
+            if reference is None:
+                reference, reference_seconds = features, seconds
+            same = np.array_equal(features.input_ids, reference.input_ids) \
+                and np.array_equal(features.offsets, reference.offsets)
+            print("{} workers: {} texts, {:.2f}s, speedup {:.2f}, same "
+                  "features: {}".format(workers, len(texts), seconds,
+                                        reference_seconds / seconds, same))
+            shutil.rmtree(path)
+            workers *= 2
+    else:
+        for split in cache_args.splits:
+            examples = processor._read_data(split=split)
+            start = time.time()
+            features = load_or_build_features([e.text for e in examples],
+                                              tokenizer, cache_args.cache_dir,
+                                              cache_args.num_workers)
+            print("{}: {} examples, max length {}, {:.3f}s".format(
+                split, len(features), features.lengths.max(),
+                time.time() - start))
@@ -0,0 +1,241 @@
+import zlib
+import logging
+from collections import defaultdict
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Shingle hashes are 31-bit, so that `a * x + b` of the permutations below
+# fits in 64 bits.
+_PRIME = (1 << 31) - 1
+
+
+def shingles(text, size=5):
+    """Hashes of the character `size`-grams of the lowercased text, with
+    whitespace collapsed."""
+    text = " ".join(text.lower().split())
+    if len(text) <= size:
+        return {zlib.crc32(text.encode("utf-8")) % _PRIME}
+    return {zlib.crc32(text[i:i + size].encode("utf-8")) % _PRIME
+            for i in range(len(text) - size + 1)}
+
+
+def jaccard(a, b):
+    return len(a & b) / float(len(a | b)) if a or b else 1.0
+
+
+def lsh_bands(num_perm, threshold, recall=0.99):
+    """`(bands, rows)` with `bands * rows == num_perm`: the most rows per
+    band (the fewest candidate pairs) such that a pair of similarity
+    `threshold` still shares a bucket with probability `recall`."""
+    best = (num_perm, 1)
+    for rows in range(1, num_perm + 1):
+        if num_perm % rows:
+            continue
+        bands = num_perm // rows
+        if 1.0 - (1.0 - threshold ** rows) ** bands >= recall:
+            best = (bands, rows)
+    return best
+
+
+class NearDuplicateIndex(object):
+    """MinHash signatures of example texts in LSH buckets.
+
+    Only examples sharing a bucket in some band are compared, so finding all
+    the pairs above `threshold` (Jaccard similarity of character shingles)
+    is close to linear in the number of examples instead of quadratic.
+    Examples are keyed by `(split, position)`.
+    """
+
+    def __init__(self, threshold=0.8, num_perm=128, shingle_size=5, seed=1):
+        self.threshold = threshold
+        self.shingle_size = shingle_size
+        self.bands, self.rows = lsh_bands(num_perm, threshold)
+        rng = np.random.RandomState(seed)
+        self.a = rng.randint(1, _PRIME, size=num_perm).astype(np.uint64)
+        self.b = rng.randint(0, _PRIME, size=num_perm).astype(np.uint64)
+        self.keys = []
+        self.guids = []
+        self.shingle_sets = []
+        self.signatures = []
+
+    def signature(self, shingle_set):
+        hashes = np.fromiter(shingle_set, dtype=np.uint64,
+                             count=len(shingle_set))
+        return ((self.a[:, None] * hashes[None, :] + self.b[:, None])
+                % _PRIME).min(axis=1)
+
+    def add(self, split, examples):
+        for position, example in enumerate(examples):
+            shingle_set = shingles(example.text, self.shingle_size)
+            self.keys.append((split, position))
+            self.guids.append(example.guid)
+            self.shingle_sets.append(shingle_set)
+            self.signatures.append(self.signature(shingle_set))
+
+    def candidate_pairs(self):
+        """Index pairs `(i, j)`, `i < j`, sharing a bucket in some band."""
+        signatures = np.stack(self.signatures)
+        candidates = set()
+        for band in range(self.bands):
+            rows = signatures[:, band * self.rows:(band + 1) * self.rows]
+            _, buckets = np.unique(rows, axis=0, return_inverse=True)
+            buckets = buckets.reshape(-1)
+            order = np.argsort(buckets, kind="stable")
+            bounds = np.flatnonzero(np.diff(buckets[order])) + 1
+            for members in np.split(order, bounds):
+                if len(members) < 2:
+                    continue
+                members = np.sort(members).tolist()
+                for x in range(len(members)):
+                    for y in range(x + 1, len(members)):
+                        candidates.add((members[x], members[y]))
+        return candidates
+
+    def pairs(self):
+        """`(key_a, key_b, similarity)` of all the near-duplicate pairs.
+
+        The two statements of a complementary pair (same split and guid) are
+        near-duplicates by construction and are left out.
+        """
+        results = []
+        for i, j in sorted(self.candidate_pairs()):
+            if (self.keys[i][0] == self.keys[j][0]
+                    and self.guids[i] == self.guids[j]):
+                continue
+            similarity = jaccard(self.shingle_sets[i], self.shingle_sets[j])
+            if similarity >= self.threshold:
+                results.append((self.keys[i], self.keys[j], similarity))
+        return results
+
+
+def find_near_duplicates(splits, threshold=0.8, **kwargs):
+    """Near-duplicate pairs within and across the `{split: examples}`.
+
+    Returns `{(split_a, split_b): [(position_a, position_b, similarity)]}`.
+    """
+    index = NearDuplicateIndex(threshold, **kwargs)
+    for split, examples in splits.items():
+        index.add(split, examples)
+    found = defaultdict(list)
+    for (split_a, i), (split_b, j), similarity in index.pairs():
+        found[(split_a, split_b)].append((i, j, similarity))
+    return found
+
+
+def dedupe_examples(examples, threshold=0.9, against=None, **kwargs):
+    """Drops the near-duplicate groups of `examples` (training examples).
+
+    Examples sharing a guid (a complementary pair) are kept or dropped
+    together: a group is dropped when each of its statements is a
+    near-duplicate of a statement of an earlier kept group, or of any of the
+    `against` examples (e.g. the dev and test splits, against leakage).
+
+    Returns the kept examples, in their original order.
+    """
+    index = NearDuplicateIndex(threshold, **kwargs)
+    index.add("train", examples)
+    for split, other_examples in (against or {}).items():
+        index.add(split, other_examples)
+
+    group_of = {}
+    groups = []
+    for position, example in enumerate(examples):
+        if example.guid not in group_of:
+            group_of[example.guid] = len(groups)
+            groups.append([])
+        groups[group_of[example.guid]].append(position)
+
+    # For each train statement, the groups it duplicates (-1: other splits).
+    duplicates = defaultdict(set)
+    for (split_a, i), (split_b, j), _ in index.pairs():
+        if split_a == "train" and split_b == "train":
+            duplicates[i].add(group_of[examples[j].guid])
+            duplicates[j].add(group_of[examples[i].guid])
+        elif split_a == "train":
+            duplicates[i].add(-1)
+        elif split_b == "train":
+            duplicates[j].add(-1)
+
+    kept_groups = set()
+    kept = []
+    for group, positions in enumerate(groups):
+        is_duplicate = all(
+            -1 in duplicates[p] or any(g < group and g in kept_groups
+                                       for g in duplicates[p])
+            for p in positions)
+        if not is_duplicate:
+            kept_groups.add(group)
+            kept.extend(positions)
+    logger.info("Near-duplicate filtering kept %d of %d examples "
+                "(threshold %.2f)", len(kept), len(examples), threshold)
+    return [examples[p] for p in sorted(kept)]
+
+
+if __name__ == "__main__":
+
+    import time
+    import argparse
+    import itertools
+    from . import data_processors
+
+    parser = argparse.ArgumentParser(
+        description="Near-duplicate statements within and across splits.")
+    parser.add_argument("--task_name", default="semeval", type=str)
+    parser.add_argument("--data_dir", default="datasets/semeval_2020_task4",
+                        type=str)
+    parser.add_argument("--splits", default=["train", "dev", "test"],
+                        nargs="+")
+    parser.add_argument("--threshold", default=0.8, type=float)
+    parser.add_argument("--num_perm", default=128, type=int)
+    parser.add_argument("--show", default=3, type=int,
+                        help="Pairs to print per split pair.")
+    parser.add_argument("--brute_force", action="store_true",
+                        help="Also compare all pairs exactly, for the recall "
+                             "and time of the index.")
+    cli_args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    processor = data_processors[cli_args.task_name](
+        data_dir=cli_args.data_dir)
+    splits = {split: processor._read_data(split=split)
+              for split in cli_args.splits}
+
+    start = time.time()
+    found = find_near_duplicates(splits, cli_args.threshold,
+                                 num_perm=cli_args.num_perm)
+    print("MinHash/LSH: {} examples in {:.2f}s".format(
+        sum(len(examples) for examples in splits.values()),
+        time.time() - start))
+    for split_a, split_b in itertools.combinations_with_replacement(
+            cli_args.splits, 2):
+        split_pairs = found.get((split_a, split_b), [])
+        print("  {} / {}: {} pairs".format(split_a, split_b,
+                                           len(split_pairs)))
+        for i, j, similarity in split_pairs[:cli_args.show]:
+            print("    {:.2f}  {!r}\n          {!r}".format(
+                similarity, splits[split_a][i].text, splits[split_b][j].text))
+
+    if cli_args.brute_force:
+        start = time.time()
+        keys, guids, sets = [], [], []
+        for split, examples in splits.items():
+            for position, example in enumerate(examples):
+                keys.append((split, position))
+                guids.append(example.guid)
+                sets.append(shingles(example.text))
+        exact = set()
+        for i in range(len(sets)):
+            for j in range(i + 1, len(sets)):
+                if keys[i][0] == keys[j][0] and guids[i] == guids[j]:
+                    continue
+                if jaccard(sets[i], sets[j]) >= cli_args.threshold:
+                    exact.add((keys[i], keys[j]))
+        lsh = set((split_a, i, split_b, j)
+                  for (split_a, split_b), split_pairs in found.items()
+                  for i, j, _ in split_pairs)
+        recall = sum((a[0], a[1], b[0], b[1]) in lsh
+                     for a, b in exact) / max(1, len(exact))
+        print("Brute force: {} pairs in {:.2f}s, LSH recall {:.3f}".format(
+            len(exact), time.time() - start, recall))
@@ -0,0 +1,120 @@
+import logging
+
+import numpy as np
+import torch
+from torch.utils.data import Dataset
+
+logger = logging.getLogger(__name__)
+
+
+def pack_lengths(lengths, max_seq_length, max_segments=16):
+    """Best-fit-decreasing bin packing of sequence lengths into rows of
+    `max_seq_length` tokens. Returns a list of rows of example indices."""
+    order = sorted(range(len(lengths)), key=lambda i: (-lengths[i], i))
+    rows = []
+    # open_rows[c] lists the rows with exactly `c` free tokens left.
+    open_rows = [[] for _ in range(max_seq_length + 1)]
+    for idx in order:
+        length = lengths[idx]
+        row = None
+        for capacity in range(length, max_seq_length + 1):
+            if open_rows[capacity]:
+                row = open_rows[capacity].pop()
+                break
+        if row is None:
+            row = len(rows)
+            rows.append([])
+            capacity = max_seq_length
+        rows[row].append(idx)
+        if len(rows[row]) < max_segments:
+            open_rows[capacity - length].append(row)
+    return rows
+
+
+class PackedDataset(Dataset):
+    """Several short examples packed into each `max_seq_length` row.
+
+    Each row item is `(input_ids, position_ids, segment_ids, cls_positions,
+    labels, example_index)`: position ids restart at 0 for every segment,
+    segment ids number the segments from 1 (0 is padding) so that the model
+    can build a block-diagonal attention mask, and the last three tensors
+    have one entry per segment (padded with -1 / -100 up to
+    `max_segments`). `example_index` maps the segments back to the order
+    of the wrapped examples, see `trainers/packing_utils.py`.
+    """
+
+    def __init__(self, examples, tokenizer, max_seq_length=128,
+                 features=None, max_segments=16):
+        """
+        Args:
+            examples (list): input examples from one of the processors.
+            tokenizer (huggingface.tokenizer): tokenizer in used.
+            max_seq_length (int): the length of a packed row.
+            features (TokenizedFeatures): optional pre-tokenized examples
+                from `feature_cache.py`.
+            max_segments (int): maximum number of examples in a row.
+        """
+        self.examples = examples
+        self.max_seq_length = max_seq_length
+        self.max_segments = max_segments
+        self.pad_id = tokenizer.pad_token_id
+
+        if features is not None:
+            self.token_ids = [features.token_ids(i, max_seq_length)
+                              for i in range(len(examples))]
+        else:
+            batch_encoding = tokenizer([example.text for example in examples],
+                                       add_special_tokens=True,
+                                       max_length=max_seq_length,
+                                       truncation=True)
+            self.token_ids = [np.asarray(ids)
+                              for ids in batch_encoding["input_ids"]]
+
+        self.labels = [-100 if example.label is None else example.label
+                       for example in examples]
+        self.rows = pack_lengths([len(ids) for ids in self.token_ids],
+                                 max_seq_length, max_segments)
+
+        num_tokens = sum(len(ids) for ids in self.token_ids)
+        logger.info("Packed %d examples into %d rows of %d tokens (%.1f%% "
+                    "padding instead of %.1f%%)", len(examples),
+                    len(self.rows), max_seq_length,
+                    100.0 * (1 - num_tokens / float(len(self.rows)
+                                                    * max_seq_length)),
+                    100.0 * (1 - num_tokens / float(len(examples)
+                                                    * max_seq_length)))
+
+    @classmethod
+    def from_dataset(cls, dataset, max_segments=16):
+        """Packs the examples of a `Com2SenseDataset`, `SemEvalDataset` or
+        `DummyDataset`."""
+        return cls(dataset.examples, dataset.tokenizer,
+                   max_seq_length=dataset.max_seq_length,
+                   features=dataset.features, max_segments=max_segments)
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __getitem__(self, idx):
+        input_ids = torch.full((self.max_seq_length,), self.pad_id,
+                               dtype=torch.long)
+        position_ids = torch.zeros(self.max_seq_length, dtype=torch.long)
+        segment_ids = torch.zeros(self.max_seq_length, dtype=torch.long)
+        cls_positions = torch.zeros(self.max_segments, dtype=torch.long)
+        labels = torch.full((self.max_segments,), -100, dtype=torch.long)
+        example_index = torch.full((self.max_segments,), -1, dtype=torch.long)
+
+        start = 0
+        for segment, example_idx in enumerate(self.rows[idx]):
+            ids = self.token_ids[example_idx]
+            end = start + len(ids)
+            input_ids[start:end] = torch.as_tensor(ids, dtype=torch.long)
+            position_ids[start:end] = torch.arange(len(ids))
+            segment_ids[start:end] = segment + 1
+            cls_positions[segment] = start
+            labels[segment] = self.labels[example_idx]
+            example_index[segment] = example_idx
+            start = end
+
+        return (input_ids, position_ids, segment_ids, cls_positions, labels,
+                example_index)
@@ -18,16 +18,12 @@ from torch.utils.data import Dataset, DataLoader
 from torch.utils.data import RandomSampler
 from torch.utils.data.distributed import DistributedSampler
 from dataclasses import dataclass
-from transformers import PreTrainedTokenizer, is_tf_available, is_torch_available
 from torch.utils.data import DataLoader, SequentialSampler
 
 # Processors.
 from .dummy_data import DummyDataProcessor
 from .com2sense_data import Com2SenseDataProcessor
 from .semeval_data import SemEvalDataProcessor
-from transformers import (
-    AutoTokenizer,
-)
 
 logger = logging.getLogger(__name__)
 
@@ -37,13 +33,15 @@ class DummyDataset(Dataset):
 
     def __init__(self, examples, tokenizer,
                  max_seq_length=None,
-                 seed=None, args=None):
+                 seed=None, args=None, features=None):
         """
         Args:
             examples (list): input examples of type `DummyExample`.
             tokenizer (huggingface.tokenizer): tokenizer in used.
             max_seq_length (int): maximum length to truncate the input ids.
             seed (int): random seed.
+            features (TokenizedFeatures): optional pre-tokenized examples
+                from `feature_cache.py`, used instead of the tokenizer.
         """
         if seed is not None:
             np.random.seed(seed)
@@ -56,6 +54,7 @@ class DummyDataset(Dataset):
 
         self.tokenizer = tokenizer
         self.max_seq_length = max_seq_length
+        self.features = features
 
         self.cls_id = self.tokenizer.convert_tokens_to_ids(tokenizer.cls_token)
         self.pad_id = self.tokenizer.convert_tokens_to_ids(tokenizer.pad_token)
@@ -73,13 +72,19 @@ class DummyDataset(Dataset):
         text = example.text
         label = example.label
 
-        batch_encoding = self.tokenizer(
-            text,
-            add_special_tokens=True,
-            max_length=self.max_seq_length,
-            padding="max_length",
-            truncation=True,
-        )
+        if self.features is not None:
+            input_ids, attention_mask = self.features.encode(
+                idx, self.max_seq_length)
+            batch_encoding = {"input_ids": input_ids,
+                              "attention_mask": attention_mask}
+        else:
+            batch_encoding = self.tokenizer(
+                text,
+                add_special_tokens=True,
+                max_length=self.max_seq_length,
+                padding="max_length",
+                truncation=True,
+            )
 
         input_ids = torch.Tensor(batch_encoding["input_ids"]).long()
         attention_mask = torch.Tensor(batch_encoding["attention_mask"]).long()
@@ -101,13 +106,15 @@ class SemEvalDataset(Dataset):
 
     def __init__(self, examples, tokenizer,
                  max_seq_length=None,
-                 seed=None, args=None):
+                 seed=None, args=None, features=None):
         """
         Args:
             examples (list): input examples of type `DummyExample`.
             tokenizer (huggingface.tokenizer): tokenizer in used.
             max_seq_length (int): maximum length to truncate the input ids.
             seed (int): random seed.
+            features (TokenizedFeatures): optional pre-tokenized examples
+                from `feature_cache.py`, used instead of the tokenizer.
         """
         if seed is not None:
             np.random.seed(seed)
@@ -120,6 +127,7 @@ class SemEvalDataset(Dataset):
 
         self.tokenizer = tokenizer
         self.max_seq_length = max_seq_length
+        self.features = features
 
         self.cls_id = self.tokenizer.convert_tokens_to_ids(tokenizer.cls_token)
         self.pad_id = self.tokenizer.convert_tokens_to_ids(tokenizer.pad_token)
@@ -143,13 +151,19 @@ class SemEvalDataset(Dataset):
         text = example.text
         label = example.label
 
-        batch_encoding = self.tokenizer(
-            text,
-            add_special_tokens=True,
-            max_length=self.max_seq_length,
-            padding="max_length",
-            truncation=True,
-        )
+        if self.features is not None:
+            input_ids, attention_mask = self.features.encode(
+                idx, self.max_seq_length)
+            batch_encoding = {"input_ids": input_ids,
+                              "attention_mask": attention_mask}
+        else:
+            batch_encoding = self.tokenizer(
+                text,
+                add_special_tokens=True,
+                max_length=self.max_seq_length,
+                padding="max_length",
+                truncation=True,
+            )
         input_ids = torch.Tensor(batch_encoding["input_ids"]).long()
         attention_mask = torch.Tensor(batch_encoding["attention_mask"]).long()
         if "token_type_ids" not in batch_encoding:
@@ -176,13 +190,15 @@ class Com2SenseDataset(Dataset):
 
     def __init__(self, examples, tokenizer,
                  max_seq_length=None,
-                 seed=None, args=None):
+                 seed=None, args=None, features=None):
         """
         Args:
             examples (list): input examples of type `DummyExample`.
             tokenizer (huggingface.tokenizer): tokenizer in used.
             max_seq_length (int): maximum length to truncate the input ids.
             seed (int): random seed.
+            features (TokenizedFeatures): optional pre-tokenized examples
+                from `feature_cache.py`, used instead of the tokenizer.
         """
         if seed is not None:
             np.random.seed(seed)
@@ -195,6 +211,7 @@ class Com2SenseDataset(Dataset):
 
         self.tokenizer = tokenizer
         self.max_seq_length = max_seq_length
+        self.features = features
 
         self.cls_id = self.tokenizer.convert_tokens_to_ids(tokenizer.cls_token)
         self.pad_id = self.tokenizer.convert_tokens_to_ids(tokenizer.pad_token)
@@ -221,13 +238,19 @@ class Com2SenseDataset(Dataset):
         scenario = example.scenario
         numeracy = example.numeracy
 
-        batch_encoding = self.tokenizer(
-            text,
-            add_special_tokens=True,
-            max_length=self.max_seq_length,
-            padding="max_length",
-            truncation=True,
-        )
+        if self.features is not None:
+            input_ids, attention_mask = self.features.encode(
+                idx, self.max_seq_length)
+            batch_encoding = {"input_ids": input_ids,
+                              "attention_mask": attention_mask}
+        else:
+            batch_encoding = self.tokenizer(
+                text,
+                add_special_tokens=True,
+                max_length=self.max_seq_length,
+                padding="max_length",
+                truncation=True,
+            )
         input_ids = torch.Tensor(batch_encoding["input_ids"]).long()
         attention_mask = torch.Tensor(batch_encoding["attention_mask"]).long()
         if "token_type_ids" not in batch_encoding:
@@ -250,8 +273,140 @@ class Com2SenseDataset(Dataset):
         return input_ids, attention_mask, token_type_ids, labels, guid
 
 
+class SemEvalMultipleChoiceDataset(Dataset):
+    """Sem-Eval 2020 Task 4 subtask B Dataset.
+
+    Every item holds all the choices of an example as `(num_choices,
+    max_seq_length)` tensors of `[CLS] statement [SEP] reason [SEP]`, for a
+    multiple-choice model to score in one forward pass.
+
+    The distinct statements and reasons are tokenized once, in two batched
+    calls, and the pairs are assembled from their ids with the tokenizer's
+    special tokens. A statement is thus tokenized once for all its choices
+    (and all the examples sharing it), instead of once per pair. An empty
+    reason gives `[CLS] statement [SEP]`, as the tokenizers encode it. When
+    the assembled ids differ from the tokenizer's own pair encoding, the
+    pairs are tokenized as usual.
+    """
+
+    def __init__(self, examples, tokenizer,
+                 max_seq_length=None,
+                 seed=None, args=None, features=None):
+        """
+        Args:
+            examples (list): input examples of type
+                `SemEvalMultipleChoiceExample`.
+            tokenizer (huggingface.tokenizer): tokenizer in used.
+            max_seq_length (int): maximum length to truncate the input ids.
+            seed (int): random seed.
+            features: unused, the feature cache holds single sentences.
+        """
+        if seed is not None:
+            np.random.seed(seed)
+            torch.manual_seed(seed)
+            random.seed(seed)
+            self.seed = seed
+
+        self.args = args
+        self.examples = examples
+        self.tokenizer = tokenizer
+        self.max_seq_length = max_seq_length
+        self.pad_id = tokenizer.pad_token_id
+
+        texts = sorted(set(example.statement for example in examples)
+                       | set(choice for example in examples
+                             for choice in example.choices))
+        token_ids = tokenizer(texts, add_special_tokens=False)["input_ids"]
+        self.token_ids = dict(zip(texts, token_ids))
+        self.num_special = tokenizer.num_special_tokens_to_add(pair=True)
+
+        # Checked on every pair of the first examples, and on an empty
+        # choice, which the tokenizers encode without a second sequence.
+        pairs = [(example.statement, choice) for example in examples[:16]
+                 for choice in example.choices]
+        if examples:
+            pairs.append((examples[0].statement, ""))
+        self.shared_tokenization = all(
+            self._pair_ids(statement, choice)[0] == tokenizer(
+                statement, choice, truncation=True,
+                max_length=max_seq_length)["input_ids"]
+            for statement, choice in pairs)
+        if not self.shared_tokenization:
+            logger.warning("Pairs of %s are tokenized one by one.",
+                           type(tokenizer).__name__)
+
+    def __len__(self):
+        return len(self.examples)
+
+    def _pair_ids(self, statement, choice):
+        first = self.token_ids[statement]
+        if not choice:
+            # The tokenizers encode an empty second text as no pair at all.
+            first = first[:self.max_seq_length
+                          - self.tokenizer.num_special_tokens_to_add()]
+            return (self.tokenizer.build_inputs_with_special_tokens(first),
+                    self.tokenizer.create_token_type_ids_from_sequences(
+                        first))
+        second = self.token_ids[choice]
+        # Longest-first truncation, as the (fast) tokenizers do it: the
+        # shorter sequence keeps its length if it fits in half the budget,
+        # otherwise the budget is split in halves.
+        budget = self.max_seq_length - self.num_special
+        if len(first) + len(second) > budget:
+            shorter, longer = sorted([len(first), len(second)])
+            if shorter > budget // 2:
+                shorter, longer = budget // 2, budget - budget // 2
+            else:
+                longer = budget - shorter
+            if len(first) > len(second):
+                first, second = first[:longer], second[:shorter]
+            else:
+                first, second = first[:shorter], second[:longer]
+        input_ids = self.tokenizer.build_inputs_with_special_tokens(first,
+                                                                    second)
+        token_type_ids = self.tokenizer.create_token_type_ids_from_sequences(
+            first, second)
+        return input_ids, token_type_ids
+
+    def __getitem__(self, idx):
+        example = self.examples[idx]
+        num_choices = len(example.choices)
+        input_ids = torch.full((num_choices, self.max_seq_length),
+                               self.pad_id, dtype=torch.long)
+        attention_mask = torch.zeros((num_choices, self.max_seq_length),
+                                     dtype=torch.long)
+        token_type_ids = torch.zeros((num_choices, self.max_seq_length),
+                                     dtype=torch.long)
+        for c, choice in enumerate(example.choices):
+            if self.shared_tokenization:
+                ids, types = self._pair_ids(example.statement, choice)
+            else:
+                encoding = self.tokenizer(example.statement, choice,
+                                          truncation=True,
+                                          max_length=self.max_seq_length)
+                ids = encoding["input_ids"]
+                types = encoding.get("token_type_ids", [0] * len(ids))
+            input_ids[c, :len(ids)] = torch.as_tensor(ids)
+            attention_mask[c, :len(ids)] = 1
+            token_type_ids[c, :len(types)] = torch.as_tensor(types)
+
+        guid = example.guid
+        label = example.label
+        if label is not None:
+            labels = torch.tensor(label, dtype=torch.long)
+
+        if not self.args.do_train:
+            if label is None:
+                return input_ids, attention_mask, token_type_ids, guid
+            return input_ids, attention_mask, token_type_ids, labels, guid
+
+        return input_ids, attention_mask, token_type_ids, labels
+
+
 if __name__ == "__main__":
 
+    from transformers import AutoTokenizer
+
     parser = argparse.ArgumentParser()
     # Basic args.
     parser.add_argument(
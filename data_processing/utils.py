@@ -30,6 +30,15 @@ class DataProcessor:
         """Gets the list of labels for this data set."""
         raise NotImplementedError()
 
+    def _new_examples(self, example_class, categorical=()):
+        """The container `_read_data` appends the examples to: a list, or an
+        `ExampleTable` (with `categorical` fields stored as codes) when
+        `args.compact_examples` is set."""
+        if getattr(getattr(self, "args", None), "compact_examples", False):
+            from .example_table import ExampleTable
+            return ExampleTable(example_class, categorical=categorical)
+        return []
+
 
 @dataclass
 class DummyExample:
@@ -82,3 +91,21 @@ class SemEvalSingleSentenceExample:
     def to_json_string(self):
         """Serializes this instance to a JSON string."""
         return json.dumps(dataclasses.asdict(self), indent=2) + "\n"
+
+
+@dataclass
+class SemEvalMultipleChoiceExample:
+    """
+    A single training/test example for Sem-Eval subtask B: the statement
+    against common sense and the candidate reasons, `label` is the index of
+    the right one.
+    """
+
+    guid: str
+    statement: str
+    choices: List[str]
+    label: Optional[int] = None
+
+    def to_json_string(self):
+        """Serializes this instance to a JSON string."""
+        return json.dumps(dataclasses.asdict(self), indent=2) + "\n"
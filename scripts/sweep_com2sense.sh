@@ -0,0 +1,24 @@
+TASK_NAME="com2sense"
+DATA_DIR="datasets/com2sense"
+MODEL_TYPE="bert-base-cased"
+
+python3 -m trainers.sweep \
+  --param learning_rate=1e-5,2e-5,5e-5 \
+  --param per_gpu_train_batch_size=8,16 \
+  --prune \
+  -- \
+  --model_name_or_path ${MODEL_TYPE} \
+  --do_not_load_optimizer \
+  --do_train \
+  --evaluate_during_training \
+  --per_gpu_eval_batch_size 64 \
+  --num_train_epochs 10.0 \
+  --max_seq_length 128 \
+  --output_dir "${TASK_NAME}/sweep" \
+  --task_name "${TASK_NAME}" \
+  --data_dir "${DATA_DIR}" \
+  --save_steps 1000 \
+  --logging_steps 50 \
+  --warmup_steps 100 \
+  --eval_split "dev" \
+  --score_average_method "binary" \
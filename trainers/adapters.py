@@ -0,0 +1,255 @@
+import os
+import copy
+import json
+import math
+import logging
+
+import torch
+import torch.nn as nn
+
+from .model_heads import head_parameters
+
+logger = logging.getLogger(__name__)
+
+ADAPTER_WEIGHTS_NAME = "adapter_model.bin"
+ADAPTER_CONFIG_NAME = "adapter_config.json"
+
+# Attention projections that get LoRA updates (query and value, as in the
+# LoRA paper), and the output projections after which bottleneck adapters
+# are inserted (after attention and after the feed-forward block).
+LORA_TARGETS = {
+    "bert": ["query", "value"],
+    "roberta": ["query", "value"],
+    "deberta-v2": ["query_proj", "value_proj"],
+    "distilbert": ["q_lin", "v_lin"],
+}
+ADAPTER_TARGETS = {
+    "bert": ["output.dense"],
+    "roberta": ["output.dense"],
+    "deberta-v2": ["output.dense"],
+    "distilbert": ["out_lin", "ffn.lin2"],
+}
+
+
+class LoRALinear(nn.Module):
+    """A frozen `nn.Linear` plus a trainable low-rank update
+    `scaling * B @ A`, with `B` initialized to zero so training starts from
+    the pretrained function."""
+
+    def __init__(self, base, r=8, alpha=16, dropout=0.0):
+        super(LoRALinear, self).__init__()
+        self.base = base
+        self.lora_A = nn.Parameter(torch.empty(r, base.in_features))
+        self.lora_B = nn.Parameter(torch.zeros(base.out_features, r))
+        nn.init.kaiming_uniform_(self.lora_A, a=math.sqrt(5))
+        self.scaling = alpha / float(r)
+        self.dropout = nn.Dropout(dropout)
+
+    def forward(self, x):
+        update = self.dropout(x) @ self.lora_A.t() @ self.lora_B.t()
+        return self.base(x) + update * self.scaling
+
+    def merged(self):
+        """An `nn.Linear` with the low-rank update folded into its weight."""
+        linear = copy.deepcopy(self.base)
+        with torch.no_grad():
+            linear.weight += (self.lora_B @ self.lora_A) * self.scaling
+        return linear
+
+
+class BottleneckAdapter(nn.Module):
+    """A frozen `nn.Linear` followed by a residual bottleneck adapter
+    (Houlsby et al., 2019), with a zero-initialized up projection."""
+
+    def __init__(self, base, adapter_size=64):
+        super(BottleneckAdapter, self).__init__()
+        self.base = base
+        self.adapter_down = nn.Linear(base.out_features, adapter_size)
+        self.adapter_up = nn.Linear(adapter_size, base.out_features)
+        nn.init.zeros_(self.adapter_up.weight)
+        nn.init.zeros_(self.adapter_up.bias)
+        self.activation = nn.GELU()
+
+    def forward(self, x):
+        hidden = self.base(x)
+        return hidden + self.adapter_up(self.activation(
+            self.adapter_down(hidden)))
+
+
+def _replace_modules(model, targets, wrap):
+    names = [name for name, module in model.named_modules()
+             if isinstance(module, nn.Linear)
+             and any(name == t or name.endswith("." + t) for t in targets)]
+    for name in names:
+        parent_name, _, child_name = name.rpartition(".")
+        parent = model.get_submodule(parent_name)
+        setattr(parent, child_name, wrap(getattr(parent, child_name)))
+    return len(names)
+
+
+def adapter_config_from_args(args, model):
+    return {
+        "peft_mode": args.peft_mode,
+        "model_type": model.config.model_type,
+        "base_model": model.config._name_or_path,
+        "lora_r": args.lora_r,
+        "lora_alpha": args.lora_alpha,
+        "lora_dropout": args.lora_dropout,
+        "adapter_size": args.adapter_size,
+    }
+
+
+def apply_adapters(model, config):
+    """Freezes `model` and adds trainable LoRA or bottleneck adapter weights
+    (`config["peft_mode"]`), the classification head stays trainable."""
+    model_type = model.config.model_type
+    if model_type not in LORA_TARGETS:
+        raise ValueError("Adapters are not supported for model type {}."
+                         .format(model_type))
+
+    for param in model.parameters():
+        param.requires_grad = False
+
+    if config["peft_mode"] == "lora":
+        num_wrapped = _replace_modules(
+            model, LORA_TARGETS[model_type],
+            lambda linear: LoRALinear(linear, config["lora_r"],
+                                      config["lora_alpha"],
+                                      config["lora_dropout"]))
+    elif config["peft_mode"] == "adapter":
+        num_wrapped = _replace_modules(
+            model, ADAPTER_TARGETS[model_type],
+            lambda linear: BottleneckAdapter(linear, config["adapter_size"]))
+    else:
+        raise ValueError("Unknown peft mode {}.".format(config["peft_mode"]))
+
+    for _, param in head_parameters(model):
+        param.requires_grad = True
+    model.adapter_config = config
+
+    num_trainable = sum(p.numel() for p in model.parameters()
+                        if p.requires_grad)
+    num_total = sum(p.numel() for p in model.parameters())
+    logger.info("Added %s weights to %d linear layers, training %d / %d "
+                "parameters (%.2f%%)", config["peft_mode"], num_wrapped,
+                num_trainable, num_total, 100.0 * num_trainable / num_total)
+    return model
+
+
+def trainable_state_dict(model):
+    """The adapter and classification head weights only."""
+    trainable = {name for name, param in model.named_parameters()
+                 if param.requires_grad}
+    return {name: tensor for name, tensor in model.state_dict().items()
+            if name in trainable}
+
+
+def save_adapters(model, output_dir):
+    torch.save(trainable_state_dict(model),
+               os.path.join(output_dir, ADAPTER_WEIGHTS_NAME))
+    with open(os.path.join(output_dir, ADAPTER_CONFIG_NAME), "w") as f:
+        json.dump(model.adapter_config, f, indent=2)
+
+
+def is_adapter_checkpoint(path):
+    return os.path.isfile(os.path.join(path, ADAPTER_CONFIG_NAME))
+
+
+def load_adapter_config(checkpoint_dir):
+    with open(os.path.join(checkpoint_dir, ADAPTER_CONFIG_NAME)) as f:
+        return json.load(f)
+
+
+def load_adapters(model, checkpoint_dir):
+    """Loads adapter weights saved by `save_adapters` into a model that
+    already went through `apply_adapters`."""
+    state_dict = torch.load(os.path.join(checkpoint_dir, ADAPTER_WEIGHTS_NAME),
+                            map_location="cpu")
+    missing, unexpected = model.load_state_dict(state_dict, strict=False)
+    if unexpected:
+        raise ValueError("Unexpected adapter weights: {}".format(unexpected))
+    return model
+
+
+def merge_adapters(model):
+    """Folds the LoRA updates into the frozen weights, so that inference
+    runs the original architecture at the original speed. Bottleneck
+    adapters are non-linear and stay as they are."""
+    merged = 0
+    for name, module in list(model.named_modules()):
+        if isinstance(module, LoRALinear):
+            parent_name, _, child_name = name.rpartition(".")
+            setattr(model.get_submodule(parent_name), child_name,
+                    module.merged())
+            merged += 1
+    logger.info("Merged %d LoRA layers into the base weights", merged)
+    return model
+
+
+if __name__ == "__main__":
+
+    import time
+    import tempfile
+    import argparse
+    from transformers import AutoConfig, AutoModelForSequenceClassification
+    from .optim import create_optimizer
+    from .memory_utils import peak_rss_mb
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--config_name", default="bert-base-cased", type=str,
+                        help="Config of the (randomly initialized) model.")
+    parser.add_argument("--batch_size", default=16, type=int)
+    parser.add_argument("--max_seq_length", default=128, type=int)
+    parser.add_argument("--num_steps", default=3, type=int)
+    parser.add_argument("--peft_mode", default="full", type=str,
+                        choices=["full", "lora", "adapter"])
+    parser.add_argument("--lora_r", default=8, type=int)
+    parser.add_argument("--lora_alpha", default=16, type=int)
+    parser.add_argument("--lora_dropout", default=0.0, type=float)
+    parser.add_argument("--adapter_size", default=64, type=int)
+    bench_args = parser.parse_args()
+    bench_args.optimizer = "adamw_fused"
+    bench_args.learning_rate = 1e-4
+    bench_args.adam_epsilon = 1e-8
+    bench_args.weight_decay = 0.0
+
+    # Run one mode per process, so that the peak RSS is its own.
+    config = AutoConfig.from_pretrained(bench_args.config_name)
+    model = AutoModelForSequenceClassification.from_config(config)
+    if bench_args.peft_mode != "full":
+        apply_adapters(model, adapter_config_from_args(bench_args, model))
+    optimizer = create_optimizer(bench_args, model)
+
+    input_ids = torch.randint(1000, (bench_args.batch_size,
+                                     bench_args.max_seq_length))
+    labels = torch.randint(2, (bench_args.batch_size,))
+    model.train()
+    step_times = []
+    for _ in range(bench_args.num_steps + 1):
+        start = time.time()
+        loss = model(input_ids, labels=labels)[0]
+        loss.backward()
+        optimizer.step()
+        model.zero_grad()
+        step_times.append(time.time() - start)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        if bench_args.peft_mode == "full":
+            torch.save(model.state_dict(),
+                       os.path.join(tmp_dir, "pytorch_model.bin"))
+        else:
+            save_adapters(model, tmp_dir)
+        torch.save(optimizer.state_dict(), os.path.join(tmp_dir,
+                                                        "optimizer.pt"))
+        sizes = {name: os.path.getsize(os.path.join(tmp_dir, name))
+                 for name in os.listdir(tmp_dir)}
+
+    num_trainable = sum(p.numel() for p in model.parameters()
+                        if p.requires_grad)
+    print("{}: {:.2f}M trainable parameters, {:.0f} ms/step, peak RSS "
+          "{:.0f} MB, checkpoint {:.1f} MB ({})".format(
+              bench_args.peft_mode, num_trainable / 1e6,
+              1000 * sum(step_times[1:]) / bench_args.num_steps,
+              peak_rss_mb(), sum(sizes.values()) / 2 ** 20,
+              ", ".join("{} {:.1f} MB".format(name, size / 2 ** 20)
+                        for name, size in sorted(sizes.items()))))
@@ -1,7 +1,7 @@
 import argparse
 
 
-def get_args():
+def get_parser():
     parser = argparse.ArgumentParser()
 
     # Basic args.
@@ -28,6 +28,13 @@ def get_args():
         required=False,
         help=("The output root directory."),
     )
+    parser.add_argument(
+        "--results_db",
+        default=None,
+        type=str,
+        help="SQLite database of runs, checkpoints and evaluation results, "
+             "defaults to `output_root/results.sqlite`.",
+    )
     parser.add_argument(
         "--task_name",
         default=None,
@@ -110,6 +117,109 @@ def get_args():
         help=("Pretrained tokenizer name or path "
               "if not the same as model_name"),
     )
+    parser.add_argument(
+        "--feature_cache_dir",
+        default=None,
+        type=str,
+        help=("If set, tokenized features are cached in this directory and "
+              "shared across runs using the same tokenizer."),
+    )
+    parser.add_argument(
+        "--cpu_threads",
+        default=0,
+        type=int,
+        help=("PyTorch intra-op threads. By default one per CPU of the "
+              "process when it is pinned (--numa_node, "
+              "--dataloader_workers), else PyTorch's default."),
+    )
+    parser.add_argument(
+        "--cpu_interop_threads",
+        default=0,
+        type=int,
+        help="PyTorch inter-op threads, 0 keeps PyTorch's default.",
+    )
+    parser.add_argument(
+        "--dataloader_workers",
+        default=0,
+        type=int,
+        help=("DataLoader worker processes tokenizing the batches, each "
+              "pinned to a CPU taken from the PyTorch threads when there "
+              "are enough (Linux only)."),
+    )
+    parser.add_argument(
+        "--tokenizers_parallelism",
+        default="auto",
+        choices=["auto", "true", "false"],
+        help=("Thread pool of the fast tokenizers. auto turns it off with "
+              "--dataloader_workers and otherwise leaves "
+              "TOKENIZERS_PARALLELISM as it is."),
+    )
+    parser.add_argument(
+        "--numa_node",
+        default=None,
+        type=str,
+        help=("Pins the process to the CPUs of this NUMA node, or with "
+              "auto to node local_rank modulo the number of nodes (one "
+              "node per process of a multi-process run). Linux only."),
+    )
+    parser.add_argument(
+        "--attn_implementation",
+        default="default",
+        choices=["default", "sdpa", "eager"],
+        help=("Attention of the model: PyTorch scaled_dot_product_attention "
+              "(sdpa), the explicit implementation (eager), or what "
+              "transformers picks. Models without the requested one keep "
+              "the default."),
+    )
+    parser.add_argument(
+        "--compile_model",
+        action="store_true",
+        help=("Runs the model through torch.compile, warmed up on "
+              "--compile_buckets sequence lengths before training, with the "
+              "batches trimmed to the shortest bucket holding them."),
+    )
+    parser.add_argument(
+        "--compile_buckets",
+        default=None,
+        type=int,
+        nargs="+",
+        help=("Sequence lengths of --compile_model, defaults to "
+              "--max_seq_length and its two halves."),
+    )
+    parser.add_argument(
+        "--auto_max_seq_length",
+        action="store_true",
+        help=("Sets --max_seq_length from the token lengths of "
+              "--max_seq_length_split, to cover --max_seq_length_quantile "
+              "of its inputs (lengths come from the feature cache when "
+              "--feature_cache_dir is set)."),
+    )
+    parser.add_argument(
+        "--max_seq_length_quantile",
+        default=0.999,
+        type=float,
+        help="Quantile of the input lengths --auto_max_seq_length covers.",
+    )
+    parser.add_argument(
+        "--max_seq_length_split",
+        default="train",
+        type=str,
+        help="Split whose lengths --auto_max_seq_length scans.",
+    )
+    parser.add_argument(
+        "--tokenization_workers",
+        default=1,
+        type=int,
+        help=("Processes tokenizing a split into the feature cache (with "
+              "--feature_cache_dir), in shards written to memory-mapped "
+              "files."),
+    )
+    parser.add_argument(
+        "--compact_examples",
+        action="store_true",
+        help=("Stores the examples of a split column by column, with "
+              "categorical fields as codes, instead of one object each."),
+    )
     parser.add_argument(
         "--max_seq_length",
         default=128,
@@ -118,6 +228,28 @@ def get_args():
               "Sequences longer than this will be truncated, sequences "
               "shorter will be padded."),
     )
+    parser.add_argument(
+        "--dedupe_train", action="store_true",
+        help="Drop near-duplicate training pairs (MinHash/LSH over character "
+             "shingles) before caching features, see "
+             "data_processing/near_duplicates.py."
+    )
+    parser.add_argument("--dedupe_threshold", default=0.9, type=float,
+                        help="Jaccard similarity of near-duplicates.")
+    parser.add_argument(
+        "--dedupe_against", default=[], type=str, nargs="*",
+        choices=["dev", "test"],
+        help="Also drop training pairs near-duplicating these splits."
+    )
+    parser.add_argument(
+        "--pack_sequences", action="store_true",
+        help="Pack several examples into each `max_seq_length` row with "
+             "block-diagonal attention (bert, roberta and deberta models)."
+    )
+    parser.add_argument(
+        "--max_segments_per_row", default=16, type=int,
+        help="Maximum number of examples packed into one row."
+    )
     parser.add_argument("--do_train", action="store_true",
                         help="Whether to run training.")
     parser.add_argument("--do_eval", action="store_true",
@@ -127,7 +259,38 @@ def get_args():
         help="Rul evaluation during training at each logging step."
     )
     parser.add_argument(
-        "--do_lower_case", action="store_true", 
+        "--eval_interval_seconds", default=0.0, type=float,
+        help="If > 0: evaluate during training every X seconds of wall-clock "
+             "time instead of every `logging_steps` updates steps."
+    )
+    parser.add_argument(
+        "--eval_subsample_size", default=0, type=int,
+        help="If > 0: evaluate during training on a fixed stratified "
+             "subsample of this many examples of the eval split."
+    )
+    parser.add_argument(
+        "--full_eval_every", default=10, type=int,
+        help="With `eval_subsample_size`, run a full pass over the eval "
+             "split every X evaluations (at least 1)."
+    )
+    parser.add_argument(
+        "--early_stopping_patience", default=0, type=int,
+        help="If > 0: stop training after X full evaluations without "
+             "improvement of `early_stopping_metric`."
+    )
+    parser.add_argument(
+        "--early_stopping_metric", default="pairwise_accuracy", type=str,
+        choices=["pairwise_accuracy", "accuracy", "F1_score"],
+        help="Metric watched by early stopping (pairwise accuracy falls back "
+             "to accuracy for tasks without statement pairs)."
+    )
+    parser.add_argument(
+        "--early_stopping_min_delta", default=0.0, type=float,
+        help="Minimum increase of `early_stopping_metric` that counts as an "
+             "improvement."
+    )
+    parser.add_argument(
+        "--do_lower_case", action="store_true",
         help="Set this flag if you are using an uncased model."
     )
 
@@ -144,8 +307,125 @@ def get_args():
         help="Number of updates steps to accumulate before performing "
              "a backward/update pass.",
     )
+    parser.add_argument(
+        "--gradient_checkpointing", action="store_true",
+        help="Recompute activations in the backward pass to save memory."
+    )
+    parser.add_argument(
+        "--auto_batch_size", action="store_true",
+        help="Probe the largest per-device batch size that fits "
+             "`memory_budget_mb` and set `gradient_accumulation_steps` to "
+             "keep the same effective batch size."
+    )
+    parser.add_argument(
+        "--memory_budget_mb", default=0, type=float,
+        help="Memory budget of `auto_batch_size` (peak CPU RSS or device "
+             "memory), defaults to most of the available memory. Required "
+             "for CPU runs off Linux."
+    )
     parser.add_argument("--learning_rate", default=5e-5, type=float,
                         help="The initial learning rate for Adam.")
+    parser.add_argument(
+        "--optimizer",
+        default="adamw_hf",
+        type=str,
+        choices=["adamw_hf", "adamw", "adamw_foreach", "adamw_fused",
+                 "adamw_8bit"],
+        help="AdamW implementation, see trainers/optim.py. The default, "
+             "transformers.AdamW, is the one the baseline scripts were run "
+             "with; the others are torch.optim.AdamW variants.",
+    )
+    parser.add_argument(
+        "--peft_mode",
+        default="none",
+        type=str,
+        choices=["none", "lora", "adapter"],
+        help="Freeze the pretrained model and only train LoRA or bottleneck "
+             "adapter weights plus the classification head, see "
+             "trainers/adapters.py.",
+    )
+    parser.add_argument("--lora_r", default=8, type=int,
+                        help="Rank of the LoRA updates.")
+    parser.add_argument("--lora_alpha", default=16, type=int,
+                        help="LoRA scaling, updates are scaled by alpha / r.")
+    parser.add_argument("--lora_dropout", default=0.0, type=float,
+                        help="Dropout on the inputs of the LoRA updates.")
+    parser.add_argument("--adapter_size", default=64, type=int,
+                        help="Bottleneck size of the adapters.")
+    parser.add_argument(
+        "--linear_probe", action="store_true",
+        help="Run the encoder once per split, cache its [CLS] outputs and "
+             "only train/evaluate the classification head on them."
+    )
+    parser.add_argument(
+        "--embedding_cache_dir", default=None, type=str,
+        help="Where `linear_probe` caches encoder outputs, defaults to "
+             "`feature_cache_dir/embeddings` or `output_dir/embeddings`."
+    )
+    parser.add_argument(
+        "--early_exit",
+        default="none",
+        type=str,
+        choices=["none", "joint", "post"],
+        help="Add classifiers after every intermediate layer, trained along "
+             "with the model (`joint`) or after it on the frozen model "
+             "(`post`), see trainers/early_exit.py.",
+    )
+    parser.add_argument("--early_exit_epochs", default=1, type=int,
+                        help="Epochs of `post` early exit training.")
+    parser.add_argument(
+        "--early_exit_thresholds", default=[0.99, 0.95, 0.9, 0.8, 0.7, 0.6],
+        type=float, nargs="+",
+        help="Confidence thresholds of the evaluated accuracy/latency curve."
+    )
+    parser.add_argument(
+        "--prediction_cache", action="store_true",
+        help="Look up the logits of each evaluated text by checkpoint and "
+             "tokenizer hash, only cache misses run through the model, see "
+             "trainers/prediction_cache.py."
+    )
+    parser.add_argument(
+        "--prediction_cache_db", default=None, type=str,
+        help="The prediction cache file, defaults to "
+             "`output_root/predictions.sqlite`."
+    )
+    parser.add_argument("--prediction_cache_size", default=100000, type=int,
+                        help="Entries of the in-memory LRU of the cache.")
+    parser.add_argument(
+        "--example_stats", action="store_true",
+        help="Track the loss EMA, forgetting count and last-correct step of "
+             "every training example, saved as example_stats.npz (only the "
+             "first process's shard in distributed training)."
+    )
+    parser.add_argument("--example_stats_decay", default=0.9, type=float,
+                        help="Decay of the per-example loss EMA.")
+    parser.add_argument(
+        "--hard_example_sampling", action="store_true",
+        help="After warm-up, sample training examples by their loss EMA "
+             "(implies --example_stats), see trainers/example_stats.py. "
+             "Not available in distributed training."
+    )
+    parser.add_argument("--hard_example_warmup_epochs", default=1, type=int,
+                        help="Epochs of uniform sampling before.")
+    parser.add_argument(
+        "--hard_example_min_weight", default=0.1, type=float,
+        help="Sampling weight floor (relative to the mean loss) of learned "
+             "examples, 0 drops them."
+    )
+    parser.add_argument(
+        "--slice_eval", action="store_true",
+        help="Also compute the metrics of every domain/scenario/numeracy "
+             "slice and their intersections, see trainers/slice_eval.py."
+    )
+    parser.add_argument("--slice_max_order", default=2, type=int,
+                        help="Intersections of up to this many slice fields.")
+    parser.add_argument("--slice_min_size", default=20, type=int,
+                        help="Smallest slice (in examples) to report.")
+    parser.add_argument(
+        "--merge_adapters", action="store_true",
+        help="Fold the LoRA weights into the pretrained weights before "
+             "evaluation."
+    )
     parser.add_argument("--weight_decay", default=0.0, type=float,
                         help="Weight decay if we apply some.")
     parser.add_argument("--adam_epsilon", default=1e-8, type=float,
@@ -202,6 +482,11 @@ def get_args():
         "--no_gene", action="store_true", 
         help="Set this flag if not using the gene and variation information."
     )
-    args = parser.parse_args()
+    return parser
+
+
+def get_args(argv=None):
+    parser = get_parser()
+    args = parser.parse_args(argv)
 
     return args
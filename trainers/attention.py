@@ -0,0 +1,164 @@
+"""Attention implementation of the models: PyTorch's fused
+`scaled_dot_product_attention` ("sdpa") or the explicit matmul-softmax one
+("eager"), with a check that padded batches give the same logits as the
+unpadded examples.
+
+    python3 -m trainers.attention --models bert-base-cased roberta-base \
+        --task_name com2sense --data_dir datasets/com2sense --split dev
+"""
+import time
+import logging
+import argparse
+
+import numpy as np
+import torch
+
+logger = logging.getLogger(__name__)
+
+ATTENTION_IMPLEMENTATIONS = ["default", "sdpa", "eager"]
+
+
+def from_pretrained(auto_class, name_or_path, attn_implementation="default",
+                    **kwargs):
+    """`auto_class.from_pretrained` with the requested attention
+    implementation, or the default one for models without it (e.g. no
+    SDPA for DeBERTa-v2)."""
+    if attn_implementation != "default":
+        try:
+            return auto_class.from_pretrained(
+                name_or_path, attn_implementation=attn_implementation,
+                **kwargs)
+        except ValueError as e:
+            logger.warning("%s, using the default attention.", e)
+    return auto_class.from_pretrained(name_or_path, **kwargs)
+
+
+def attention_implementation(model):
+    return getattr(model.config, "_attn_implementation", None) or "eager"
+
+
+@torch.no_grad()
+def padding_mask_error(model, dataset, num_examples=16):
+    """Largest absolute logit difference between the examples of `dataset`
+    run as one padded batch (with its attention mask) and each one alone,
+    without padding. Close to zero when the padding is masked out."""
+    num_examples = min(num_examples, len(dataset))
+    items = [dataset[i] for i in range(num_examples)]
+    input_ids = torch.stack([item[0] for item in items])
+    attention_mask = torch.stack([item[1] for item in items])
+    device = next(model.parameters()).device
+    was_training = model.training
+    model.eval()
+    batched = model(input_ids=input_ids.to(device),
+                    attention_mask=attention_mask.to(device))[0]
+    error = 0.0
+    for i in range(num_examples):
+        length = int(attention_mask[i].sum())
+        alone = model(input_ids=input_ids[i:i + 1, :length].to(device),
+                      attention_mask=attention_mask[i:i + 1, :length]
+                      .to(device))[0]
+        error = max(error, float((batched[i] - alone[0]).abs().max()))
+    model.train(was_training)
+    return error
+
+
+def check_padding_mask(model, dataset, atol=1e-4):
+    """Logs the padding error of `model` on the first examples of
+    `dataset`, warns when it is above `atol`."""
+    error = padding_mask_error(model, dataset)
+    implementation = attention_implementation(model)
+    if error > atol:
+        logger.warning("Padded and unpadded logits differ by %.2e with %s "
+                       "attention, the padding is not masked out.", error,
+                       implementation)
+    else:
+        logger.info("Padding mask check with %s attention: max logit "
+                    "difference %.2e", implementation, error)
+    return error
+
+
+def step_milliseconds(model, input_ids, attention_mask, labels, backward,
+                      steps=10):
+    """Median time of a forward (in eval mode), or of a forward and
+    backward (in train mode), on one batch."""
+    model.train(backward)
+    times = []
+    for _ in range(steps + 1):
+        start = time.perf_counter()
+        if backward:
+            model(input_ids=input_ids, attention_mask=attention_mask,
+                  labels=labels)[0].backward()
+            model.zero_grad(set_to_none=True)
+        else:
+            with torch.no_grad():
+                model(input_ids=input_ids, attention_mask=attention_mask)
+        times.append(time.perf_counter() - start)
+    return 1000 * float(np.median(times[1:]))
+
+
+if __name__ == "__main__":
+
+    import json
+    from transformers import AutoModelForSequenceClassification, \
+        AutoTokenizer
+    from data_processing import data_processors, data_classes
+    from .seq_length import example_lengths, quantile_length, \
+        choose_max_seq_length
+
+    parser = argparse.ArgumentParser(
+        description="Padding check and CPU step times of the attention "
+                    "implementations, at the token lengths of a split.")
+    parser.add_argument("--models", required=True, nargs="+")
+    parser.add_argument("--task_name", default="com2sense", type=str)
+    parser.add_argument("--data_dir", default="datasets/com2sense", type=str)
+    parser.add_argument("--split", default="dev", type=str)
+    parser.add_argument("--quantiles", default=[0.5, 0.95, 0.999],
+                        type=float, nargs="+",
+                        help="Batches are padded to these length quantiles "
+                             "(the last one rounded up as by "
+                             "--auto_max_seq_length).")
+    parser.add_argument("--batch_size", default=16, type=int)
+    parser.add_argument("--steps", default=10, type=int)
+    cli_args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    torch.manual_seed(0)
+    processor = data_processors[cli_args.task_name](
+        data_dir=cli_args.data_dir, fields=["guid", "text", "label"])
+    examples = processor._read_data(split=cli_args.split)
+    dataset_args = argparse.Namespace(do_train=True)
+
+    report = []
+    for name in cli_args.models:
+        tokenizer = AutoTokenizer.from_pretrained(name)
+        lengths = example_lengths(examples, tokenizer)
+        seq_lengths = [quantile_length(lengths, q)
+                       for q in cli_args.quantiles[:-1]]
+        seq_lengths.append(choose_max_seq_length(lengths,
+                                                 cli_args.quantiles[-1]))
+        for implementation in ["eager", "sdpa"]:
+            model = from_pretrained(AutoModelForSequenceClassification, name,
+                                    implementation)
+            if attention_implementation(model) != implementation:
+                continue
+            for seq_length in seq_lengths:
+                dataset = data_classes[cli_args.task_name](
+                    examples, tokenizer, max_seq_length=seq_length,
+                    args=dataset_args)
+                # The first examples of the split, with their real padding.
+                batch = [dataset[i] for i in range(cli_args.batch_size)]
+                input_ids = torch.stack([item[0] for item in batch])
+                attention_mask = torch.stack([item[1] for item in batch])
+                labels = torch.stack([item[3] for item in batch])
+                report.append({
+                    "model": name, "attention": implementation,
+                    "seq_length": seq_length,
+                    "padding_error": padding_mask_error(model, dataset),
+                    "forward_ms": round(step_milliseconds(
+                        model, input_ids, attention_mask, labels, False,
+                        cli_args.steps), 2),
+                    "forward_backward_ms": round(step_milliseconds(
+                        model, input_ids, attention_mask, labels, True,
+                        cli_args.steps), 2),
+                })
+    print(json.dumps(report, indent=2))
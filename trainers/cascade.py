@@ -0,0 +1,238 @@
+"""Two-model cascade: a fast model (e.g. distilbert) scores every example
+and only those it is unsure about are escalated to a large model (e.g.
+DeBERTa-v3-base).
+
+The confidence threshold is calibrated on a labeled split: the lowest
+escalation rate whose cascade accuracy is within `max_accuracy_drop` of the
+large model alone.
+
+With `--prediction_cache_db`, both models read and fill the prediction
+cache of `prediction_cache.py`, so a statement scored before does not run
+through a model again.
+
+    python3 -m trainers.cascade --fast_model outputs/distilbert/checkpoint-4000 \
+        --large_model outputs/deberta/checkpoint-5000 \
+        --task_name com2sense --data_dir datasets/com2sense \
+        --calibration_split dev --eval_split test --batch_size 8
+"""
+import time
+import json
+import logging
+import argparse
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+from .prediction_cache import cache_namespace, cache_lookup, cache_store
+
+logger = logging.getLogger(__name__)
+
+
+class Cascade(object):
+    """Routes batches of texts through the fast model, re-batching the
+    examples with a confidence (max class probability) under `threshold`
+    for the large model. Counts the escalations. With a `cache` (a
+    `PredictionCache`), each model only runs on the texts it has no cached
+    logits for."""
+
+    def __init__(self, fast_model, fast_tokenizer, large_model,
+                 large_tokenizer, threshold, max_seq_length=128,
+                 device=torch.device("cpu"), cache=None):
+        self.fast_model = fast_model.to(device).eval()
+        self.fast_tokenizer = fast_tokenizer
+        self.large_model = large_model.to(device).eval()
+        self.large_tokenizer = large_tokenizer
+        self.threshold = threshold
+        self.max_seq_length = max_seq_length
+        self.device = device
+        self.num_examples = 0
+        self.num_escalated = 0
+        self.cache = cache
+        self.namespaces = {}
+        if cache is not None:
+            for model, tokenizer in [(fast_model, fast_tokenizer),
+                                     (large_model, large_tokenizer)]:
+                self.namespaces[id(model)] = cache_namespace(
+                    model, tokenizer, max_seq_length)
+
+    @torch.no_grad()
+    def _logits(self, model, tokenizer, texts):
+        encoding = tokenizer(texts, padding=True, truncation=True,
+                             max_length=self.max_seq_length,
+                             return_tensors="pt")
+        logits = model(input_ids=encoding["input_ids"].to(self.device),
+                       attention_mask=encoding["attention_mask"]
+                       .to(self.device))[0]
+        return logits.float().cpu().numpy()
+
+    def _probs(self, model, tokenizer, texts):
+        if self.cache is None:
+            logits = self._logits(model, tokenizer, texts)
+        else:
+            namespace = self.namespaces[id(model)]
+            keys, cached, to_run = cache_lookup(self.cache, namespace, texts)
+            new_logits = self._logits(
+                model, tokenizer, [texts[i] for i in to_run]) \
+                if to_run else None
+            logits = cache_store(self.cache, namespace, keys, cached, to_run,
+                                 new_logits)
+        return F.softmax(torch.from_numpy(logits), dim=-1).numpy()
+
+    def fast_probs(self, texts):
+        return self._probs(self.fast_model, self.fast_tokenizer, texts)
+
+    def large_probs(self, texts):
+        return self._probs(self.large_model, self.large_tokenizer, texts)
+
+    def predict(self, texts):
+        """Class probabilities of `texts` and which were escalated."""
+        probs = self.fast_probs(texts)
+        escalated = probs.max(axis=-1) < self.threshold
+        if escalated.any():
+            probs[escalated] = self.large_probs(
+                [text for text, up in zip(texts, escalated) if up])
+        self.num_examples += len(texts)
+        self.num_escalated += int(escalated.sum())
+        return probs, escalated
+
+    @property
+    def escalation_rate(self):
+        return self.num_escalated / float(max(1, self.num_examples))
+
+
+def calibrate_threshold(fast_probs, large_probs, labels,
+                        max_accuracy_drop=0.0):
+    """The threshold escalating the fewest examples whose cascade accuracy
+    is at least the large model's minus `max_accuracy_drop`.
+
+    Escalating the `k` least confident examples gives an accuracy of
+    `(large correct among them + fast correct among the rest) / n`, computed
+    for every `k` at once with cumulative sums.
+
+    Returns `(threshold, escalation_rate, cascade_accuracy)`.
+    """
+    confidence = fast_probs.max(axis=-1)
+    order = np.argsort(confidence, kind="stable")
+    confidence = confidence[order]
+    fast_correct = (fast_probs.argmax(axis=-1) == labels)[order]
+    large_correct = (large_probs.argmax(axis=-1) == labels)[order]
+
+    n = len(labels)
+    escalated_correct = np.concatenate([[0], np.cumsum(large_correct)])
+    kept_correct = np.concatenate(
+        [[0], np.cumsum(fast_correct[::-1])])[::-1]
+    accuracy = (escalated_correct + kept_correct) / float(n)
+
+    target = large_correct.mean() - max_accuracy_drop
+    # Thresholds must fall between distinct confidences.
+    valid = np.ones(n + 1, dtype=bool)
+    valid[1:n] = confidence[1:] > confidence[:-1]
+    k = int(np.flatnonzero(valid & (accuracy >= target - 1e-12))[0])
+    if k == 0:
+        threshold = 0.0
+    elif k == n:
+        threshold = np.nextafter(1.0, 2.0)
+    else:
+        threshold = float(confidence[k - 1] + confidence[k]) / 2
+    return threshold, k / float(n), float(accuracy[k])
+
+
+def batched(items, batch_size):
+    for start in range(0, len(items), batch_size):
+        yield items[start:start + batch_size]
+
+
+def timed_predictions(predict, texts, batch_size):
+    """Probabilities of `texts` and the latency of every batch."""
+    probs, latencies = [], []
+    for batch in batched(texts, batch_size):
+        start = time.perf_counter()
+        probs.append(predict(batch))
+        latencies.append(time.perf_counter() - start)
+    return np.concatenate(probs), np.array(latencies)
+
+
+if __name__ == "__main__":
+
+    from transformers import AutoModelForSequenceClassification, \
+        AutoTokenizer
+    from data_processing import data_processors
+    from .prediction_cache import PredictionCache
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--fast_model", required=True, type=str)
+    parser.add_argument("--large_model", required=True, type=str)
+    parser.add_argument("--task_name", default="com2sense", type=str)
+    parser.add_argument("--data_dir", default="datasets/com2sense", type=str)
+    parser.add_argument("--calibration_split", default="dev", type=str)
+    parser.add_argument("--eval_split", default="test", type=str)
+    parser.add_argument("--threshold", default=None, type=float,
+                        help="Skips the calibration.")
+    parser.add_argument("--max_accuracy_drop", default=0.0, type=float)
+    parser.add_argument("--max_seq_length", default=128, type=int)
+    parser.add_argument("--batch_size", default=8, type=int,
+                        help="Requests of the latency benchmark.")
+    parser.add_argument("--prediction_cache_db", default=None, type=str,
+                        help="Prediction cache database (see "
+                             "trainers/prediction_cache.py). The latencies "
+                             "then include the cache hits.")
+    parser.add_argument("--no_cuda", action="store_true")
+    cli_args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    device = torch.device("cuda" if torch.cuda.is_available()
+                          and not cli_args.no_cuda else "cpu")
+    cascade = Cascade(
+        AutoModelForSequenceClassification.from_pretrained(
+            cli_args.fast_model),
+        AutoTokenizer.from_pretrained(cli_args.fast_model),
+        AutoModelForSequenceClassification.from_pretrained(
+            cli_args.large_model),
+        AutoTokenizer.from_pretrained(cli_args.large_model),
+        cli_args.threshold, cli_args.max_seq_length, device,
+        None if cli_args.prediction_cache_db is None
+        else PredictionCache(cli_args.prediction_cache_db))
+    processor = data_processors[cli_args.task_name](
+        data_dir=cli_args.data_dir)
+
+    def split_data(split):
+        examples = processor._read_data(split=split)
+        return ([example.text for example in examples],
+                np.array([-1 if example.label is None else example.label
+                          for example in examples]))
+
+    if cascade.threshold is None:
+        texts, labels = split_data(cli_args.calibration_split)
+        fast_probs, _ = timed_predictions(cascade.fast_probs, texts, 64)
+        large_probs, _ = timed_predictions(cascade.large_probs, texts, 64)
+        cascade.threshold, rate, accuracy = calibrate_threshold(
+            fast_probs, large_probs, labels, cli_args.max_accuracy_drop)
+        logger.info("Calibrated threshold %.4f on %s: escalation rate "
+                    "%.3f, cascade accuracy %.4f (large %.4f, fast %.4f)",
+                    cascade.threshold, cli_args.calibration_split, rate,
+                    accuracy, (large_probs.argmax(-1) == labels).mean(),
+                    (fast_probs.argmax(-1) == labels).mean())
+
+    texts, labels = split_data(cli_args.eval_split)
+    has_label = (labels >= 0).all()
+    # Warm-up, the first batches include one-off allocations.
+    for batch in list(batched(texts, cli_args.batch_size))[:2]:
+        cascade.large_probs(batch)
+        cascade.fast_probs(batch)
+
+    report = {"threshold": cascade.threshold,
+              "batch_size": cli_args.batch_size}
+    for name, predict in [("large", cascade.large_probs),
+                          ("cascade", lambda batch: cascade.predict(batch)[0])]:
+        probs, latencies = timed_predictions(predict, texts,
+                                             cli_args.batch_size)
+        report[name] = {
+            "mean_latency_ms": 1000 * float(latencies.mean()),
+            "p99_latency_ms": 1000 * float(np.percentile(latencies, 99)),
+        }
+        if has_label:
+            report[name]["accuracy"] = float(
+                (probs.argmax(axis=-1) == labels).mean())
+    report["cascade"]["escalation_rate"] = cascade.escalation_rate
+    print(json.dumps(report, indent=2))
@@ -0,0 +1,199 @@
+import os
+import json
+import struct
+import logging
+
+import numpy as np
+import torch
+
+logger = logging.getLogger(__name__)
+
+SAFE_WEIGHTS_NAME = "model.safetensors"
+WEIGHTS_NAME = "pytorch_model.bin"
+
+# safetensors dtype names; bfloat16 has no numpy type and is read as int16.
+_SAFETENSORS_DTYPES = {
+    "F64": (np.float64, torch.float64),
+    "F32": (np.float32, torch.float32),
+    "F16": (np.float16, torch.float16),
+    "BF16": (np.int16, torch.bfloat16),
+    "I64": (np.int64, torch.int64),
+    "I32": (np.int32, torch.int32),
+    "I16": (np.int16, torch.int16),
+    "I8": (np.int8, torch.int8),
+    "U8": (np.uint8, torch.uint8),
+    "BOOL": (np.bool_, torch.bool),
+}
+
+
+def checkpoint_weights_file(checkpoint_dir):
+    """The weights file of a checkpoint, safetensors first."""
+    for name in [SAFE_WEIGHTS_NAME, WEIGHTS_NAME]:
+        path = os.path.join(checkpoint_dir, name)
+        if os.path.isfile(path):
+            return path
+    raise FileNotFoundError("No {} or {} in {}".format(
+        SAFE_WEIGHTS_NAME, WEIGHTS_NAME, checkpoint_dir))
+
+
+def mmap_safetensors(path):
+    """A state dict of CPU tensors backed by a copy-on-write memory map of
+    the safetensors file `path`: nothing is read until a tensor is used, and
+    the pages are shared with the page cache instead of copied."""
+    with open(path, "rb") as f:
+        header_len = struct.unpack("<Q", f.read(8))[0]
+        header = json.loads(f.read(header_len))
+    data = np.memmap(path, mode="c", offset=8 + header_len)
+
+    state_dict = {}
+    for name, info in header.items():
+        if name == "__metadata__":
+            continue
+        np_dtype, torch_dtype = _SAFETENSORS_DTYPES[info["dtype"]]
+        start, end = info["data_offsets"]
+        array = data[start:end].view(np_dtype).reshape(info["shape"])
+        tensor = torch.from_numpy(array)
+        if tensor.dtype != torch_dtype:
+            tensor = tensor.view(torch_dtype)
+        state_dict[name] = tensor
+    return state_dict
+
+
+def load_state_dict(path):
+    """Loads a `.safetensors` or `.bin` state dict memory-mapped."""
+    if path.endswith(".safetensors"):
+        return mmap_safetensors(path)
+    return torch.load(path, map_location="cpu", mmap=True, weights_only=True)
+
+
+def load_checkpoint_weights(model, checkpoint_dir):
+    """Loads the weights of a checkpoint into `model`.
+
+    On CPU the parameters are replaced by the memory-mapped tensors (zero
+    copy), on other devices each tensor is copied over once. Either way the
+    full state dict is never materialized next to the model.
+    """
+    state_dict = load_state_dict(checkpoint_weights_file(checkpoint_dir))
+    device = next(model.parameters()).device
+    missing, unexpected = model.load_state_dict(
+        state_dict, strict=False, assign=device.type == "cpu")
+    # safetensors files do not repeat tied weights.
+    model.tie_weights()
+    if unexpected:
+        raise ValueError("Unexpected weights in {}: {}".format(
+            checkpoint_dir, unexpected))
+    if missing:
+        logger.warning("Weights missing from %s: %s", checkpoint_dir, missing)
+    return model
+
+
+def convert_to_safetensors(checkpoint_path, remove_bin=False):
+    """Writes `model.safetensors` next to a `pytorch_model.bin` checkpoint
+    (a file or its directory)."""
+    from safetensors.torch import save_file
+
+    if os.path.isdir(checkpoint_path):
+        checkpoint_path = os.path.join(checkpoint_path, WEIGHTS_NAME)
+    output_path = os.path.join(os.path.dirname(checkpoint_path),
+                               SAFE_WEIGHTS_NAME)
+    state_dict = torch.load(checkpoint_path, map_location="cpu",
+                            weights_only=True)
+    # safetensors does not store tensors sharing memory more than once.
+    seen, tensors = set(), {}
+    for name, tensor in state_dict.items():
+        key = (tensor.data_ptr(), tensor.numel())
+        tensors[name] = tensor.clone() if key in seen else tensor.contiguous()
+        seen.add(key)
+    save_file(tensors, output_path, metadata={"format": "pt"})
+    logger.info("Converted %s to %s", checkpoint_path, output_path)
+    if remove_bin:
+        os.remove(checkpoint_path)
+    return output_path
+
+
+def _benchmark_load(method, config_name, checkpoint_dir):
+    """Loads a checkpoint into a freshly built model with `method`, returns
+    `(seconds, extra peak RSS in MB)`."""
+    import time
+    from transformers import AutoConfig, AutoModelForSequenceClassification
+    from .memory_utils import peak_rss_mb
+
+    config = AutoConfig.from_pretrained(config_name)
+    model = AutoModelForSequenceClassification.from_config(config)
+    base_rss = peak_rss_mb()
+
+    start = time.time()
+    if method == "torch.load":
+        path = os.path.join(checkpoint_dir, WEIGHTS_NAME)
+        model.load_state_dict(torch.load(path, map_location="cpu"))
+    elif method == "torch.load-mmap":
+        path = os.path.join(checkpoint_dir, WEIGHTS_NAME)
+        model.load_state_dict(load_state_dict(path), assign=True)
+    else:
+        load_checkpoint_weights(model, checkpoint_dir)
+    # Touches every weight, as the first forward pass would.
+    checksum = sum(float(p.float().sum()) for p in model.parameters())
+    seconds = time.time() - start
+    assert np.isfinite(checksum)
+    return seconds, peak_rss_mb() - base_rss
+
+
+if __name__ == "__main__":
+
+    import sys
+    import argparse
+    import subprocess
+    import tempfile
+
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    convert_parser = subparsers.add_parser(
+        "convert", help="Convert pytorch_model.bin checkpoints to safetensors.")
+    convert_parser.add_argument("checkpoints", nargs="+",
+                                help="Checkpoint directories or .bin files.")
+    convert_parser.add_argument("--remove_bin", action="store_true")
+    bench_parser = subparsers.add_parser(
+        "benchmark", help="Load time and peak memory of the load methods.")
+    bench_parser.add_argument("--config_name", default="bert-base-cased",
+                              type=str)
+    bench_parser.add_argument("--checkpoint_dir", default=None, type=str,
+                              help="Internal: the checkpoint to load.")
+    bench_parser.add_argument("--method", default=None, type=str,
+                              choices=["torch.load", "torch.load-mmap",
+                                       "safetensors-mmap"],
+                              help="Internal: run a single method.")
+    cli_args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    if cli_args.command == "convert":
+        for checkpoint in cli_args.checkpoints:
+            convert_to_safetensors(checkpoint, cli_args.remove_bin)
+        sys.exit(0)
+
+    if cli_args.method is not None:
+        seconds, extra_rss = _benchmark_load(
+            cli_args.method, cli_args.config_name, cli_args.checkpoint_dir)
+        print(json.dumps({"seconds": seconds, "extra_rss_mb": extra_rss}))
+        sys.exit(0)
+
+    # Writes a random checkpoint in both formats, then loads it with each
+    # method in its own process so that the peak RSS is its own.
+    from transformers import AutoConfig, AutoModelForSequenceClassification
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        config = AutoConfig.from_pretrained(cli_args.config_name)
+        model = AutoModelForSequenceClassification.from_config(config)
+        torch.save(model.state_dict(), os.path.join(tmp_dir, WEIGHTS_NAME))
+        del model
+        convert_to_safetensors(tmp_dir)
+        for name in [WEIGHTS_NAME, SAFE_WEIGHTS_NAME]:
+            print("{}: {:.1f} MB".format(name, os.path.getsize(
+                os.path.join(tmp_dir, name)) / 2 ** 20))
+
+        for method in ["torch.load", "torch.load-mmap", "safetensors-mmap"]:
+            output = subprocess.check_output(
+                [sys.executable, "-m", "trainers.checkpoints", "benchmark",
+                 "--config_name", cli_args.config_name, "--checkpoint_dir",
+                 tmp_dir, "--method", method], stderr=subprocess.DEVNULL)
+            result = json.loads(output.decode().strip().splitlines()[-1])
+            print("{:>17}: {:6.3f}s, +{:6.1f} MB peak RSS".format(
+                method, result["seconds"], result["extra_rss_mb"]))
@@ -0,0 +1,170 @@
+import time
+import logging
+
+import torch
+
+logger = logging.getLogger(__name__)
+
+# Model types `--compile_model` compiles, the others run eagerly.
+COMPILE_MODEL_TYPES = ["bert", "roberta", "deberta-v2", "distilbert"]
+
+
+def sequence_buckets(max_seq_length, num_buckets=3):
+    """`max_seq_length` and its halves (multiples of 8), shortest first,
+    e.g. `[32, 64, 128]`."""
+    buckets = [max_seq_length]
+    while len(buckets) < num_buckets and buckets[0] // 2 >= 8:
+        buckets.insert(0, buckets[0] // 2 // 8 * 8)
+    return buckets
+
+
+def trim_batch(batch, buckets):
+    """Cuts the padding columns of the input ids, attention mask and token
+    type ids of a batch down to the shortest bucket holding its longest
+    sequence."""
+    length = int(batch[1].sum(dim=-1).max())
+    bucket = next((b for b in buckets if b >= length), buckets[-1])
+    return tuple(t[..., :bucket] if i < 3 else t
+                 for i, t in enumerate(batch))
+
+
+def _warm_up_inputs(model, batch_size, length, num_choices=None):
+    shape = (batch_size, length) if num_choices is None \
+            else (batch_size, num_choices, length)
+    input_ids = torch.full(shape, model.config.pad_token_id or 0,
+                           dtype=torch.long)
+    attention_mask = torch.ones(shape, dtype=torch.long)
+    labels = torch.zeros(batch_size, dtype=torch.long)
+    device = next(model.parameters()).device
+    return input_ids.to(device), attention_mask.to(device), labels.to(device)
+
+
+def warm_up(model, buckets, training=True, num_choices=None, batch_size=2):
+    """Runs every bucket length through the compiled model, as `train()`
+    and `evaluate()` call it: forward and backward in training mode, and a
+    forward without gradients in evaluation mode. Leaves no gradients and
+    consumes no random numbers."""
+    # Same keyword arguments as the training and evaluation loops.
+    kwargs = {} if model.config.model_type == "distilbert" \
+             else {"token_type_ids": None}
+    was_training = model.training
+    with torch.random.fork_rng(devices=[]):
+        for length in buckets:
+            input_ids, attention_mask, labels = _warm_up_inputs(
+                model, batch_size, length, num_choices)
+            if training:
+                model.train()
+                outputs = model(input_ids, attention_mask=attention_mask,
+                                labels=labels, **kwargs)
+                outputs[0].backward()
+                model.zero_grad(set_to_none=True)
+            model.eval()
+            with torch.no_grad():
+                model(input_ids, attention_mask=attention_mask,
+                      labels=labels, **kwargs)
+    model.train(was_training)
+
+
+def compile_model(model, buckets, training=True, num_choices=None):
+    """Compiles `model.forward` in place (the module, its state dict and
+    `save_pretrained` are unchanged) and warms it up on `buckets`.
+
+    The batch and sequence dimensions are compiled dynamic, so one graph per
+    mode covers every batch size and bucket. After the warm-up, a call that
+    would recompile runs eagerly instead of stalling the run. Model types
+    outside `COMPILE_MODEL_TYPES`, or whose compilation fails, stay eager.
+
+    Returns the warm-up time in seconds, or None when the model stays eager.
+    """
+    model_type = model.config.model_type
+    if model_type not in COMPILE_MODEL_TYPES:
+        logger.warning("Not compiling %s, only %s", model_type,
+                       COMPILE_MODEL_TYPES)
+        return None
+    # HF models set the problem type at their first call with labels, which
+    # would invalidate the first compiled graph.
+    if model.config.problem_type is None and num_choices is None:
+        model.config.problem_type = "regression" \
+            if model.config.num_labels == 1 else "single_label_classification"
+
+    start = time.time()
+    torch.compiler.set_stance("default")
+    model.forward = torch.compile(model.forward, dynamic=True)
+    try:
+        warm_up(model, buckets, training, num_choices)
+    except Exception:
+        logger.warning("Compiling %s failed, running it eagerly.", model_type,
+                       exc_info=True)
+        del model.forward
+        torch._dynamo.reset()
+        return None
+    seconds = time.time() - start
+    torch.compiler.set_stance("eager_on_recompile")
+    logger.info("Compiled %s and warmed up sequence lengths %s in %.1fs",
+                model_type, buckets, seconds)
+    return seconds
+
+
+if __name__ == "__main__":
+
+    import json
+    import argparse
+    from transformers import AutoModelForSequenceClassification
+
+    parser = argparse.ArgumentParser(
+        description="Compile time and steady-state step time of compiled "
+                    "and eager models.")
+    parser.add_argument("--models", required=True, nargs="+",
+                        help="Model directories or names.")
+    parser.add_argument("--max_seq_length", default=128, type=int)
+    parser.add_argument("--batch_size", default=16, type=int)
+    parser.add_argument("--steps", default=20, type=int)
+    cli_args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    buckets = sequence_buckets(cli_args.max_seq_length)
+
+    def step_seconds(model, length, training):
+        input_ids, attention_mask, labels = _warm_up_inputs(
+            model, cli_args.batch_size, length)
+        kwargs = {} if model.config.model_type == "distilbert" \
+                 else {"token_type_ids": None}
+        model.train(training)
+        times = []
+        for _ in range(cli_args.steps + 2):
+            start = time.perf_counter()
+            if training:
+                model(input_ids, attention_mask=attention_mask,
+                      labels=labels, **kwargs)[0].backward()
+                model.zero_grad(set_to_none=True)
+            else:
+                with torch.no_grad():
+                    model(input_ids, attention_mask=attention_mask,
+                          labels=labels, **kwargs)
+            times.append(time.perf_counter() - start)
+        # Median, without the first (allocation) steps.
+        return sorted(times[2:])[len(times[2:]) // 2]
+
+    report = []
+    for name in cli_args.models:
+        model = AutoModelForSequenceClassification.from_pretrained(name)
+        eager = {(training, length): step_seconds(model, length, training)
+                 for training in [True, False] for length in buckets}
+        compile_seconds = compile_model(model, buckets)
+        if compile_seconds is None:
+            continue
+        for (training, length), eager_seconds in eager.items():
+            compiled_seconds = step_seconds(model, length, training)
+            saved = eager_seconds - compiled_seconds
+            report.append({
+                "model": name, "model_type": model.config.model_type,
+                "mode": "train" if training else "eval", "length": length,
+                "compile_seconds": round(compile_seconds, 1),
+                "eager_ms": round(1000 * eager_seconds, 1),
+                "compiled_ms": round(1000 * compiled_seconds, 1),
+                "speedup": round(eager_seconds / compiled_seconds, 3),
+                # Steps before the compile time pays for itself.
+                "break_even_steps": int(compile_seconds / saved)
+                                    if saved > 0 else None,
+            })
+        torch._dynamo.reset()
+    print(json.dumps(report, indent=2))
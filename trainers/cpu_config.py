@@ -0,0 +1,306 @@
+"""CPU execution settings of a run: PyTorch intra- and inter-op threads,
+the tokenizers' thread pool, DataLoader workers pinned to their own CPUs
+and, with several processes per host, one NUMA node per process.
+
+The benchmark sweep trains a model for a few steps in a fresh process per
+configuration and prints the flags of the fastest one:
+
+    python3 -m trainers.cpu_config --model_name_or_path bert-base-cased \
+        --task_name com2sense --data_dir datasets/com2sense
+"""
+import os
+import re
+import glob
+import logging
+import argparse
+import functools
+
+import torch
+
+logger = logging.getLogger(__name__)
+
+# CPU affinity (`--numa_node`, pinned DataLoader workers) needs Linux.
+AFFINITY_SUPPORTED = hasattr(os, "sched_setaffinity")
+
+
+def cpu_flags_given(args):
+    """Whether any CPU execution flag differs from its default."""
+    return bool(args.cpu_threads or args.cpu_interop_threads
+                or args.dataloader_workers or args.numa_node is not None
+                or args.tokenizers_parallelism != "auto")
+
+
+def allowed_cpus():
+    """CPUs this process may run on, all the CPUs off Linux."""
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+
+def parse_cpulist(text):
+    """CPU ids of a kernel cpulist, e.g. "0-3,8" -> [0, 1, 2, 3, 8]."""
+    cpus = []
+    for part in text.strip().split(","):
+        if not part:
+            continue
+        low, _, high = part.partition("-")
+        cpus.extend(range(int(low), int(high or low) + 1))
+    return cpus
+
+
+def numa_nodes():
+    """`{node: cpus}` of the host, read from sysfs. A single node with the
+    CPUs this process may run on when the host reports none."""
+    nodes = {}
+    for path in glob.glob("/sys/devices/system/node/node[0-9]*/cpulist"):
+        with open(path) as f:
+            cpus = parse_cpulist(f.read())
+        if cpus:
+            nodes[int(re.search(r"node(\d+)", path).group(1))] = cpus
+    return nodes or {0: allowed_cpus()}
+
+
+def local_rank(args):
+    if args.local_rank != -1:
+        return args.local_rank
+    return int(os.environ.get("LOCAL_RANK", 0))
+
+
+def process_cpus(args):
+    """CPUs of this process and its NUMA node: the node picked by
+    `--numa_node` ("auto": the local rank modulo the number of nodes), or
+    every CPU the process may run on (node None)."""
+    allowed = set(allowed_cpus())
+    if args.numa_node is None:
+        return sorted(allowed), None
+    if not AFFINITY_SUPPORTED:
+        raise ValueError("--numa_node pins the process to CPUs, which needs "
+                         "Linux (os.sched_setaffinity).")
+    nodes = numa_nodes()
+    if args.numa_node == "auto":
+        node = sorted(nodes)[local_rank(args) % len(nodes)]
+    else:
+        node = int(args.numa_node)
+    if node not in nodes:
+        raise ValueError("No NUMA node {}, the host has {}".format(
+            node, sorted(nodes)))
+    cpus = sorted(allowed & set(nodes[node]))
+    if not cpus:
+        raise ValueError("This process may not run on NUMA node {}".format(
+            node))
+    return cpus, node
+
+
+def split_cpus(cpus, num_workers):
+    """`(compute_cpus, worker_cpus)`: the last `num_workers` CPUs go to the
+    DataLoader workers, one each, and the rest to the PyTorch threads. With
+    too few CPUs, the workers share all of them with the threads."""
+    if num_workers == 0:
+        return cpus, []
+    if len(cpus) > num_workers:
+        return cpus[:-num_workers], [[cpu] for cpu in cpus[-num_workers:]]
+    return cpus, [cpus] * num_workers
+
+
+def _init_dataloader_worker(worker_cpus, worker_id):
+    os.sched_setaffinity(0, worker_cpus[worker_id])
+    # Workers only tokenize and collate.
+    torch.set_num_threads(1)
+
+
+def dataloader_kwargs(args):
+    """`num_workers` and `worker_init_fn` of the training and evaluation
+    DataLoaders, after `configure_cpu_execution`."""
+    if not args.dataloader_workers:
+        return {}
+    return {"num_workers": args.dataloader_workers,
+            "worker_init_fn": functools.partial(_init_dataloader_worker,
+                                                args.worker_cpus)}
+
+
+def configure_cpu_execution(args):
+    """Applies the CPU flags to this process, before any tokenizer or model
+    is loaded. Sets `args.worker_cpus` and returns a summary of the
+    settings. Thread settings and environment variables without a flag are
+    left as they are.
+
+    * The process is pinned to its NUMA node (`--numa_node`), and to the
+      CPUs left by the DataLoader workers (`--dataloader_workers`).
+    * PyTorch runs `--cpu_threads` intra-op threads, one per pinned CPU by
+      default, and `--cpu_interop_threads` inter-op threads.
+    * The tokenizers' own thread pool (`--tokenizers_parallelism`) is
+      turned off by default when DataLoader workers tokenize, as each
+      forked worker would otherwise start one on the same CPUs.
+    """
+    if args.dataloader_workers and not AFFINITY_SUPPORTED:
+        raise ValueError("--dataloader_workers pins each worker to a CPU, "
+                         "which needs Linux (os.sched_setaffinity).")
+    cpus, node = process_cpus(args)
+    compute_cpus, args.worker_cpus = split_cpus(cpus,
+                                                args.dataloader_workers)
+    pinned = node is not None or len(compute_cpus) < len(cpus)
+    if pinned:
+        os.sched_setaffinity(0, compute_cpus)
+
+    # Without a flag or pinning, PyTorch keeps its default (one thread per
+    # physical core).
+    if args.cpu_threads > 0 or pinned:
+        torch.set_num_threads(args.cpu_threads or len(compute_cpus))
+        # Libraries and processes started from this one.
+        os.environ["OMP_NUM_THREADS"] = str(torch.get_num_threads())
+        os.environ["MKL_NUM_THREADS"] = str(torch.get_num_threads())
+    threads = torch.get_num_threads()
+    if args.cpu_interop_threads > 0:
+        try:
+            torch.set_num_interop_threads(args.cpu_interop_threads)
+        except RuntimeError:
+            logger.warning("Inter-op threads already started, keeping %d.",
+                           torch.get_num_interop_threads())
+
+    parallelism = args.tokenizers_parallelism
+    if parallelism == "auto" and args.dataloader_workers:
+        parallelism = "false"
+    if parallelism != "auto":
+        os.environ["TOKENIZERS_PARALLELISM"] = parallelism
+    else:
+        parallelism = os.environ.get("TOKENIZERS_PARALLELISM", "unset")
+
+    summary = {
+        "numa_node": node,
+        "cpus": compute_cpus,
+        "threads": threads,
+        "interop_threads": torch.get_num_interop_threads(),
+        "dataloader_workers": args.dataloader_workers,
+        "worker_cpus": args.worker_cpus,
+        "tokenizers_parallelism": parallelism,
+    }
+    logger.info("CPU execution: %s", summary)
+    return summary
+
+
+def candidate_configs(num_cpus, num_nodes, max_workers=2):
+    """Flag sets of the sweep: powers of two (and all) intra-op threads,
+    one or two inter-op threads, 0 to `max_workers` DataLoader workers,
+    and pinning to one NUMA node on multi-node hosts."""
+    threads = sorted({t for t in [1, 2, 4, 8, 16, 32, 64, num_cpus]
+                      if t <= num_cpus})
+    configs = []
+    for numa_node in [None, 0] if num_nodes > 1 else [None]:
+        for workers in range(min(max_workers, num_cpus - 1) + 1):
+            for thread_count in threads:
+                if thread_count + workers > num_cpus:
+                    continue
+                for interop in [1, 2]:
+                    config = ["--cpu_threads", str(thread_count),
+                              "--cpu_interop_threads", str(interop),
+                              "--dataloader_workers", str(workers)]
+                    if numa_node is not None:
+                        config += ["--numa_node", str(numa_node)]
+                    configs.append(config)
+    return configs
+
+
+def add_cpu_arguments(parser):
+    """The CPU flags of `trainers.args`, for the sweep."""
+    parser.add_argument("--cpu_threads", default=0, type=int)
+    parser.add_argument("--cpu_interop_threads", default=0, type=int)
+    parser.add_argument("--dataloader_workers", default=0, type=int)
+    parser.add_argument("--tokenizers_parallelism", default="auto",
+                        choices=["auto", "true", "false"])
+    parser.add_argument("--numa_node", default=None, type=str)
+    parser.add_argument("--local_rank", default=-1, type=int)
+
+
+def measure_throughput(cli_args):
+    """Training examples per second of the configuration in `cli_args`,
+    over `--steps` optimizer steps after two warm-up steps."""
+    import time
+    from torch.utils.data import DataLoader, RandomSampler
+    from transformers import AutoModelForSequenceClassification, \
+        AutoTokenizer
+    from data_processing import data_processors, data_classes
+
+    configure_cpu_execution(cli_args)
+    torch.manual_seed(0)
+    tokenizer = AutoTokenizer.from_pretrained(cli_args.model_name_or_path)
+    model = AutoModelForSequenceClassification.from_pretrained(
+        cli_args.model_name_or_path)
+    processor = data_processors[cli_args.task_name](
+        data_dir=cli_args.data_dir, fields=["guid", "text", "label"])
+    dataset = data_classes[cli_args.task_name](
+        processor._read_data(split="train"), tokenizer,
+        max_seq_length=cli_args.max_seq_length,
+        args=argparse.Namespace(do_train=True))
+    dataloader = DataLoader(dataset, sampler=RandomSampler(dataset),
+                            batch_size=cli_args.batch_size,
+                            **dataloader_kwargs(cli_args))
+    optimizer = torch.optim.AdamW(model.parameters(), lr=1e-5)
+    model.train()
+    kwargs = {} if model.config.model_type == "distilbert" \
+             else {"token_type_ids": None}
+
+    start = None
+    batches = iter(dataloader)
+    for step in range(cli_args.steps + 2):
+        if step == 2:
+            start = time.perf_counter()
+        batch = next(batches)
+        model(batch[0], attention_mask=batch[1], labels=batch[3],
+              **kwargs)[0].backward()
+        optimizer.step()
+        optimizer.zero_grad(set_to_none=True)
+    return cli_args.steps * cli_args.batch_size \
+           / (time.perf_counter() - start)
+
+
+if __name__ == "__main__":
+
+    import sys
+    import json
+    import subprocess
+
+    parser = argparse.ArgumentParser(
+        description="Training throughput of CPU execution settings, each "
+                    "measured in a fresh process.")
+    parser.add_argument("--model_name_or_path", default="bert-base-cased",
+                        type=str)
+    parser.add_argument("--task_name", default="com2sense", type=str)
+    parser.add_argument("--data_dir", default="datasets/com2sense", type=str)
+    parser.add_argument("--max_seq_length", default=64, type=int)
+    parser.add_argument("--batch_size", default=16, type=int)
+    parser.add_argument("--steps", default=10, type=int)
+    parser.add_argument("--max_workers", default=2, type=int)
+    parser.add_argument("--measure", action="store_true",
+                        help="Measures the given flags only (used by the "
+                             "sweep).")
+    add_cpu_arguments(parser)
+    cli_args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+
+    if cli_args.measure:
+        print(json.dumps({"examples_per_second":
+                          measure_throughput(cli_args)}))
+        sys.exit(0)
+
+    common = ["--model_name_or_path", cli_args.model_name_or_path,
+              "--task_name", cli_args.task_name,
+              "--data_dir", cli_args.data_dir,
+              "--max_seq_length", str(cli_args.max_seq_length),
+              "--batch_size", str(cli_args.batch_size),
+              "--steps", str(cli_args.steps)]
+    report = []
+    # Off Linux, nothing can be pinned: threads only.
+    max_workers = cli_args.max_workers if AFFINITY_SUPPORTED else 0
+    num_nodes = len(numa_nodes()) if AFFINITY_SUPPORTED else 1
+    for config in candidate_configs(len(allowed_cpus()), num_nodes,
+                                    max_workers):
+        output = subprocess.run(
+            [sys.executable, "-m", "trainers.cpu_config", "--measure"]
+            + common + config, check=True, capture_output=True, text=True)
+        result = json.loads(output.stdout.strip().splitlines()[-1])
+        report.append({"flags": " ".join(config),
+                       "examples_per_second":
+                           round(result["examples_per_second"], 2)})
+        print(json.dumps(report[-1]))
+    best = max(report, key=lambda r: r["examples_per_second"])
+    print("Fastest on this host: {}".format(best["flags"]))
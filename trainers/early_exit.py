@@ -0,0 +1,258 @@
+import os
+import json
+import time
+import logging
+
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from torch.utils.data import DataLoader, SequentialSampler, Subset
+from tqdm import tqdm, trange
+from transformers.modeling_attn_mask_utils import \
+    _prepare_4d_attention_mask_for_sdpa
+
+from .model_heads import classification_head_logits
+from .train_utils import pairwise_accuracy
+from .cpu_config import dataloader_kwargs
+
+logger = logging.getLogger(__name__)
+
+EXIT_HEADS_NAME = "early_exit_heads.bin"
+EARLY_EXIT_MODEL_TYPES = ["bert", "roberta", "deberta-v2", "distilbert"]
+
+
+class EarlyExitHeads(nn.Module):
+    """Classifiers on the first-token hidden states after the intermediate
+    layers 1 .. num_layers - 1. The last layer exits through the model's own
+    classification head, so a model without confident intermediate exits
+    predicts exactly as before."""
+
+    def __init__(self, config):
+        super(EarlyExitHeads, self).__init__()
+        self.heads = nn.ModuleList([
+            nn.Sequential(nn.Dropout(config.hidden_dropout_prob
+                                     if hasattr(config, "hidden_dropout_prob")
+                                     else config.dropout),
+                          nn.Linear(config.hidden_size, config.hidden_size),
+                          nn.Tanh(),
+                          nn.Linear(config.hidden_size, config.num_labels))
+            for _ in range(config.num_hidden_layers - 1)])
+
+    def forward(self, layer, cls_hidden):
+        """Logits of the exit after `layer` (1-based)."""
+        return self.heads[layer - 1](cls_hidden)
+
+
+def add_exit_heads(model):
+    """Attaches `EarlyExitHeads` to `model` as `model.early_exit_heads`, so
+    that they are saved, moved and optimized along with it."""
+    if model.config.model_type not in EARLY_EXIT_MODEL_TYPES:
+        raise ValueError("Early exits are not supported for model type {}."
+                         .format(model.config.model_type))
+    model.early_exit_heads = EarlyExitHeads(model.config)
+    return model
+
+
+def save_exit_heads(model, output_dir):
+    torch.save(model.early_exit_heads.state_dict(),
+               os.path.join(output_dir, EXIT_HEADS_NAME))
+
+
+def load_exit_heads(model, checkpoint_dir):
+    """Loads the exit heads of a checkpoint, if it has any."""
+    path = os.path.join(checkpoint_dir, EXIT_HEADS_NAME)
+    if os.path.isfile(path):
+        logger.info("Loading early exit heads from %s", path)
+        model.early_exit_heads.load_state_dict(
+            torch.load(path, map_location="cpu"))
+
+
+def exit_heads_loss(model, hidden_states, labels):
+    """Mean cross entropy of all the intermediate exits, given the
+    `hidden_states` of a forward pass (embeddings first)."""
+    losses = [F.cross_entropy(
+        model.early_exit_heads(layer, hidden_states[layer][:, 0]), labels)
+        for layer in range(1, len(hidden_states) - 1)]
+    return torch.stack(losses).mean()
+
+
+def train_exit_heads(args, model, train_dataset):
+    """Trains the exit heads after the main run, on top of the frozen
+    finetuned model, for `early_exit_epochs` epochs."""
+    train_dataloader = DataLoader(
+        train_dataset, shuffle=True,
+        batch_size=args.per_gpu_train_batch_size * max(1, args.n_gpu),
+        **dataloader_kwargs(args))
+    optimizer = torch.optim.AdamW(model.early_exit_heads.parameters(),
+                                  lr=args.learning_rate,
+                                  eps=args.adam_epsilon)
+    logger.info("***** Training early exit heads *****")
+
+    model.eval()
+    model.early_exit_heads.train()
+    global_step, tr_loss = 0, 0.0
+    for _ in trange(args.early_exit_epochs, desc="Epoch"):
+        for batch in tqdm(train_dataloader, desc="Iteration"):
+            batch = tuple(t.to(args.device) for t in batch)
+            with torch.no_grad():
+                hidden_states = model.base_model(
+                    batch[0], attention_mask=batch[1],
+                    output_hidden_states=True).hidden_states
+            loss = exit_heads_loss(model, hidden_states, batch[3])
+            loss.backward()
+            optimizer.step()
+            optimizer.zero_grad()
+            tr_loss += loss.item()
+            global_step += 1
+    logger.info("  Early exit heads loss = %s", tr_loss / max(1, global_step))
+    return global_step
+
+
+def _embed(model, input_ids, attention_mask):
+    """Embeddings of a batch and the per-example and shared inputs of the
+    encoder layers, as the full encoder computes them."""
+    model_type = model.config.model_type
+    base = model.base_model
+    if model_type in ["bert", "roberta"]:
+        hidden = base.embeddings(input_ids=input_ids)
+        layer_mask = base.get_extended_attention_mask(attention_mask,
+                                                      input_ids.size())
+        return hidden, {"mask": layer_mask}, {}
+    if model_type == "distilbert":
+        hidden = base.embeddings(input_ids)
+        layer_mask = attention_mask
+        if getattr(base, "_use_sdpa", False):
+            layer_mask = _prepare_4d_attention_mask_for_sdpa(
+                attention_mask, hidden.dtype, tgt_len=input_ids.size(1))
+        return hidden, {"mask": layer_mask}, {}
+    # DeBERTa: relative positions are shared by the batch.
+    encoder = base.encoder
+    hidden = base.embeddings(input_ids=input_ids, mask=attention_mask)
+    shared = {"relative_pos": encoder.get_rel_pos(hidden),
+              "rel_embeddings": encoder.get_rel_embedding()}
+    return hidden, {"mask": encoder.get_attention_mask(attention_mask),
+                    "input_mask": attention_mask,
+                    "embeddings": hidden}, shared
+
+
+def _run_layer(model, index, hidden, per_example, shared):
+    model_type = model.config.model_type
+    base = model.base_model
+    if model_type in ["bert", "roberta"]:
+        return base.encoder.layer[index](hidden, per_example["mask"])[0]
+    if model_type == "distilbert":
+        return base.transformer.layer[index](hidden, per_example["mask"],
+                                             None)[-1]
+    encoder = base.encoder
+    output = encoder.layer[index](hidden, per_example["mask"],
+                                  relative_pos=shared["relative_pos"],
+                                  rel_embeddings=shared["rel_embeddings"])[0]
+    if index == 0 and encoder.conv is not None:
+        output = encoder.conv(per_example["embeddings"], output,
+                              per_example["input_mask"])
+    return output
+
+
+@torch.no_grad()
+def early_exit_forward(model, input_ids, attention_mask, threshold):
+    """Runs the encoder layer by layer and lets every example leave at the
+    first exit whose top probability reaches `threshold`. Finished examples
+    are dropped from the batch, so the remaining layers only run on the
+    hard ones.
+
+    Returns `(probs, exit_layers)`, exit layers are 1-based.
+    """
+    num_layers = model.config.num_hidden_layers
+    probs = torch.zeros(input_ids.size(0), model.config.num_labels,
+                        device=input_ids.device)
+    exit_layers = torch.full((input_ids.size(0),), num_layers,
+                             dtype=torch.long, device=input_ids.device)
+
+    hidden, per_example, shared = _embed(model, input_ids, attention_mask)
+    active = torch.arange(input_ids.size(0), device=input_ids.device)
+    for index in range(num_layers):
+        hidden = _run_layer(model, index, hidden, per_example, shared)
+        layer = index + 1
+        if layer == num_layers:
+            probs[active] = F.softmax(
+                classification_head_logits(model, hidden[:, 0]), dim=-1)
+            break
+
+        layer_probs = F.softmax(model.early_exit_heads(layer, hidden[:, 0]),
+                                dim=-1)
+        done = layer_probs.max(dim=-1)[0] >= threshold
+        if done.any():
+            probs[active[done]] = layer_probs[done]
+            exit_layers[active[done]] = layer
+            keep = ~done
+            if not keep.any():
+                break
+            active, hidden = active[keep], hidden[keep]
+            per_example = {key: value[keep] if value is not None else None
+                           for key, value in per_example.items()}
+    return probs, exit_layers
+
+
+def early_exit_predictions(args, model, dataset, threshold):
+    """Early exit probabilities of `dataset`, in order.
+
+    Returns `(probs, exit_layers, seconds)`.
+    """
+    dataloader = DataLoader(dataset, sampler=SequentialSampler(dataset),
+                            batch_size=args.eval_batch_size)
+    model.eval()
+    all_probs, all_layers = [], []
+    start = time.time()
+    for batch in dataloader:
+        probs, exit_layers = early_exit_forward(
+            model, batch[0].to(args.device), batch[1].to(args.device),
+            threshold)
+        all_probs.append(probs.cpu().numpy())
+        all_layers.append(exit_layers.cpu().numpy())
+    elapsed = time.time() - start
+    return np.concatenate(all_probs), np.concatenate(all_layers), elapsed
+
+
+def early_exit_curve(args, model, dataset, output_file=None):
+    """Accuracy, mean exit layer and latency for each threshold of
+    `early_exit_thresholds`. A threshold above 1 never exits early, which
+    is the full-depth baseline. Unlabeled splits (e.g. the Com2Sense test
+    set) get no accuracy fields."""
+    examples = dataset.examples
+    labels = np.array([example.label for example in examples])
+    has_label = all(label is not None for label in labels)
+    guids = [example.guid for example in examples]
+    num_layers = model.config.num_hidden_layers
+
+    # Warm-up, so that the first threshold is not timed with it.
+    early_exit_predictions(args, model, Subset(
+        dataset, range(min(len(dataset), args.eval_batch_size))), 1.1)
+
+    curve = []
+    for threshold in [1.1] + sorted(args.early_exit_thresholds, reverse=True):
+        probs, exit_layers, elapsed = early_exit_predictions(args, model,
+                                                             dataset, threshold)
+        preds = probs.argmax(axis=-1)
+        point = {
+            "threshold": threshold,
+            "mean_exit_layer": float(exit_layers.mean()),
+            "relative_depth": float(exit_layers.mean() / num_layers),
+            "ms_per_example": 1000.0 * elapsed / len(examples),
+        }
+        if has_label:
+            point["accuracy"] = float((preds == labels).mean())
+            if args.task_name == "com2sense":
+                point["pairwise_accuracy"] = float(pairwise_accuracy(
+                    guids, preds, labels))
+        curve.append(point)
+        logger.info("  threshold %.2f: accuracy %s, mean exit layer %.2f / "
+                    "%d, %.2f ms/example", threshold,
+                    "{:.4f}".format(point["accuracy"]) if has_label
+                    else "n/a", point["mean_exit_layer"], num_layers,
+                    point["ms_per_example"])
+
+    if output_file is not None:
+        with open(output_file, "w") as f:
+            json.dump(curve, f, indent=2)
+    return curve
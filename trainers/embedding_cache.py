@@ -0,0 +1,160 @@
+import os
+import hashlib
+import logging
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+from torch.utils.data import DataLoader, SequentialSampler
+from tqdm import tqdm, trange
+
+from data_processing.feature_cache import feature_cache_path
+from .model_heads import classification_head_logits, head_parameters
+from .optim import create_optimizer
+
+logger = logging.getLogger(__name__)
+
+
+def encoder_fingerprint(model):
+    """A content hash of the encoder weights of `model`. The classification
+    head is left out, so every linear-probe checkpoint of the same encoder
+    shares its cached embeddings."""
+    hasher = hashlib.sha1()
+    hasher.update(model.config.model_type.encode("utf-8"))
+    for name, tensor in sorted(model.base_model.state_dict().items()):
+        hasher.update(name.encode("utf-8"))
+        hasher.update(tensor.detach().cpu().contiguous().numpy().tobytes())
+    return hasher.hexdigest()
+
+
+def embedding_cache_path(cache_dir, model, dataset):
+    """`{encoder hash}-{feature cache key}-{max_seq_length}`, where the
+    feature cache key is the one of `feature_cache.py` (tokenizer and text
+    hashes)."""
+    texts = [example.text for example in dataset.examples]
+    features_key = os.path.basename(
+        feature_cache_path(cache_dir, texts, dataset.tokenizer))
+    return os.path.join(cache_dir, "{}-{}-{}.npy".format(
+        encoder_fingerprint(model)[:16], features_key,
+        dataset.max_seq_length))
+
+
+@torch.no_grad()
+def encode_dataset(args, model, dataset, path):
+    """Runs the encoder once over `dataset` and writes the first ([CLS])
+    token hidden states into the `.npy` array `path`."""
+    dataloader = DataLoader(dataset, sampler=SequentialSampler(dataset),
+                            batch_size=args.eval_batch_size)
+    tmp_path = "{}.tmp-{}.npy".format(path[:-len(".npy")], os.getpid())
+    embeddings = np.lib.format.open_memmap(
+        tmp_path, mode="w+", dtype=np.float32,
+        shape=(len(dataset), model.config.hidden_size))
+
+    model.eval()
+    start = 0
+    for batch in tqdm(dataloader, desc="Encoding"):
+        input_ids = batch[0].to(args.device)
+        attention_mask = batch[1].to(args.device)
+        sequence_output = model.base_model(input_ids,
+                                           attention_mask=attention_mask)[0]
+        cls_hidden = sequence_output[:, 0].float().cpu().numpy()
+        embeddings[start:start + len(cls_hidden)] = cls_hidden
+        start += len(cls_hidden)
+    embeddings.flush()
+    del embeddings
+    os.replace(tmp_path, path)
+
+
+def load_or_build_embeddings(args, model, dataset):
+    """Cached encoder outputs of `dataset` as a memory-mapped
+    (num_examples, hidden_size) array, computed only on cache miss."""
+    cache_dir = args.embedding_cache_dir
+    os.makedirs(cache_dir, exist_ok=True)
+    path = embedding_cache_path(cache_dir, model, dataset)
+    if os.path.isfile(path):
+        logger.info("Loading cached embeddings from %s", path)
+    else:
+        logger.info("Encoding %d examples into %s", len(dataset), path)
+        encode_dataset(args, model, dataset, path)
+    return np.load(path, mmap_mode="r")
+
+
+def example_labels(dataset):
+    """Labels of the dataset examples, -100 where there is none."""
+    return np.array([-100 if example.label is None else int(example.label)
+                     for example in dataset.examples], dtype=np.int64)
+
+
+def train_linear_probe(args, model, train_dataset):
+    """Trains only the classification head of `model` on the cached encoder
+    outputs of `train_dataset`. Each epoch is a pass over an in-memory
+    array, so that even many epochs take seconds.
+
+    Returns `(global_step, average_loss)` as `train()` does.
+    """
+    embeddings = torch.from_numpy(np.array(
+        load_or_build_embeddings(args, model, train_dataset)))
+    labels = torch.from_numpy(example_labels(train_dataset))
+
+    head = dict(head_parameters(model))
+    requires_grad = {name: param.requires_grad
+                     for name, param in model.named_parameters()}
+    for name, param in model.named_parameters():
+        param.requires_grad = name in head
+    optimizer = create_optimizer(args, model)
+
+    batch_size = args.per_gpu_train_batch_size * max(1, args.n_gpu)
+    num_epochs = int(args.num_train_epochs)
+    logger.info("***** Training linear probe *****")
+    logger.info("  Num examples = %d, Num Epochs = %d, Batch size = %d",
+                len(embeddings), num_epochs, batch_size)
+
+    model.train()
+    global_step, tr_loss = 0, 0.0
+    for _ in trange(num_epochs, desc="Epoch"):
+        order = torch.randperm(len(embeddings))
+        for start in range(0, len(order), batch_size):
+            index = order[start:start + batch_size]
+            logits = classification_head_logits(
+                model, embeddings[index].to(args.device))
+            loss = F.cross_entropy(logits, labels[index].to(args.device))
+            loss.backward()
+            optimizer.step()
+            model.zero_grad()
+            tr_loss += loss.item()
+            global_step += 1
+            if args.max_steps > 0 and global_step >= args.max_steps:
+                break
+        if args.max_steps > 0 and global_step >= args.max_steps:
+            break
+
+    for name, param in model.named_parameters():
+        param.requires_grad = requires_grad[name]
+    return global_step, tr_loss / max(1, global_step)
+
+
+@torch.no_grad()
+def linear_probe_predictions(args, model, dataset):
+    """Predicted probabilities of `dataset` from cached encoder outputs.
+
+    Returns `(probs, labels, eval_loss, nb_eval_steps)` like
+    `packed_predictions`, `labels` is `None` for unlabeled splits.
+    """
+    embeddings = load_or_build_embeddings(args, model, dataset)
+    labels = example_labels(dataset)
+
+    model.eval()
+    all_logits = []
+    for start in range(0, len(embeddings), args.eval_batch_size):
+        batch = torch.from_numpy(np.array(
+            embeddings[start:start + args.eval_batch_size]))
+        all_logits.append(classification_head_logits(
+            model, batch.to(args.device)).cpu())
+    logits = torch.cat(all_logits)
+    probs = F.softmax(logits, dim=-1).numpy()
+
+    if (labels < 0).all():
+        return probs, None, 0.0, 1
+    # The mean over all examples, as a single evaluation step.
+    eval_loss = F.cross_entropy(logits, torch.from_numpy(labels)).item()
+    return probs, labels, eval_loss, 1
@@ -0,0 +1,273 @@
+"""Ensemble evaluation of several checkpoints on one split.
+
+Checkpoints are grouped by tokenizer (content hash), each group's split is
+tokenized once, and every batch goes through all the models of the group
+concurrently: a thread pool on CPU (PyTorch releases the GIL in its
+kernels), or one model per device round-robin over the GPUs. On CPU the
+PyTorch threads are split between the concurrent models.
+
+With `--prediction_cache_db`, the models read and fill the prediction cache
+of `prediction_cache.py`, so only statements a checkpoint has not scored
+yet run through it.
+
+    python3 -m trainers.ensemble --task_name com2sense \
+        --data_dir datasets/com2sense --split dev --combine mean \
+        --checkpoints outputs/bert/checkpoint-4000 \
+                      outputs/distilroberta/checkpoint-3000 \
+                      outputs/deberta/checkpoint-5000
+"""
+import os
+import json
+import time
+import logging
+import argparse
+import functools
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+from torch.utils.data import DataLoader, SequentialSampler
+
+from data_processing import data_processors, data_classes
+from data_processing.feature_cache import load_or_build_features, \
+    tokenizer_fingerprint
+from .train_utils import evaluate_standard, pairwise_accuracy
+from .prediction_cache import PredictionCache, cache_namespace, \
+    cache_lookup, cache_store, dataset_logits, log_cache_stats
+from .cpu_config import allowed_cpus
+
+logger = logging.getLogger(__name__)
+
+COMBINE_METHODS = ["mean", "vote"]
+
+
+def model_devices(num_models, no_cuda=False):
+    """Round-robin assignment of the models to the available GPUs, or the
+    CPU for all of them."""
+    if no_cuda or not torch.cuda.is_available():
+        return [torch.device("cpu")] * num_models
+    num_gpus = torch.cuda.device_count()
+    return [torch.device("cuda", i % num_gpus) for i in range(num_models)]
+
+
+def load_ensemble(checkpoints, no_cuda=False):
+    """Loads the checkpoints grouped by tokenizer.
+
+    Returns `{tokenizer hash: (tokenizer, [(checkpoint, model)])}`, in the
+    order of `checkpoints`.
+    """
+    from transformers import AutoModelForSequenceClassification, \
+        AutoTokenizer
+
+    groups = OrderedDict()
+    devices = model_devices(len(checkpoints), no_cuda)
+    for checkpoint, device in zip(checkpoints, devices):
+        tokenizer = AutoTokenizer.from_pretrained(checkpoint)
+        fingerprint = tokenizer_fingerprint(tokenizer)
+        model = AutoModelForSequenceClassification.from_pretrained(checkpoint)
+        model.to(device)
+        model.eval()
+        if fingerprint not in groups:
+            groups[fingerprint] = (tokenizer, [])
+        groups[fingerprint][1].append((checkpoint, model))
+    for fingerprint, (_, models) in groups.items():
+        logger.info("Tokenizer %s: %s", fingerprint[:16],
+                    ", ".join(checkpoint for checkpoint, _ in models))
+    return groups
+
+
+@torch.no_grad()
+def _model_probs(model, input_ids, attention_mask):
+    device = next(model.parameters()).device
+    logits = model(input_ids=input_ids.to(device),
+                   attention_mask=attention_mask.to(device))[0]
+    return F.softmax(logits.float(), dim=-1).cpu().numpy()
+
+
+def cached_group_probs(models, tokenizer, dataset, batch_size, executor,
+                       cache):
+    """`group_probs` through the prediction cache: the cache is read and
+    written here, and only the misses of each model run, concurrently."""
+    texts = [example.text for example in dataset.examples]
+    lookups, futures = [], []
+    for _, model in models:
+        namespace = cache_namespace(model, tokenizer, dataset.max_seq_length)
+        keys, cached, to_run = cache_lookup(cache, namespace, texts)
+        log_cache_stats(cache, cached, to_run)
+        lookups.append((namespace, keys, cached, to_run))
+        futures.append(executor.submit(
+            dataset_logits, model, dataset, to_run, batch_size,
+            next(model.parameters()).device) if to_run else None)
+    probs = []
+    for (namespace, keys, cached, to_run), future in zip(lookups, futures):
+        logits = cache_store(cache, namespace, keys, cached, to_run,
+                             future.result() if future else None)
+        probs.append(F.softmax(torch.from_numpy(logits), dim=-1).numpy())
+    return probs
+
+
+def group_probs(models, dataset, batch_size, executor):
+    """Probabilities of every model of a tokenizer group on `dataset`, the
+    models running concurrently on each batch. Returns one
+    (num_examples, num_labels) array per model."""
+    dataloader = DataLoader(dataset, sampler=SequentialSampler(dataset),
+                            batch_size=batch_size)
+    probs = [[] for _ in models]
+    for batch in dataloader:
+        # Drops the padding columns no example of the batch uses.
+        max_len = int(batch[1].sum(dim=1).max())
+        input_ids = batch[0][:, :max_len]
+        attention_mask = batch[1][:, :max_len]
+        futures = [executor.submit(_model_probs, model, input_ids,
+                                   attention_mask)
+                   for _, model in models]
+        for model_probs, future in zip(probs, futures):
+            model_probs.append(future.result())
+    return [np.concatenate(model_probs) for model_probs in probs]
+
+
+def combine(all_probs, method="mean", weights=None):
+    """Combined class probabilities of the models.
+
+    `mean` averages the probabilities (weighted by `weights`), `vote` takes
+    the (weighted) majority of the predicted classes as a one-hot, with ties
+    broken by the mean probabilities.
+    """
+    all_probs = np.stack(all_probs)
+    weights = np.ones(len(all_probs)) if weights is None \
+              else np.asarray(weights, dtype=np.float64)
+    weights = weights / weights.sum()
+    mean = np.tensordot(weights, all_probs, axes=1)
+    if method == "mean":
+        return mean
+    if method == "vote":
+        num_labels = all_probs.shape[-1]
+        votes = np.tensordot(
+            weights, np.eye(num_labels)[all_probs.argmax(axis=-1)], axes=1)
+        # Ties go to the class with the larger mean probability.
+        return votes + 1e-6 * mean
+    raise ValueError("Unknown combine method {}, one of {}".format(
+        method, COMBINE_METHODS))
+
+
+def split_metrics(task_name, probs, labels, guids, average="binary"):
+    preds = probs.argmax(axis=-1)
+    acc, prec, recall, f1 = evaluate_standard(preds, labels, average)
+    results = {"accuracy": acc, "precision": prec, "recall": recall,
+               "F1_score": f1}
+    if task_name == "com2sense":
+        results["pairwise_accuracy"] = pairwise_accuracy(guids, preds, labels)
+    return results
+
+
+def evaluate_ensemble(args):
+    """Per-model and ensemble predictions (and metrics on labeled splits)."""
+    processor = data_processors[args.task_name](data_dir=args.data_dir)
+    examples = processor._read_data(split=args.split)
+    labels = [example.label for example in examples]
+    has_label = all(label is not None for label in labels)
+    guids = [example.guid for example in examples]
+    dataset_args = argparse.Namespace(do_train=False)
+
+    groups = load_ensemble(args.checkpoints, args.no_cuda)
+    num_models = sum(len(models) for _, models in groups.values())
+    cache = None
+    if args.prediction_cache_db is not None:
+        cache = PredictionCache(args.prediction_cache_db)
+    num_workers = min(args.num_threads or num_models, num_models)
+    # Concurrent CPU models share the cores instead of each starting one
+    # thread per core.
+    threads = max(1, len(allowed_cpus()) // num_workers)
+    initializer = None
+    if all(next(model.parameters()).device.type == "cpu"
+           for _, models in groups.values() for _, model in models):
+        initializer = functools.partial(torch.set_num_threads, threads)
+        logger.info("%d concurrent models, %d PyTorch threads each",
+                    num_workers, threads)
+    probs_by_checkpoint = {}
+    start = time.time()
+    with ThreadPoolExecutor(max_workers=num_workers,
+                            initializer=initializer) as executor:
+        for tokenizer, models in groups.values():
+            features = None
+            if args.feature_cache_dir is not None:
+                features = load_or_build_features(
+                    [example.text for example in examples], tokenizer,
+                    args.feature_cache_dir)
+            dataset = data_classes[args.task_name](
+                examples, tokenizer, max_seq_length=args.max_seq_length,
+                args=dataset_args, features=features)
+            if cache is not None:
+                probs = cached_group_probs(models, tokenizer, dataset,
+                                           args.batch_size, executor, cache)
+            else:
+                probs = group_probs(models, dataset, args.batch_size,
+                                    executor)
+            for (checkpoint, _), model_probs in zip(models, probs):
+                probs_by_checkpoint[checkpoint] = model_probs
+    if cache is not None:
+        cache.close()
+    logger.info("%d models on %d examples in %.2fs", num_models,
+                len(examples), time.time() - start)
+
+    all_probs = [probs_by_checkpoint[checkpoint]
+                 for checkpoint in args.checkpoints]
+    ensemble_probs = combine(all_probs, args.combine, args.weights)
+
+    report = {"split": args.split, "combine": args.combine,
+              "checkpoints": args.checkpoints, "weights": args.weights}
+    if has_label:
+        labels = np.asarray(labels)
+        report["models"] = {
+            checkpoint: split_metrics(args.task_name, probs, labels, guids,
+                                      args.score_average_method)
+            for checkpoint, probs in zip(args.checkpoints, all_probs)}
+        report["ensemble"] = split_metrics(args.task_name, ensemble_probs,
+                                           labels, guids,
+                                           args.score_average_method)
+    return ensemble_probs, report
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--checkpoints", required=True, nargs="+",
+                        help="Checkpoint directories (model and tokenizer).")
+    parser.add_argument("--task_name", default="com2sense", type=str)
+    parser.add_argument("--data_dir", default="datasets/com2sense", type=str)
+    parser.add_argument("--split", default="dev", type=str)
+    parser.add_argument("--combine", default="mean", choices=COMBINE_METHODS)
+    parser.add_argument("--weights", default=None, type=float, nargs="+",
+                        help="One weight per checkpoint, defaults to equal.")
+    parser.add_argument("--max_seq_length", default=128, type=int)
+    parser.add_argument("--batch_size", default=32, type=int)
+    parser.add_argument("--num_threads", default=0, type=int,
+                        help="Models run concurrently, defaults to all.")
+    parser.add_argument("--feature_cache_dir", default=None, type=str)
+    parser.add_argument("--prediction_cache_db", default=None, type=str,
+                        help="Prediction cache database (see "
+                             "trainers/prediction_cache.py), e.g. "
+                             "outputs/predictions.sqlite.")
+    parser.add_argument("--score_average_method", default="binary", type=str)
+    parser.add_argument("--no_cuda", action="store_true")
+    parser.add_argument("--output_dir", default=None, type=str,
+                        help="Writes the ensemble predictions and metrics.")
+    cli_args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    if cli_args.weights is not None \
+            and len(cli_args.weights) != len(cli_args.checkpoints):
+        parser.error("--weights needs one weight per checkpoint.")
+
+    ensemble_probs, report = evaluate_ensemble(cli_args)
+    print(json.dumps(report, indent=2))
+    if cli_args.output_dir is not None:
+        os.makedirs(cli_args.output_dir, exist_ok=True)
+        with open(os.path.join(cli_args.output_dir, "ensemble_results_{}.json"
+                               .format(cli_args.split)), "w") as f:
+            json.dump(report, f, indent=2)
+        with open(os.path.join(cli_args.output_dir, "ensemble_predictions_{}"
+                               ".txt".format(cli_args.split)), "w") as f:
+            for pred in ensemble_probs.argmax(axis=-1):
+                f.write("{}\n".format(pred))
@@ -0,0 +1,206 @@
+import os
+import logging
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+from torch.utils.data import Dataset, Sampler
+
+logger = logging.getLogger(__name__)
+
+EXAMPLE_STATS_NAME = "example_stats.npz"
+
+
+class ExampleStats(object):
+    """Training statistics of every example, indexed by dataset position.
+
+    * `loss_ema`: exponential moving average of the example's loss.
+    * `forgetting`: times the example went from correct to incorrect.
+    * `last_correct_step`: last optimizer step it was predicted correctly.
+
+    A few bytes per example, updated in place from the losses `train()`
+    already computes.
+    """
+
+    def __init__(self, num_examples, ema_decay=0.9):
+        self.ema_decay = ema_decay
+        self.loss_ema = np.zeros(num_examples, dtype=np.float32)
+        self.seen = np.zeros(num_examples, dtype=np.int32)
+        self.correct = np.zeros(num_examples, dtype=bool)
+        self.forgetting = np.zeros(num_examples, dtype=np.int32)
+        self.last_correct_step = np.full(num_examples, -1, dtype=np.int64)
+
+    def __len__(self):
+        return len(self.loss_ema)
+
+    def update(self, indices, losses, correct, global_step):
+        """Records a batch: `indices` are dataset positions, `losses` the
+        per-example losses and `correct` whether each was predicted right."""
+        indices = np.asarray(indices)
+        losses = np.asarray(losses, dtype=np.float32)
+        correct = np.asarray(correct, dtype=bool)
+        first = self.seen[indices] == 0
+        self.loss_ema[indices] = np.where(
+            first, losses, self.ema_decay * self.loss_ema[indices]
+            + (1.0 - self.ema_decay) * losses)
+        self.forgetting[indices] += self.correct[indices] & ~correct
+        self.correct[indices] = correct
+        self.last_correct_step[indices[correct]] = global_step
+        self.seen[indices] += 1
+
+    def save(self, path):
+        np.savez(path, loss_ema=self.loss_ema, seen=self.seen,
+                 correct=self.correct, forgetting=self.forgetting,
+                 last_correct_step=self.last_correct_step)
+
+    @classmethod
+    def load(cls, path, ema_decay=0.9):
+        arrays = np.load(path)
+        stats = cls(len(arrays["loss_ema"]), ema_decay)
+        for name in ["loss_ema", "seen", "correct", "forgetting",
+                     "last_correct_step"]:
+            setattr(stats, name, arrays[name].copy())
+        return stats
+
+    def summary(self):
+        seen = self.seen > 0
+        return {
+            "seen": int(seen.sum()),
+            "mean_loss_ema": float(self.loss_ema[seen].mean())
+                             if seen.any() else 0.0,
+            "forgotten": int((self.forgetting > 0).sum()),
+            "never_correct": int((seen & (self.last_correct_step < 0)).sum()),
+        }
+
+
+class IndexedDataset(Dataset):
+    """Appends the dataset position to every item of `dataset`, so that the
+    training loop knows which examples a batch holds."""
+
+    def __init__(self, dataset):
+        self.dataset = dataset
+        self.examples = dataset.examples
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, idx):
+        return tuple(self.dataset[idx]) + (idx,)
+
+
+class HardExampleSampler(Sampler):
+    """Uniform sampling for `warmup_epochs`, then sampling (with
+    replacement) proportional to the loss EMA of each example.
+
+    Weights are relative to the mean loss EMA and floored at `min_weight`,
+    so learned examples are down-weighted (or, with `min_weight=0`,
+    dropped), and forgotten examples keep at least the mean weight. Every
+    epoch has the same number of samples, so the learning rate schedule of
+    `train()` is unchanged.
+    """
+
+    def __init__(self, stats, warmup_epochs=1, min_weight=0.1,
+                 generator=None):
+        self.stats = stats
+        self.warmup_epochs = warmup_epochs
+        self.min_weight = min_weight
+        self.generator = generator
+        self.epoch = 0
+
+    def __len__(self):
+        return len(self.stats)
+
+    def weights(self):
+        stats = self.stats
+        mean_loss = stats.loss_ema[stats.seen > 0].mean() \
+                    if (stats.seen > 0).any() else 1.0
+        weights = stats.loss_ema / max(float(mean_loss), 1e-8)
+        weights = np.where(stats.forgetting > 0, np.maximum(weights, 1.0),
+                           weights)
+        # Examples not seen yet are as likely as an average one.
+        weights = np.where(stats.seen > 0, weights, 1.0)
+        return np.maximum(weights, self.min_weight)
+
+    def __iter__(self):
+        epoch = self.epoch
+        self.epoch += 1
+        if epoch < self.warmup_epochs:
+            return iter(torch.randperm(len(self), generator=self.generator)
+                        .tolist())
+        weights = torch.as_tensor(self.weights(), dtype=torch.double)
+        logger.info("Hard example sampling, epoch %d: %.1f%% of the weight "
+                    "on the hardest 10%% of examples", epoch, 100.0 * float(
+                        weights.sort(descending=True)[0][:len(self) // 10]
+                        .sum() / weights.sum()))
+        return iter(torch.multinomial(weights, len(self), replacement=True,
+                                      generator=self.generator).tolist())
+
+
+def update_example_stats(stats, batch, logits, labels, global_step):
+    """Per-example losses and correctness of a training batch (whose last
+    item are the `IndexedDataset` positions) into `stats`."""
+    with torch.no_grad():
+        logits = logits.detach().float()
+        losses = F.cross_entropy(logits, labels, reduction="none")
+        correct = logits.argmax(dim=-1) == labels
+    stats.update(batch[-1].cpu().numpy(), losses.cpu().numpy(),
+                 correct.cpu().numpy(), global_step)
+
+
+def save_example_stats(stats, output_dir):
+    path = os.path.join(output_dir, EXAMPLE_STATS_NAME)
+    stats.save(path)
+    logger.info("Example statistics %s saved to %s", stats.summary(), path)
+
+
+if __name__ == "__main__":
+
+    import sys
+    import json
+    import time
+    import argparse
+    import subprocess
+
+    parser = argparse.ArgumentParser(
+        description="Time to a target dev accuracy with uniform and hard "
+                    "example sampling. Arguments after `--` are passed to "
+                    "trainers.train for both runs.")
+    parser.add_argument("--target", default=0.6, type=float)
+    parser.add_argument("--metric", default="accuracy", type=str)
+    parser.add_argument("--output_dir", default="outputs/example_sampling",
+                        type=str)
+    bench_args, train_args = parser.parse_known_args()
+    if train_args and train_args[0] == "--":
+        train_args = train_args[1:]
+
+    for sampling in ["random", "hard"]:
+        output_dir = os.path.join(bench_args.output_dir, sampling)
+        command = [sys.executable, "-m", "trainers.train", "--do_train",
+                   "--evaluate_during_training", "--overwrite_output_dir",
+                   "--output_dir", output_dir] + train_args
+        if sampling == "hard":
+            command.append("--hard_example_sampling")
+        start = time.time()
+        subprocess.run(command, check=True, stdout=subprocess.DEVNULL,
+                       stderr=subprocess.DEVNULL)
+        total = time.time() - start
+
+        reached = None
+        best = 0.0
+        with open(os.path.join(output_dir, "eval_history.jsonl")) as f:
+            for line in f:
+                check = json.loads(line)
+                value = next(v for k, v in check["results"].items()
+                             if k.endswith("_" + bench_args.metric))
+                best = max(best, value)
+                if reached is None and value >= bench_args.target:
+                    reached = check
+        if reached is None:
+            print("{:>6}: {} {:.4f} never reached, best {:.4f} ({:.0f}s)"
+                  .format(sampling, bench_args.metric, bench_args.target,
+                          best, total))
+        else:
+            print("{:>6}: {} {:.4f} at step {} after {:.0f}s of training "
+                  "(best {:.4f}, {:.0f}s total)".format(
+                      sampling, bench_args.metric, bench_args.target,
+                      reached["step"], reached["train_seconds"], best, total))
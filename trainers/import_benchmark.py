@@ -0,0 +1,86 @@
+"""Import time of the packages of this repository.
+
+Each module is imported in a fresh interpreter, so that nothing is cached
+from a previous import. The light modules (processors, metrics, feature
+cache, argument parsing, sweeps) should import in well under a second; only
+the training and model code needs torch and transformers.
+
+    python3 -m trainers.import_benchmark
+    python3 -m trainers.import_benchmark --modules data_processing --top 10
+"""
+import sys
+import argparse
+import subprocess
+
+LIGHT_MODULES = [
+    "data_processing",
+    "data_processing.feature_cache",
+    "trainers.args",
+    "trainers.train_utils",
+    "trainers.sweep",
+]
+HEAVY_MODULES = [
+    "data_processing.processors",
+    "trainers.train",
+]
+
+_TIMER = ("import time; start = time.perf_counter(); import {}; "
+          "print(time.perf_counter() - start)")
+
+
+def import_seconds(module, repeats=3):
+    """Best wall time of importing `module` in a fresh interpreter."""
+    times = []
+    for _ in range(repeats):
+        output = subprocess.check_output(
+            [sys.executable, "-c", _TIMER.format(module)],
+            stderr=subprocess.DEVNULL)
+        times.append(float(output.decode().strip().splitlines()[-1]))
+    return min(times)
+
+
+def slowest_imports(module, top=10):
+    """`(cumulative_us, name)` of the slowest imports of `module`, from
+    `python -X importtime`."""
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c",
+                             "import {}".format(module)],
+                            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    rows = []
+    for line in result.stderr.decode().splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        rows.append((int(cumulative), name.strip()))
+    # Top-level packages only, their submodules are included in them.
+    rows = [row for row in rows if "." not in row[1]]
+    return sorted(rows, reverse=True)[:top]
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--modules", default=LIGHT_MODULES + HEAVY_MODULES,
+                        nargs="+")
+    parser.add_argument("--repeats", default=3, type=int)
+    parser.add_argument("--top", default=0, type=int,
+                        help="Also list the slowest imported packages.")
+    parser.add_argument("--budget", default=1.0, type=float,
+                        help="Seconds the light modules should import in.")
+    bench_args = parser.parse_args()
+
+    over_budget = []
+    for module in bench_args.modules:
+        seconds = import_seconds(module, bench_args.repeats)
+        light = module in LIGHT_MODULES
+        if light and seconds > bench_args.budget:
+            over_budget.append(module)
+        print("{:<32} {:6.3f}s{}".format(module, seconds,
+                                         "  (light)" if light else ""))
+        if bench_args.top > 0:
+            for cumulative, name in slowest_imports(module, bench_args.top):
+                print("    {:<28} {:6.3f}s".format(name, cumulative / 1e6))
+
+    if over_budget:
+        print("Over the {:.1f}s budget: {}".format(bench_args.budget,
+                                                   ", ".join(over_budget)))
+        sys.exit(1)
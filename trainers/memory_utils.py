@@ -0,0 +1,136 @@
+import gc
+import os
+import sys
+import logging
+import resource
+
+import torch
+from torch.utils.data import DataLoader, SequentialSampler
+
+from .packing_utils import packed_forward
+
+logger = logging.getLogger(__name__)
+
+
+def reset_peak_rss():
+    """Resets the peak resident memory to the current one, where the kernel
+    allows it (Linux). Elsewhere the peak stays the process's high-water
+    mark, so a probe cannot report less than earlier allocations."""
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+
+def peak_rss_mb():
+    """Peak resident memory of this process in MB, since the last
+    `reset_peak_rss` on Linux, since its start elsewhere."""
+    if os.path.exists("/proc/self/status"):
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return float(line.split()[1]) / 1024.0
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # In bytes on macOS, in KB on Linux.
+    return maxrss / 2.0 ** 20 if sys.platform == "darwin" else maxrss / 1024.0
+
+
+def available_memory_mb(device):
+    """Default memory budget: 90% of the device memory, or 80% of the memory
+    currently available to the host (read from `/proc/meminfo`, so
+    `--memory_budget_mb` is required for CPU runs off Linux)."""
+    if device.type == "cuda":
+        total = torch.cuda.get_device_properties(device).total_memory
+        return 0.9 * total / 2 ** 20
+    if not os.path.exists("/proc/meminfo"):
+        raise RuntimeError("Cannot read the available memory, please set "
+                           "--memory_budget_mb.")
+    with open("/proc/meminfo") as f:
+        for line in f:
+            if line.startswith("MemAvailable:"):
+                available = float(line.split()[1]) / 1024.0
+                return peak_rss_mb() + 0.8 * available
+    raise RuntimeError("Cannot read the available memory, please set "
+                       "--memory_budget_mb.")
+
+
+def optimizer_state_mb(model):
+    """The AdamW moments, which only get allocated at the first step."""
+    num_params = sum(p.numel() for p in model.parameters() if p.requires_grad)
+    return 2 * 4 * num_params / 2 ** 20
+
+
+def probe_step(args, model, dataset, batch_size):
+    """One forward and backward pass over a full-length batch, returns the
+    peak memory in MB or `None` if it did not fit."""
+    batch = next(iter(DataLoader(dataset, sampler=SequentialSampler(dataset),
+                                 batch_size=batch_size)))
+    batch = tuple(t.to(args.device) for t in batch)
+    if args.device.type == "cuda":
+        torch.cuda.empty_cache()
+        torch.cuda.reset_peak_memory_stats(args.device)
+    else:
+        reset_peak_rss()
+
+    model.train()
+    try:
+        if args.pack_sequences:
+            loss = packed_forward(model, batch)[0]
+        else:
+            loss = model(batch[0], attention_mask=batch[1],
+                         labels=batch[3])[0]
+        loss.backward()
+    except RuntimeError as e:
+        if "out of memory" not in str(e):
+            raise
+        return None
+    finally:
+        model.zero_grad(set_to_none=True)
+        loss = None
+        gc.collect()
+
+    if args.device.type == "cuda":
+        return torch.cuda.max_memory_allocated(args.device) / 2 ** 20
+    return peak_rss_mb()
+
+
+def fit_batch_size_to_memory(args, model, train_dataset):
+    """Sets `per_gpu_train_batch_size` to the largest micro-batch that fits
+    `memory_budget_mb` and `gradient_accumulation_steps` so that the
+    effective batch size (their product) stays the same."""
+    effective_batch_size = (args.per_gpu_train_batch_size
+                            * args.gradient_accumulation_steps)
+    budget = args.memory_budget_mb
+    if budget <= 0:
+        budget = available_memory_mb(args.device)
+    # Probes run before the optimizer allocates its states.
+    reserved = optimizer_state_mb(model)
+
+    micro_batch_size = 0
+    batch_size = 1
+    while batch_size <= min(effective_batch_size, len(train_dataset)):
+        peak = probe_step(args, model, train_dataset, batch_size)
+        logger.info("  Micro-batch %d: peak memory %s MB (+%.0f MB optimizer"
+                    " states), budget %.0f MB", batch_size,
+                    "OOM" if peak is None else "{:.0f}".format(peak),
+                    reserved, budget)
+        if peak is None or peak + reserved > budget:
+            break
+        micro_batch_size = batch_size
+        batch_size *= 2
+
+    if micro_batch_size == 0:
+        logger.warning("Even a micro-batch of 1 exceeds the memory budget of"
+                       " %.0f MB, using 1 anyway.", budget)
+        micro_batch_size = 1
+
+    # The largest divisor of the effective batch size that fits.
+    while effective_batch_size % micro_batch_size != 0:
+        micro_batch_size -= 1
+
+    args.per_gpu_train_batch_size = micro_batch_size
+    args.gradient_accumulation_steps = effective_batch_size // micro_batch_size
+    logger.info("Auto batch size: micro-batch %d x %d accumulation steps = "
+                "effective batch size %d", args.per_gpu_train_batch_size,
+                args.gradient_accumulation_steps, effective_batch_size)
@@ -11,13 +11,6 @@ import tqdm
 import numpy as np
 
 import torch
-from transformers import (
-    WEIGHTS_NAME,
-    AdamW,
-    AutoConfig,
-    AutoModelForMaskedLM,
-    AutoTokenizer,
-)
 
 def mask_tokens(inputs, tokenizer, args, special_tokens_mask=None):
     """
@@ -101,6 +94,7 @@ if __name__ == "__main__":
     set_seed(args)
 
     # Unit-testing the MLM function.
+    from transformers import AutoTokenizer
     tokenizer = AutoTokenizer.from_pretrained("bert-base-cased")
 
     input_sentence = "I am a good student and I love NLP."
@@ -0,0 +1,49 @@
+import torch
+
+
+def classification_head_logits(model, cls_hidden):
+    """Applies the sequence classification head of `model` to the hidden
+    states at the first ([CLS]) token, of size (num_examples, hidden_size).
+
+    This is what `AutoModelForSequenceClassification` models do after the
+    encoder, so the encoder output can be computed elsewhere (packed rows,
+    cached embeddings, intermediate layers) and still go through the
+    pretrained or finetuned head.
+    """
+    model_type = model.config.model_type
+    # The heads read the first token of a sequence.
+    hidden = cls_hidden.unsqueeze(1)
+
+    if model_type == "bert":
+        pooled_output = model.bert.pooler(hidden)
+        return model.classifier(model.dropout(pooled_output))
+    elif model_type == "roberta":
+        return model.classifier(hidden)
+    elif model_type in ["deberta", "deberta-v2"]:
+        pooled_output = model.pooler(hidden)
+        return model.classifier(model.dropout(pooled_output))
+    elif model_type == "distilbert":
+        pooled_output = model.pre_classifier(cls_hidden)
+        pooled_output = torch.nn.ReLU()(pooled_output)
+        return model.classifier(model.dropout(pooled_output))
+
+    raise ValueError("Classification head of model type {} is not "
+                     "supported.".format(model_type))
+
+
+# Top-level modules that make up the (newly initialized) classification head
+# of each model type, on top of the pretrained encoder.
+HEAD_MODULES = {
+    "bert": ["classifier"],
+    "roberta": ["classifier"],
+    "deberta": ["pooler", "classifier"],
+    "deberta-v2": ["pooler", "classifier"],
+    "distilbert": ["pre_classifier", "classifier"],
+}
+
+
+def head_parameters(model):
+    """`(name, parameter)` pairs of the classification head of `model`."""
+    heads = HEAD_MODULES[model.config.model_type]
+    return [(name, param) for name, param in model.named_parameters()
+            if name.split(".")[0] in heads]
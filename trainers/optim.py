@@ -0,0 +1,241 @@
+import math
+import logging
+from functools import lru_cache
+
+import torch
+
+logger = logging.getLogger(__name__)
+
+NO_DECAY = ("bias", "LayerNorm.weight")
+
+
+@lru_cache(maxsize=None)
+def _uses_weight_decay(name, no_decay=NO_DECAY):
+    return not any(nd in name for nd in no_decay)
+
+
+def build_param_groups(model, weight_decay):
+    """Splits the trainable parameters into a weight decay group and a no
+    weight decay group (biases and LayerNorm weights), in a single pass.
+    The decision per parameter name is cached, since the same names come
+    back every time an optimizer is rebuilt for a model."""
+    decay, no_decay = [], []
+    for name, param in model.named_parameters():
+        if not param.requires_grad:
+            continue
+        if _uses_weight_decay(name):
+            decay.append(param)
+        else:
+            no_decay.append(param)
+    return [
+        {"params": decay, "weight_decay": weight_decay},
+        {"params": no_decay, "weight_decay": 0.0},
+    ]
+
+
+# 8-bit optimizer states are stored with a logarithmic code per element and
+# one fp32 absmax per block: code 0 is zero, otherwise a magnitude of
+# `absmax * 2 ** (-level / levels_per_octave)`. This keeps the relative error
+# small over ~32 octaves, which a linear int8 code cannot do for the tiny
+# second moments of rarely updated embeddings.
+QUANT_BLOCK_SIZE = 256
+SIGNED_LEVELS_PER_OCTAVE = 4.0    # 127 levels, for the first moment.
+UNSIGNED_LEVELS_PER_OCTAVE = 8.0  # 255 levels, for the second moment.
+
+
+def quantize_blockwise(x, signed):
+    """Returns `(codes, absmax)` of a tensor, see `QUANT_BLOCK_SIZE`."""
+    flat = x.reshape(-1)
+    padding = (-flat.numel()) % QUANT_BLOCK_SIZE
+    if padding:
+        flat = torch.cat([flat, flat.new_zeros(padding)])
+    blocks = flat.view(-1, QUANT_BLOCK_SIZE)
+    absmax = blocks.abs().amax(dim=1, keepdim=True).clamp_(min=1e-30)
+
+    ratio = (blocks.abs() / absmax).clamp_(min=1e-30)
+    if signed:
+        levels = (-torch.log2(ratio) * SIGNED_LEVELS_PER_OCTAVE).round_()
+        codes = (levels + 1) * torch.sign(blocks)
+        codes[levels > 126] = 0
+        codes = codes.to(torch.int8)
+    else:
+        levels = (-torch.log2(ratio) * UNSIGNED_LEVELS_PER_OCTAVE).round_()
+        codes = levels + 1
+        codes[levels > 254] = 0
+        codes = codes.to(torch.uint8)
+    return codes, absmax
+
+
+def dequantize_blockwise(codes, absmax, like, signed):
+    """Inverse of `quantize_blockwise`, shaped like the tensor `like`."""
+    codes = codes.float()
+    if signed:
+        magnitude = torch.exp2(-(codes.abs() - 1) / SIGNED_LEVELS_PER_OCTAVE)
+        values = torch.sign(codes) * magnitude * absmax
+    else:
+        magnitude = torch.exp2(-(codes - 1) / UNSIGNED_LEVELS_PER_OCTAVE)
+        values = (codes > 0).float() * magnitude * absmax
+    return values.reshape(-1)[:like.numel()].view_as(like)
+
+
+class AdamW8bit(torch.optim.Optimizer):
+    """AdamW (decoupled weight decay, bias correction) keeping both moments
+    in 8 bits with blockwise scales, for about a quarter of the memory of
+    fp32 states. Tensors smaller than `min_8bit_size` keep fp32 states."""
+
+    def __init__(self, params, lr=1e-3, betas=(0.9, 0.999), eps=1e-8,
+                 weight_decay=0.0, min_8bit_size=4096):
+        defaults = dict(lr=lr, betas=betas, eps=eps,
+                        weight_decay=weight_decay)
+        self.min_8bit_size = min_8bit_size
+        super(AdamW8bit, self).__init__(params, defaults)
+
+    @torch.no_grad()
+    def step(self, closure=None):
+        loss = None
+        if closure is not None:
+            with torch.enable_grad():
+                loss = closure()
+
+        for group in self.param_groups:
+            beta1, beta2 = group["betas"]
+            for p in group["params"]:
+                if p.grad is None:
+                    continue
+                grad = p.grad.float()
+                state = self.state[p]
+                quantized = p.numel() >= self.min_8bit_size
+
+                if len(state) == 0:
+                    state["step"] = 0
+                    if quantized:
+                        state["exp_avg"], state["exp_avg_absmax"] = \
+                            quantize_blockwise(torch.zeros_like(grad), True)
+                        state["exp_avg_sq"], state["exp_avg_sq_absmax"] = \
+                            quantize_blockwise(torch.zeros_like(grad), False)
+                    else:
+                        state["exp_avg"] = torch.zeros_like(grad)
+                        state["exp_avg_sq"] = torch.zeros_like(grad)
+
+                if quantized:
+                    exp_avg = dequantize_blockwise(
+                        state["exp_avg"], state["exp_avg_absmax"], grad, True)
+                    exp_avg_sq = dequantize_blockwise(
+                        state["exp_avg_sq"], state["exp_avg_sq_absmax"], grad,
+                        False)
+                else:
+                    exp_avg, exp_avg_sq = state["exp_avg"], state["exp_avg_sq"]
+
+                state["step"] += 1
+                exp_avg.mul_(beta1).add_(grad, alpha=1 - beta1)
+                exp_avg_sq.mul_(beta2).addcmul_(grad, grad, value=1 - beta2)
+
+                bias_correction1 = 1 - beta1 ** state["step"]
+                bias_correction2 = 1 - beta2 ** state["step"]
+                step_size = group["lr"] * math.sqrt(bias_correction2) \
+                            / bias_correction1
+                denom = exp_avg_sq.sqrt().add_(
+                    group["eps"] * math.sqrt(bias_correction2))
+
+                if group["weight_decay"] > 0:
+                    p.mul_(1 - group["lr"] * group["weight_decay"])
+                p.addcdiv_(exp_avg.to(p.dtype), denom.to(p.dtype),
+                           value=-step_size)
+
+                if quantized:
+                    state["exp_avg"], state["exp_avg_absmax"] = \
+                        quantize_blockwise(exp_avg, True)
+                    state["exp_avg_sq"], state["exp_avg_sq_absmax"] = \
+                        quantize_blockwise(exp_avg_sq, False)
+
+        return loss
+
+
+OPTIMIZERS = ["adamw_hf", "adamw", "adamw_foreach", "adamw_fused",
+              "adamw_8bit"]
+
+
+def create_optimizer(args, model):
+    """Builds the optimizer named by `args.optimizer` (see `OPTIMIZERS`)
+    over the trainable parameters of `model`.
+
+    * `adamw_hf`: `transformers.AdamW`, the optimizer of the original
+      training loop, which adds `eps` after the bias correction and decays
+      the weights after the Adam update (unlike `torch.optim.AdamW`). Falls
+      back to `adamw` when transformers no longer has it.
+    * `adamw`: `torch.optim.AdamW`, one parameter tensor at a time.
+    * `adamw_foreach`: multi-tensor AdamW, updates all tensors of a group
+      with a few batched kernels.
+    * `adamw_fused`: single fused kernel AdamW, falls back to `foreach`
+      where the installed PyTorch has no fused kernel for the device.
+    * `adamw_8bit`: `AdamW8bit`, blockwise 8-bit optimizer states.
+    """
+    param_groups = build_param_groups(model, args.weight_decay)
+    kwargs = dict(lr=args.learning_rate, eps=args.adam_epsilon)
+
+    if args.optimizer == "adamw_8bit":
+        return AdamW8bit(param_groups, **kwargs)
+    if args.optimizer == "adamw_hf":
+        try:
+            from transformers import AdamW
+        except ImportError:
+            logger.warning("transformers.AdamW is not available in this "
+                           "transformers version, using torch.optim.AdamW.")
+        else:
+            return AdamW(param_groups, no_deprecation_warning=True, **kwargs)
+        return torch.optim.AdamW(param_groups, foreach=False, **kwargs)
+    if args.optimizer == "adamw":
+        return torch.optim.AdamW(param_groups, foreach=False, **kwargs)
+    if args.optimizer == "adamw_fused":
+        try:
+            return torch.optim.AdamW(param_groups, fused=True, **kwargs)
+        except (RuntimeError, TypeError) as e:
+            logger.warning("Fused AdamW is not available (%s), using the "
+                           "foreach implementation.", e)
+    return torch.optim.AdamW(param_groups, foreach=True, **kwargs)
+
+
+def optimizer_state_bytes(optimizer):
+    return sum(t.numel() * t.element_size()
+               for state in optimizer.state.values()
+               for t in state.values() if torch.is_tensor(t))
+
+
+if __name__ == "__main__":
+
+    import time
+    import argparse
+    from transformers import BertConfig, BertForSequenceClassification
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--num_steps", default=5, type=int)
+    parser.add_argument("--optimizers", default=OPTIMIZERS, nargs="+",
+                        choices=OPTIMIZERS)
+    bench_args = parser.parse_args()
+
+    # A bert-base-cased sized model (~108M parameters), randomly initialized.
+    model = BertForSequenceClassification(BertConfig(vocab_size=28996))
+    num_params = sum(p.numel() for p in model.parameters())
+    print("Parameters: {:.1f}M in {} tensors".format(
+        num_params / 1e6, len(list(model.parameters()))))
+
+    start = time.time()
+    for _ in range(100):
+        build_param_groups(model, 0.01)
+    print("Parameter groups: {:.2f} ms".format((time.time() - start) * 10))
+
+    for p in model.parameters():
+        p.grad = torch.randn_like(p) * 1e-3
+
+    for name in bench_args.optimizers:
+        opt_args = argparse.Namespace(optimizer=name, learning_rate=1e-5,
+                                      adam_epsilon=1e-8, weight_decay=0.01)
+        optimizer = create_optimizer(opt_args, model)
+        optimizer.step()  # Allocates the states.
+        start = time.time()
+        for _ in range(bench_args.num_steps):
+            optimizer.step()
+        step_time = (time.time() - start) / bench_args.num_steps
+        print("{:>14}: {:8.1f} ms/step, states {:7.1f} MB".format(
+            name, step_time * 1000, optimizer_state_bytes(optimizer) / 2 ** 20))
+        del optimizer
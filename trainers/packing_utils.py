@@ -0,0 +1,178 @@
+import time
+import logging
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+from torch.utils.data import DataLoader, SequentialSampler
+from tqdm import tqdm
+
+from .model_heads import classification_head_logits
+
+logger = logging.getLogger(__name__)
+
+# DistilBERT only accepts (batch, seq) attention masks and does not take
+# position ids, so its rows cannot be split into independent segments.
+PACKING_MODEL_TYPES = ["bert", "roberta", "deberta", "deberta-v2"]
+
+
+def block_diagonal_attention_mask(segment_ids):
+    """(batch, seq, seq) mask letting tokens attend only within their own
+    segment. Padding tokens attend to themselves so that no row is empty."""
+    same_segment = segment_ids.unsqueeze(2) == segment_ids.unsqueeze(1)
+    not_padding = (segment_ids > 0).unsqueeze(2)
+    diagonal = torch.eye(segment_ids.size(1), dtype=torch.bool,
+                         device=segment_ids.device).unsqueeze(0)
+    return ((same_segment & not_padding) | diagonal).long()
+
+
+def packed_forward(model, batch):
+    """Runs a batch of `PackedDataset` rows through a sequence classification
+    model.
+
+    Returns `(loss, logits, labels, example_index)` with one row of logits
+    per packed example; the loss is `None` when the examples have no labels.
+    """
+    input_ids, position_ids, segment_ids, cls_positions, labels, \
+        example_index = batch
+    model_type = model.config.model_type
+    if model_type not in PACKING_MODEL_TYPES:
+        raise ValueError("Sequence packing is not supported for model type "
+                         "{}, use one of {}.".format(model_type,
+                                                     PACKING_MODEL_TYPES))
+    if model_type == "roberta":
+        # RoBERTa positions start after the padding index.
+        position_ids = position_ids + model.config.pad_token_id + 1
+
+    attention_mask = block_diagonal_attention_mask(segment_ids)
+    if model_type in ["deberta", "deberta-v2"]:
+        # DeBERTa embeddings are multiplied by the (batch, seq) padding mask,
+        # only the encoder takes the block-diagonal one.
+        deberta = model.base_model
+        embedding_output = deberta.embeddings(input_ids=input_ids,
+                                              position_ids=position_ids,
+                                              mask=(segment_ids > 0).long())
+        sequence_output = deberta.encoder(embedding_output, attention_mask,
+                                          output_hidden_states=False)[0]
+    else:
+        sequence_output = model.base_model(input_ids,
+                                           attention_mask=attention_mask,
+                                           position_ids=position_ids)[0]
+
+    segments = example_index >= 0
+    rows = torch.arange(input_ids.size(0), device=input_ids.device)
+    rows = rows.unsqueeze(1).expand_as(cls_positions)[segments]
+    cls_hidden = sequence_output[rows, cls_positions[segments]]
+    logits = classification_head_logits(model, cls_hidden)
+
+    labels = labels[segments]
+    loss = None
+    if (labels >= 0).any():
+        loss = F.cross_entropy(logits, labels, ignore_index=-100)
+    return loss, logits, labels, example_index[segments]
+
+
+def packed_predictions(args, model, packed_dataset):
+    """Predicted probabilities of all the packed examples, in the order of
+    the original examples (as `evaluate()` expects).
+
+    Returns `(probs, labels, eval_loss, nb_eval_steps)`, `labels` is `None`
+    for unlabeled splits.
+    """
+    dataloader = DataLoader(packed_dataset,
+                            sampler=SequentialSampler(packed_dataset),
+                            batch_size=args.eval_batch_size)
+    num_examples = len(packed_dataset.examples)
+    probs = None
+    labels = np.full(num_examples, -100, dtype=np.int64)
+    eval_loss, nb_eval_steps = 0.0, 0
+
+    model.eval()
+    for batch in tqdm(dataloader, desc="Evaluating (packed)"):
+        batch = tuple(t.to(args.device) for t in batch)
+        with torch.no_grad():
+            loss, logits, batch_labels, example_index = packed_forward(model,
+                                                                       batch)
+        if loss is not None:
+            eval_loss += loss.item()
+        nb_eval_steps += 1
+
+        batch_probs = F.softmax(logits, dim=-1).cpu().numpy()
+        if probs is None:
+            probs = np.zeros((num_examples, batch_probs.shape[-1]),
+                             dtype=batch_probs.dtype)
+        example_index = example_index.cpu().numpy()
+        probs[example_index] = batch_probs
+        labels[example_index] = batch_labels.cpu().numpy()
+
+        if args.max_eval_steps > 0 and nb_eval_steps >= args.max_eval_steps:
+            break
+
+    if (labels < 0).all():
+        labels = None
+    return probs, labels, eval_loss, nb_eval_steps
+
+
+def benchmark_throughput(model, dataloader, step_fn, num_steps=20):
+    """Real (non-padding) tokens per second of forward + backward passes."""
+    model.train()
+    num_tokens, elapsed = 0, 0.0
+    for step, batch in enumerate(dataloader):
+        if step >= num_steps + 2:
+            break
+        start = time.time()
+        loss, batch_tokens = step_fn(batch)
+        loss.backward()
+        model.zero_grad()
+        if step >= 2:  # Warm-up steps are not timed.
+            elapsed += time.time() - start
+            num_tokens += batch_tokens
+    return num_tokens / elapsed
+
+
+if __name__ == "__main__":
+
+    import argparse
+    from transformers import AutoModelForSequenceClassification, AutoTokenizer
+    from data_processing import data_processors, data_classes
+    from data_processing.packing import PackedDataset
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model_name_or_path", default="bert-base-cased",
+                        type=str)
+    parser.add_argument("--task_name", default="com2sense", type=str)
+    parser.add_argument("--data_dir", default="datasets/com2sense", type=str)
+    parser.add_argument("--max_seq_length", default=128, type=int)
+    parser.add_argument("--batch_size", default=16, type=int)
+    parser.add_argument("--num_steps", default=20, type=int)
+    bench_args = parser.parse_args()
+    bench_args.do_train = True
+
+    logging.basicConfig(level=logging.INFO)
+    tokenizer = AutoTokenizer.from_pretrained(bench_args.model_name_or_path)
+    model = AutoModelForSequenceClassification.from_pretrained(
+        bench_args.model_name_or_path)
+    processor = data_processors[bench_args.task_name](
+        data_dir=bench_args.data_dir)
+    examples = processor.get_train_examples()
+    dataset = data_classes[bench_args.task_name](
+        examples, tokenizer, max_seq_length=bench_args.max_seq_length,
+        args=bench_args)
+    packed_dataset = PackedDataset.from_dataset(dataset)
+
+    def padded_step(batch):
+        outputs = model(batch[0], attention_mask=batch[1], labels=batch[3])
+        return outputs[0], int(batch[1].sum())
+
+    def packed_step(batch):
+        loss = packed_forward(model, batch)[0]
+        return loss, int((batch[2] > 0).sum())
+
+    padded = benchmark_throughput(
+        model, DataLoader(dataset, batch_size=bench_args.batch_size),
+        padded_step, bench_args.num_steps)
+    packed = benchmark_throughput(
+        model, DataLoader(packed_dataset, batch_size=bench_args.batch_size),
+        packed_step, bench_args.num_steps)
+    print("Padded: {:.0f} tokens/sec".format(padded))
+    print("Packed: {:.0f} tokens/sec ({:.2f}x)".format(packed, packed / padded))
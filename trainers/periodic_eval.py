@@ -0,0 +1,227 @@
+import os
+import json
+import time
+import random
+import logging
+from collections import defaultdict
+
+import numpy as np
+import torch
+
+from .train_utils import pairwise_accuracy, evaluate_standard
+from .compile_utils import trim_batch
+
+logger = logging.getLogger(__name__)
+
+
+class InTrainingEvaluator(object):
+    """Cheap periodic evaluation used by `train()`.
+
+    The evaluation split is tokenized once and kept in memory as ready-made
+    batches, so every check is only a forward pass with no dataset
+    rebuilding. Each check appends one line to `eval_history.jsonl` in the
+    output directory, which `sweep.py` reads for pruning. Checks can be
+    triggered every `logging_steps` optimizer steps or every
+    `eval_interval_seconds` of wall-clock time. When
+    `eval_subsample_size` is set, most checks run on a fixed stratified
+    subsample and every `full_eval_every`-th check runs the full split.
+    Early stopping watches `early_stopping_metric` on the full passes.
+    """
+
+    def __init__(self, args, eval_dataset):
+        """
+        Args:
+            args: the training args (see `trainers/args.py`).
+            eval_dataset (torch.utils.data.Dataset): one of the datasets in
+                `data_processing/processors.py`, its `examples` attribute is
+                used for the guids.
+        """
+        self.args = args
+        self.task_name = args.task_name
+        self.batch_size = args.per_gpu_eval_batch_size * max(1, args.n_gpu)
+
+        input_ids, attention_mask, labels = [], [], []
+        for idx in range(len(eval_dataset)):
+            item = eval_dataset[idx]
+            input_ids.append(item[0])
+            attention_mask.append(item[1])
+            labels.append(item[3])
+        input_ids = torch.stack(input_ids)
+        attention_mask = torch.stack(attention_mask)
+
+        # Drops the padding columns no example in the split ever uses (the
+        # last axis, also for `(examples, choices, length)` inputs). A
+        # compiled model gets its bucket lengths instead, see `_make_batches`.
+        max_len = int(attention_mask.sum(dim=-1).max().item())
+        if args.compile_model:
+            max_len = input_ids.size(-1)
+        self.input_ids = input_ids[..., :max_len]
+        self.attention_mask = attention_mask[..., :max_len]
+        self.labels = torch.stack(labels)
+        self.guids = [example.guid for example in eval_dataset.examples]
+
+        # Pairwise accuracy needs both statements of a pair to be adjacent,
+        # which is how the processors emit them.
+        self.has_pairs = self.task_name == "com2sense"
+
+        self.full_batches = self._make_batches(np.arange(len(self.guids)))
+        self.subsample_batches = None
+        if args.eval_subsample_size > 0 \
+            and args.eval_subsample_size < len(self.guids):
+            self.subsample_indices = self._stratified_subsample(
+                args.eval_subsample_size, seed=args.seed)
+            self.subsample_batches = self._make_batches(self.subsample_indices)
+            logger.info("In-training evaluation uses a fixed subsample of %d"
+                        " / %d examples, full pass every %d checks",
+                        len(self.subsample_indices), len(self.guids),
+                        args.full_eval_every)
+
+        self.metric_name = "{}_{}".format(self.task_name,
+                                          args.early_stopping_metric)
+        if args.early_stopping_metric == "pairwise_accuracy" \
+            and not self.has_pairs:
+            self.metric_name = "{}_accuracy".format(self.task_name)
+
+        self.history_file = os.path.join(args.output_dir,
+                                         "eval_history.jsonl")
+        open(self.history_file, "w").close()
+
+        self.num_checks = 0
+        self.last_eval_time = time.time()
+        # Wall-clock time of training only, without the checks.
+        self.start_time = self.last_eval_time
+        self.eval_seconds = 0.0
+        self.best_metric = None
+        self.best_step = None
+        self.bad_checks = 0
+        self.stop_training = False
+
+    def _stratified_subsample(self, size, seed=42):
+        """Samples whole guid groups, stratified by their label pattern."""
+        groups = defaultdict(list)
+        for idx, guid in enumerate(self.guids):
+            groups[guid].append(idx)
+
+        strata = defaultdict(list)
+        for guid, indices in groups.items():
+            pattern = tuple(int(self.labels[i]) for i in indices)
+            strata[pattern].append(guid)
+
+        rng = random.Random(seed)
+        fraction = float(size) / len(self.guids)
+        picked = []
+        for pattern in sorted(strata.keys()):
+            guids = strata[pattern]
+            num_picked = max(1, int(round(len(guids) * fraction)))
+            picked += rng.sample(guids, min(num_picked, len(guids)))
+
+        indices = sorted(i for guid in picked for i in groups[guid])
+        return np.asarray(indices)
+
+    def _make_batches(self, indices):
+        batches = []
+        for start in range(0, len(indices), self.batch_size):
+            chunk = torch.as_tensor(indices[start:start + self.batch_size])
+            input_ids, attention_mask = \
+                self.input_ids[chunk], self.attention_mask[chunk]
+            if self.args.compile_model:
+                input_ids, attention_mask = trim_batch(
+                    (input_ids, attention_mask), self.args.compile_buckets)
+            batches.append((
+                input_ids.to(self.args.device),
+                attention_mask.to(self.args.device),
+                self.labels[chunk].to(self.args.device),
+                chunk.numpy(),
+            ))
+        return batches
+
+    def should_evaluate(self, global_step):
+        """Whether a check is due at this optimizer step."""
+        if self.args.eval_interval_seconds > 0:
+            return (time.time() - self.last_eval_time
+                    >= self.args.eval_interval_seconds)
+        return (self.args.logging_steps > 0
+                and global_step % self.args.logging_steps == 0)
+
+    def evaluate(self, model, global_step):
+        """Runs one check and returns `(results, is_full_pass)`."""
+        self.num_checks += 1
+        full_pass = (self.subsample_batches is None
+                     or self.num_checks % self.args.full_eval_every == 0)
+        batches = self.full_batches if full_pass else self.subsample_batches
+
+        start_time = time.time()
+        train_seconds = start_time - self.start_time - self.eval_seconds
+        was_training = model.training
+        model.eval()
+
+        eval_loss = 0.0
+        preds, indices = [], []
+        # Same keyword arguments as `evaluate()`, which a compiled model was
+        # warmed up with.
+        kwargs = {} if self.args.model_type == "distilbert" \
+                 else {"token_type_ids": None}
+        with torch.no_grad():
+            for input_ids, attention_mask, labels, chunk in batches:
+                outputs = model(input_ids, attention_mask=attention_mask,
+                                labels=labels, **kwargs)
+                eval_loss += outputs[0].mean().item()
+                preds.append(outputs[1].argmax(dim=-1).cpu().numpy())
+                indices.append(chunk)
+
+        if was_training:
+            model.train()
+
+        preds = np.concatenate(preds)
+        indices = np.concatenate(indices)
+        labels = self.labels[indices].numpy()
+
+        results = {"{}_loss".format(self.task_name): eval_loss / len(batches)}
+        acc, prec, recall, f1 = evaluate_standard(
+            preds, labels, self.args.score_average_method)
+        results["{}_accuracy".format(self.task_name)] = acc
+        results["{}_precision".format(self.task_name)] = prec
+        results["{}_recall".format(self.task_name)] = recall
+        results["{}_F1_score".format(self.task_name)] = f1
+        if self.has_pairs:
+            guids = [self.guids[i] for i in indices]
+            results["{}_pairwise_accuracy".format(self.task_name)] = \
+                pairwise_accuracy(guids, preds, labels)
+
+        self.last_eval_time = time.time()
+        self.eval_seconds += self.last_eval_time - start_time
+        logger.info("Step %d: %s evaluation on %d examples took %.2fs, %s"
+                    " = %.4f", global_step,
+                    "full" if full_pass else "subsample", len(indices),
+                    self.last_eval_time - start_time, self.metric_name,
+                    results[self.metric_name])
+
+        with open(self.history_file, "a") as writer:
+            writer.write(json.dumps({
+                "step": global_step,
+                "train_seconds": train_seconds,
+                "full_pass": full_pass,
+                "results": results}) + "\n")
+
+        if full_pass:
+            self._update_early_stopping(results[self.metric_name],
+                                        global_step)
+
+        return results, full_pass
+
+    def _update_early_stopping(self, metric, global_step):
+        if (self.best_metric is None or metric
+            > self.best_metric + self.args.early_stopping_min_delta):
+            self.best_metric = metric
+            self.best_step = global_step
+            self.bad_checks = 0
+            return
+
+        self.bad_checks += 1
+        if (self.args.early_stopping_patience > 0
+            and self.bad_checks >= self.args.early_stopping_patience):
+            logger.info("Early stopping at step %d: %s has not improved on"
+                        " %.4f (step %d) for %d full evaluations",
+                        global_step, self.metric_name, self.best_metric,
+                        self.best_step, self.bad_checks)
+            self.stop_training = True
@@ -0,0 +1,296 @@
+import os
+import time
+import sqlite3
+import hashlib
+import logging
+from collections import OrderedDict
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+from torch.utils.data import DataLoader, SequentialSampler, Subset
+from tqdm import tqdm
+
+from data_processing.feature_cache import tokenizer_fingerprint
+
+logger = logging.getLogger(__name__)
+
+PREDICTION_DB_NAME = "predictions.sqlite"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS predictions (
+    namespace TEXT NOT NULL,
+    key BLOB NOT NULL,
+    logits BLOB NOT NULL,
+    PRIMARY KEY (namespace, key)
+) WITHOUT ROWID;
+"""
+
+# SQLite limits the number of parameters of a statement.
+_QUERY_BATCH = 500
+
+
+def model_fingerprint(model):
+    """A content hash of all the weights of `model` (encoder, head and any
+    adapters or exit heads), i.e. of the checkpoint it was loaded from."""
+    hasher = hashlib.sha1()
+    hasher.update(model.config.model_type.encode("utf-8"))
+    for name, tensor in sorted(model.state_dict().items()):
+        hasher.update(name.encode("utf-8"))
+        hasher.update(tensor.detach().cpu().contiguous().numpy().tobytes())
+    return hasher.hexdigest()
+
+
+def text_key(text):
+    """Hash of the exact text: byte-level BPE tokenizers (RoBERTa) encode
+    whitespace runs and Unicode forms differently, so no normalization is
+    safe across tokenizers."""
+    return hashlib.sha1(text.encode("utf-8")).digest()
+
+
+def cache_namespace(model, tokenizer, max_seq_length):
+    """`{checkpoint hash}-{tokenizer hash}-{max_seq_length}`: the logits of
+    a text only depend on these (the truncation length included)."""
+    return "{}-{}-{}".format(model_fingerprint(model)[:16],
+                             tokenizer_fingerprint(tokenizer)[:16],
+                             max_seq_length)
+
+
+class PredictionCache(object):
+    """Logits by `(namespace, text key)` in an SQLite file, behind an
+    in-memory LRU of the `capacity` most recently used entries.
+
+    The LRU lives as long as the cache object, so one per database is kept
+    per process (see `open_prediction_cache`) and repeated evaluations
+    (in-training, `--eval_all_checkpoints`, analysis) share it.
+    """
+
+    def __init__(self, path, capacity=100000):
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        self.path = path
+        self.capacity = capacity
+        self.lru = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        # Sweep trials share the file, WAL lets readers run alongside.
+        self.conn = sqlite3.connect(path, timeout=60)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.executescript(_SCHEMA)
+
+    def close(self):
+        self.conn.close()
+
+    def _remember(self, lru_key, logits):
+        self.lru[lru_key] = logits
+        self.lru.move_to_end(lru_key)
+        while len(self.lru) > self.capacity:
+            self.lru.popitem(last=False)
+
+    def get_many(self, namespace, keys):
+        """Cached logits of every key, `None` where there are none."""
+        results = [None] * len(keys)
+        missing = {}
+        for i, key in enumerate(keys):
+            lru_key = (namespace, key)
+            if lru_key in self.lru:
+                self.lru.move_to_end(lru_key)
+                results[i] = self.lru[lru_key]
+            else:
+                missing.setdefault(key, []).append(i)
+
+        missing_keys = list(missing)
+        for start in range(0, len(missing_keys), _QUERY_BATCH):
+            chunk = missing_keys[start:start + _QUERY_BATCH]
+            rows = self.conn.execute(
+                "SELECT key, logits FROM predictions WHERE namespace = ? AND "
+                "key IN ({})".format(", ".join("?" * len(chunk))),
+                [namespace] + chunk).fetchall()
+            for key, blob in rows:
+                logits = np.frombuffer(blob, dtype=np.float32)
+                self._remember((namespace, key), logits)
+                for i in missing[key]:
+                    results[i] = logits
+
+        num_hits = sum(result is not None for result in results)
+        self.hits += num_hits
+        self.misses += len(keys) - num_hits
+        return results
+
+    def put_many(self, namespace, keys, logits):
+        logits = np.asarray(logits, dtype=np.float32)
+        for key, row in zip(keys, logits):
+            self._remember((namespace, key), row)
+        with self.conn:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO predictions (namespace, key, logits) "
+                "VALUES (?, ?, ?)",
+                [(namespace, key, row.tobytes())
+                 for key, row in zip(keys, logits)])
+
+    @property
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+
+_caches = {}
+
+
+def default_prediction_db(args):
+    """One database per `output_root`, like the results database."""
+    if getattr(args, "prediction_cache_db", None):
+        return args.prediction_cache_db
+    root = args.output_root if args.output_root is not None \
+           else args.output_dir
+    return os.path.join(root, PREDICTION_DB_NAME)
+
+
+def open_prediction_cache(args):
+    path = os.path.abspath(default_prediction_db(args))
+    if path not in _caches:
+        _caches[path] = PredictionCache(path, args.prediction_cache_size)
+    return _caches[path]
+
+
+def cache_lookup(cache, namespace, texts):
+    """`(keys, cached, to_run)`: the keys of `texts`, their cached logits
+    (`None` for misses) and the indices of the misses to run through the
+    model. A text repeated among `texts` only runs once."""
+    keys = [text_key(text) for text in texts]
+    cached = cache.get_many(namespace, keys)
+    first_miss = OrderedDict()
+    for i, logits in enumerate(cached):
+        if logits is None:
+            first_miss.setdefault(keys[i], i)
+    return keys, cached, list(first_miss.values())
+
+
+def cache_store(cache, namespace, keys, cached, to_run, new_logits):
+    """Adds the logits of the `to_run` texts to the cache and returns the
+    logits of all the texts, the misses filled in."""
+    if to_run:
+        cache.put_many(namespace, [keys[i] for i in to_run], new_logits)
+        by_key = dict(zip((keys[i] for i in to_run), new_logits))
+        cached = [by_key[key] if logits is None else logits
+                  for key, logits in zip(keys, cached)]
+    return np.stack(cached)
+
+
+@torch.no_grad()
+def dataset_logits(model, dataset, indices, batch_size, device):
+    """Logits of the examples of `dataset` at `indices`."""
+    subset = Subset(dataset, indices)
+    dataloader = DataLoader(subset, sampler=SequentialSampler(subset),
+                            batch_size=batch_size)
+    model.eval()
+    logits = []
+    for batch in tqdm(dataloader, desc="Evaluating (cache misses)"):
+        outputs = model(input_ids=batch[0].to(device),
+                        attention_mask=batch[1].to(device))
+        logits.append(outputs[0].float().cpu().numpy())
+    return np.concatenate(logits)
+
+
+def log_cache_stats(cache, cached, to_run):
+    num_misses = sum(logits is None for logits in cached)
+    logger.info("  Prediction cache: %d hits, %d misses (%d run), "
+                "hit rate %.1f%% (%.1f%% this process)",
+                len(cached) - num_misses, num_misses, len(to_run),
+                100.0 * (len(cached) - num_misses) / max(1, len(cached)),
+                100.0 * cache.hit_rate)
+
+
+def cached_logits(model, dataset, cache, namespace, batch_size, device,
+                  num_examples=None):
+    """Logits of the first `num_examples` (default all) examples of
+    `dataset`; only the examples whose text is not in `cache` are run
+    through the model (and then added to it)."""
+    examples = dataset.examples[:num_examples]
+    keys, cached, to_run = cache_lookup(
+        cache, namespace, [example.text for example in examples])
+    log_cache_stats(cache, cached, to_run)
+    new_logits = dataset_logits(model, dataset, to_run, batch_size, device) \
+                 if to_run else None
+    return cache_store(cache, namespace, keys, cached, to_run, new_logits)
+
+
+def cached_predictions(args, model, tokenizer, dataset):
+    """Predicted probabilities of `dataset` through the prediction cache.
+
+    Returns `(probs, labels, eval_loss, nb_eval_steps)` like
+    `packed_predictions`, `labels` is `None` for unlabeled splits.
+    """
+    num_examples = None
+    if args.max_eval_steps > 0:
+        num_examples = args.max_eval_steps * args.eval_batch_size
+    cache = open_prediction_cache(args)
+    namespace = cache_namespace(model, tokenizer, dataset.max_seq_length)
+    logits = torch.from_numpy(cached_logits(
+        model, dataset, cache, namespace, args.eval_batch_size, args.device,
+        num_examples))
+    probs = F.softmax(logits, dim=-1).numpy()
+
+    labels = np.array([-100 if example.label is None else int(example.label)
+                       for example in dataset.examples[:len(probs)]],
+                      dtype=np.int64)
+    if (labels < 0).all():
+        return probs, None, 0.0, 1
+    # The mean over all examples, as a single evaluation step.
+    eval_loss = F.cross_entropy(logits, torch.from_numpy(labels)).item()
+    return probs, labels, eval_loss, 1
+
+
+if __name__ == "__main__":
+
+    import argparse
+    from transformers import AutoModelForSequenceClassification, \
+        AutoTokenizer
+    from data_processing import data_processors, data_classes
+
+    parser = argparse.ArgumentParser(
+        description="Scores a split through the prediction cache and "
+                    "reports the hit rate.")
+    parser.add_argument("--db", required=True, type=str)
+    parser.add_argument("--model_name_or_path", required=True, type=str)
+    parser.add_argument("--task_name", default="com2sense", type=str)
+    parser.add_argument("--data_dir", default="datasets/com2sense", type=str)
+    parser.add_argument("--split", default="dev", type=str)
+    parser.add_argument("--max_seq_length", default=128, type=int)
+    parser.add_argument("--batch_size", default=32, type=int)
+    parser.add_argument("--repeats", default=2, type=int,
+                        help="Passes over the split, the first fills the "
+                             "cache.")
+    parser.add_argument("--stats", action="store_true",
+                        help="Only print the entries per namespace.")
+    cli_args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+
+    cache = PredictionCache(cli_args.db)
+    if cli_args.stats:
+        for namespace, count in cache.conn.execute(
+                "SELECT namespace, COUNT(*) FROM predictions "
+                "GROUP BY namespace"):
+            print("{}  {} entries".format(namespace, count))
+        print("{:.1f} MB".format(os.path.getsize(cli_args.db) / 2 ** 20))
+        raise SystemExit(0)
+
+    tokenizer = AutoTokenizer.from_pretrained(cli_args.model_name_or_path)
+    model = AutoModelForSequenceClassification.from_pretrained(
+        cli_args.model_name_or_path)
+    processor = data_processors[cli_args.task_name](
+        data_dir=cli_args.data_dir)
+    examples = processor._read_data(split=cli_args.split)
+    dataset_args = argparse.Namespace(do_train=False)
+    dataset = data_classes[cli_args.task_name](
+        examples, tokenizer, max_seq_length=cli_args.max_seq_length,
+        args=dataset_args)
+
+    namespace = cache_namespace(model, tokenizer, cli_args.max_seq_length)
+    for repeat in range(cli_args.repeats):
+        start = time.time()
+        cached_logits(model, dataset, cache, namespace, cli_args.batch_size,
+                      torch.device("cpu"))
+        print("pass {}: {:.2f}s, hit rate so far {:.1f}%".format(
+            repeat, time.time() - start, 100.0 * cache.hit_rate))
+    cache.close()
@@ -0,0 +1,291 @@
+import os
+import json
+import time
+import sqlite3
+import logging
+import argparse
+
+logger = logging.getLogger(__name__)
+
+RESULTS_DB_NAME = "results.sqlite"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    run_id INTEGER PRIMARY KEY,
+    output_dir TEXT NOT NULL UNIQUE,
+    task_name TEXT,
+    model_name_or_path TEXT,
+    config TEXT,
+    created REAL
+);
+CREATE TABLE IF NOT EXISTS checkpoints (
+    checkpoint_id INTEGER PRIMARY KEY,
+    run_id INTEGER NOT NULL REFERENCES runs(run_id),
+    path TEXT NOT NULL UNIQUE,
+    step INTEGER,
+    weights_file TEXT,
+    created REAL
+);
+CREATE TABLE IF NOT EXISTS results (
+    checkpoint_id INTEGER NOT NULL REFERENCES checkpoints(checkpoint_id),
+    split TEXT NOT NULL,
+    metric TEXT NOT NULL,
+    value REAL,
+    created REAL,
+    PRIMARY KEY (checkpoint_id, split, metric)
+);
+CREATE INDEX IF NOT EXISTS checkpoints_by_run ON checkpoints (run_id, step);
+CREATE INDEX IF NOT EXISTS results_by_metric ON results (metric, split, value);
+"""
+
+
+def default_results_db(args):
+    """One database per `output_root` (shared by the runs and sweep trials
+    under it), or per `output_dir` without one."""
+    if getattr(args, "results_db", None):
+        return args.results_db
+    root = args.output_root if args.output_root is not None \
+           else args.output_dir
+    return os.path.join(root, RESULTS_DB_NAME)
+
+
+def _jsonable_config(args):
+    config = {}
+    for key, value in sorted(vars(args).items()):
+        if value is None or isinstance(value, (bool, int, float, str)):
+            config[key] = value
+        elif isinstance(value, (list, tuple)):
+            config[key] = list(value)
+        else:
+            config[key] = str(value)
+    return config
+
+
+def _step_from_path(path):
+    suffix = os.path.basename(os.path.normpath(path)).split("-")[-1]
+    return int(suffix) if suffix.isdigit() else None
+
+
+class ResultsStore(object):
+    """Runs, their checkpoints (the manifest) and every evaluation metric,
+    in an embedded SQLite database.
+
+    Metrics are stored without the task prefix of `evaluate()`, e.g.
+    `com2sense_pairwise_accuracy` is `pairwise_accuracy` of a com2sense run.
+    """
+
+    def __init__(self, path):
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        self.path = path
+        # Sweep trials write concurrently, WAL lets readers run alongside.
+        self.conn = sqlite3.connect(path, timeout=60)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.executescript(_SCHEMA)
+
+    def close(self):
+        self.conn.close()
+
+    def run_id(self, args):
+        """Id of the run writing into `args.output_dir`, recording its
+        config. Evaluation-only invocations on the same directory share the
+        run, the config is updated by training invocations."""
+        output_dir = os.path.abspath(args.output_dir)
+        row = self.conn.execute("SELECT run_id FROM runs WHERE output_dir = ?",
+                                (output_dir,)).fetchone()
+        config = json.dumps(_jsonable_config(args))
+        with self.conn:
+            if row is None:
+                cursor = self.conn.execute(
+                    "INSERT INTO runs (output_dir, task_name, "
+                    "model_name_or_path, config, created) "
+                    "VALUES (?, ?, ?, ?, ?)",
+                    (output_dir, args.task_name, args.model_name_or_path,
+                     config, time.time()))
+                return cursor.lastrowid
+            if args.do_train:
+                self.conn.execute(
+                    "UPDATE runs SET task_name = ?, model_name_or_path = ?, "
+                    "config = ? WHERE run_id = ?",
+                    (args.task_name, args.model_name_or_path, config, row[0]))
+        return row[0]
+
+    def add_checkpoint(self, run_id, path, weights_file=None, step=None):
+        """Adds (or refreshes) a checkpoint directory in the manifest."""
+        path = os.path.abspath(path)
+        if step is None:
+            step = _step_from_path(path)
+        with self.conn:
+            self.conn.execute(
+                "INSERT INTO checkpoints (run_id, path, step, weights_file, "
+                "created) VALUES (?, ?, ?, ?, ?) ON CONFLICT(path) DO UPDATE "
+                "SET run_id = excluded.run_id, step = excluded.step, "
+                "weights_file = COALESCE(excluded.weights_file, weights_file), "
+                "created = excluded.created",
+                (run_id, path, step, weights_file, time.time()))
+        return self.conn.execute(
+            "SELECT checkpoint_id FROM checkpoints WHERE path = ?",
+            (path,)).fetchone()[0]
+
+    def checkpoints(self, run_id, steps=None):
+        """Checkpoint paths of a run from the manifest, by step, optionally
+        only the given steps. Entries whose directory was deleted are
+        skipped."""
+        rows = self.conn.execute(
+            "SELECT path, step FROM checkpoints WHERE run_id = ? "
+            "ORDER BY step", (run_id,)).fetchall()
+        if steps is not None:
+            steps = set(int(step) for step in steps)
+            rows = [row for row in rows if row[1] in steps]
+        return [path for path, _ in rows if os.path.isdir(path)]
+
+    def add_results(self, run_id, checkpoint_path, split, results,
+                    task_name=None):
+        """Records the `results` dict of `evaluate()` for a checkpoint."""
+        checkpoint_id = self.add_checkpoint(run_id, checkpoint_path)
+        prefix = "{}_".format(task_name) if task_name else ""
+        now = time.time()
+        rows = []
+        for key, value in results.items():
+            metric = key[len(prefix):] if key.startswith(prefix) else key
+            rows.append((checkpoint_id, split, metric, float(value), now))
+        with self.conn:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO results (checkpoint_id, split, metric, "
+                "value, created) VALUES (?, ?, ?, ?, ?)", rows)
+
+    def best_checkpoints(self, metric="pairwise_accuracy", split="dev",
+                         task_name=None, run_id=None, limit=1,
+                         lower_is_better=False):
+        """`(path, step, value, output_dir)` of the best checkpoints by a
+        metric, e.g. the best checkpoint by dev pairwise accuracy."""
+        query = ("SELECT c.path, c.step, r.value, runs.output_dir "
+                 "FROM results r JOIN checkpoints c USING (checkpoint_id) "
+                 "JOIN runs USING (run_id) WHERE r.metric = ? AND r.split = ?")
+        params = [metric, split]
+        if task_name is not None:
+            query += " AND runs.task_name = ?"
+            params.append(task_name)
+        if run_id is not None:
+            query += " AND c.run_id = ?"
+            params.append(run_id)
+        query += " ORDER BY r.value {} LIMIT ?".format(
+            "ASC" if lower_is_better else "DESC")
+        params.append(limit)
+        return self.conn.execute(query, params).fetchall()
+
+    def metrics(self, checkpoint_path, split):
+        rows = self.conn.execute(
+            "SELECT r.metric, r.value FROM results r JOIN checkpoints c "
+            "USING (checkpoint_id) WHERE c.path = ? AND r.split = ?",
+            (os.path.abspath(checkpoint_path), split)).fetchall()
+        return dict(rows)
+
+
+def register_run(args):
+    """Resolves `args.results_db` and returns the id of the current run."""
+    args.results_db = default_results_db(args)
+    store = ResultsStore(args.results_db)
+    try:
+        return store.run_id(args)
+    finally:
+        store.close()
+
+
+def record_checkpoint(args, path, weights_file=None):
+    store = ResultsStore(args.results_db)
+    try:
+        store.add_checkpoint(args.run_id, path, weights_file)
+    finally:
+        store.close()
+
+
+def record_results(args, path, split, results):
+    store = ResultsStore(args.results_db)
+    try:
+        store.add_results(args.run_id, path, split, results, args.task_name)
+    finally:
+        store.close()
+
+
+def manifest_checkpoints(args, steps=None):
+    store = ResultsStore(args.results_db)
+    try:
+        return store.checkpoints(args.run_id, steps)
+    finally:
+        store.close()
+
+
+def import_text_results(store, output_root):
+    """Backfills the store from the `eval_results_split_*.txt` files of
+    runs from before it existed (results already stored are overwritten
+    with the same values). Returns the number of imported files."""
+    num_files = 0
+    for directory, _, files in os.walk(output_root):
+        for name in files:
+            if not (name.startswith("eval_results_split_")
+                    and name.endswith(".txt")):
+                continue
+            split = name[len("eval_results_split_"):-len(".txt")]
+            results = {}
+            with open(os.path.join(directory, name)) as f:
+                for line in f:
+                    key, _, value = line.partition(" = ")
+                    try:
+                        results[key.strip()] = float(
+                            value.strip().replace("tensor(", "").rstrip(")"))
+                    except ValueError:
+                        continue
+            # Checkpoints live in `<output_dir>/checkpoint-<step>`.
+            is_checkpoint = _step_from_path(directory) is not None
+            run_dir = os.path.dirname(directory) if is_checkpoint \
+                      else directory
+            task_name = next((key.rsplit("_accuracy", 1)[0] for key in results
+                              if key.endswith("_accuracy")
+                              and "pairwise" not in key), None)
+            run_args = argparse.Namespace(output_dir=run_dir,
+                                          task_name=task_name,
+                                          model_name_or_path=None,
+                                          do_train=False)
+            run_id = store.run_id(run_args)
+            store.add_results(run_id, directory, split, results, task_name)
+            num_files += 1
+    return num_files
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--db", default=os.path.join("outputs", RESULTS_DB_NAME),
+                        type=str, help="The results database.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    best_parser = subparsers.add_parser("best", help="Best checkpoints.")
+    best_parser.add_argument("--metric", default="pairwise_accuracy", type=str)
+    best_parser.add_argument("--split", default="dev", type=str)
+    best_parser.add_argument("--task_name", default=None, type=str)
+    best_parser.add_argument("--limit", default=5, type=int)
+    best_parser.add_argument("--lower_is_better", action="store_true")
+    show_parser = subparsers.add_parser("show",
+                                        help="All metrics of a checkpoint.")
+    show_parser.add_argument("checkpoint", type=str)
+    show_parser.add_argument("--split", default="dev", type=str)
+    import_parser = subparsers.add_parser(
+        "import", help="Import eval_results_split_*.txt files.")
+    import_parser.add_argument("output_root", type=str)
+    cli_args = parser.parse_args()
+
+    store = ResultsStore(cli_args.db)
+    if cli_args.command == "best":
+        for path, step, value, _ in store.best_checkpoints(
+                cli_args.metric, cli_args.split, cli_args.task_name,
+                limit=cli_args.limit,
+                lower_is_better=cli_args.lower_is_better):
+            print("{:.4f}  step {}  {}".format(value, step, path))
+    elif cli_args.command == "show":
+        for metric, value in sorted(store.metrics(cli_args.checkpoint,
+                                                  cli_args.split).items()):
+            print("{} = {}".format(metric, value))
+    else:
+        print("Imported {} result files".format(
+            import_text_results(store, cli_args.output_root)))
+    store.close()
@@ -0,0 +1,154 @@
+"""Token length statistics of a split and a `max_seq_length` covering a
+quantile of them.
+
+    python3 -m trainers.seq_length --tokenizer_name bert-base-cased \
+        --task_name semeval --data_dir datasets/semeval_2020_task4 \
+        --splits train dev --quantile 0.999 \
+        --feature_cache_dir outputs/feature_cache
+"""
+import logging
+import argparse
+
+import numpy as np
+
+from data_processing import data_processors, MULTIPLE_CHOICE_TASKS
+from data_processing.feature_cache import load_or_build_features, \
+    special_tokens_layout, tokenize_texts
+
+logger = logging.getLogger(__name__)
+
+# Lengths are rounded up to a multiple of this, friendlier to the kernels.
+LENGTH_MULTIPLE = 8
+
+
+def text_lengths(texts, tokenizer, cache_dir=None, num_workers=1):
+    """Untruncated token counts (special tokens included) of `texts`, read
+    from the feature cache when `cache_dir` is set."""
+    if cache_dir is not None:
+        features = load_or_build_features(texts, tokenizer, cache_dir,
+                                          num_workers)
+    else:
+        features = tokenize_texts(texts, tokenizer)
+    return np.asarray(features.lengths)
+
+
+def example_lengths(examples, tokenizer, multiple_choice=False,
+                    cache_dir=None, num_workers=1):
+    """Untruncated lengths of the model inputs of `examples`: one per
+    statement, or one per (statement, choice) pair of multiple-choice
+    examples."""
+    if not multiple_choice:
+        return text_lengths([example.text for example in examples],
+                            tokenizer, cache_dir, num_workers)
+    texts = sorted(set(example.statement for example in examples)
+                   | set(choice for example in examples
+                         for choice in example.choices))
+    prefix_len, suffix_len = special_tokens_layout(tokenizer)
+    content = dict(zip(texts, text_lengths(texts, tokenizer, cache_dir,
+                                           num_workers)
+                       - prefix_len - suffix_len))
+    num_special = tokenizer.num_special_tokens_to_add(pair=True)
+    return np.array([content[example.statement] + content[choice]
+                     + num_special for example in examples
+                     for choice in example.choices])
+
+
+def quantile_length(lengths, quantile):
+    """The smallest length at least `quantile` of `lengths` fit in."""
+    lengths = np.sort(lengths)
+    # Rounded first, so that e.g. 99.9 / 100 and 0.999 give the same index.
+    rank = int(np.ceil(round(quantile * len(lengths), 9)))
+    return int(lengths[max(0, rank - 1)])
+
+
+def choose_max_seq_length(lengths, quantile=0.999, limit=None):
+    """The quantile length rounded up to `LENGTH_MULTIPLE`, at most
+    `limit` (the model's maximum positions)."""
+    length = -(-quantile_length(lengths, quantile) // LENGTH_MULTIPLE) \
+             * LENGTH_MULTIPLE
+    return length if limit is None else min(length, limit)
+
+
+def model_length_limit(config, tokenizer):
+    """The longest input the model takes, None if unbounded."""
+    limits = [getattr(config, "max_position_embeddings", None)]
+    # Tokenizers without a limit report a huge sentinel value.
+    if tokenizer.model_max_length < 1e6:
+        limits.append(tokenizer.model_max_length)
+    limits = [limit for limit in limits if limit]
+    return min(limits) if limits else None
+
+
+def length_report(lengths, percentiles=(50, 90, 95, 99, 99.9), bins=12,
+                  width=40):
+    """Lines of a text histogram and of the percentiles of `lengths`."""
+    lengths = np.asarray(lengths)
+    lines = ["{} inputs, lengths {} to {}, mean {:.1f}".format(
+        len(lengths), lengths.min(), lengths.max(), lengths.mean())]
+    edges = np.unique(np.linspace(lengths.min(), lengths.max() + 1,
+                                  bins + 1).astype(np.int64))
+    counts, _ = np.histogram(lengths, bins=edges)
+    for low, high, count in zip(edges[:-1], edges[1:], counts):
+        lines.append("  {:>5}-{:<5} {:>8}  {}".format(
+            low, high - 1, count,
+            "#" * int(round(width * count / float(counts.max())))))
+    lines.append("  percentiles: " + ", ".join(
+        "p{:g} {}".format(p, quantile_length(lengths, p / 100.0))
+        for p in percentiles))
+    return lines
+
+
+def autotune_max_seq_length(args, tokenizer, limit=None):
+    """`max_seq_length` covering `args.max_seq_length_quantile` of the
+    inputs of `args.max_seq_length_split`, logging the length statistics
+    and how many inputs it truncates."""
+    processor = data_processors[args.task_name](data_dir=args.data_dir,
+                                                args=args)
+    split = args.max_seq_length_split
+    examples = processor._read_data(split="dev" if split == "val"
+                                    else split)
+    lengths = example_lengths(examples, tokenizer,
+                              args.task_name in MULTIPLE_CHOICE_TASKS,
+                              args.feature_cache_dir,
+                              args.tokenization_workers)
+    max_seq_length = choose_max_seq_length(
+        lengths, args.max_seq_length_quantile, limit)
+    logger.info("Token lengths of %s %s:\n%s", args.task_name, split,
+                "\n".join(length_report(lengths)))
+    logger.info("max_seq_length %d covers the %g quantile, %d of %d inputs "
+                "(%.3f%%) are truncated", max_seq_length,
+                args.max_seq_length_quantile,
+                int((lengths > max_seq_length).sum()), len(lengths),
+                100.0 * (lengths > max_seq_length).mean())
+    return max_seq_length
+
+
+if __name__ == "__main__":
+
+    from transformers import AutoTokenizer
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--tokenizer_name", default="bert-base-cased",
+                        type=str)
+    parser.add_argument("--task_name", default="com2sense", type=str)
+    parser.add_argument("--data_dir", default="datasets/com2sense", type=str)
+    parser.add_argument("--splits", default=["train"], nargs="+")
+    parser.add_argument("--quantile", default=0.999, type=float)
+    parser.add_argument("--feature_cache_dir", default=None, type=str)
+    cli_args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    tokenizer = AutoTokenizer.from_pretrained(cli_args.tokenizer_name)
+    processor = data_processors[cli_args.task_name](
+        data_dir=cli_args.data_dir)
+    for split in cli_args.splits:
+        lengths = example_lengths(
+            processor._read_data(split=split), tokenizer,
+            cli_args.task_name in MULTIPLE_CHOICE_TASKS,
+            cli_args.feature_cache_dir)
+        max_seq_length = choose_max_seq_length(lengths, cli_args.quantile)
+        print("{}:".format(split))
+        print("\n".join(length_report(lengths)))
+        print("  max_seq_length {} covers the {:g} quantile, {} inputs "
+              "truncated\n".format(max_seq_length, cli_args.quantile,
+                                   int((lengths > max_seq_length).sum())))
@@ -0,0 +1,244 @@
+import os
+import json
+import logging
+import itertools
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Categorical example fields that define slices, where the task has them.
+SLICE_FIELDS = ["domain", "scenario", "numeracy"]
+
+# Boolean slices defined by a function of an example, evaluated on the saved
+# predictions; add entries here (or with `--predicates` of the command line)
+# to get new slices without running the model again.
+PREDICATES = {
+    "long_statement": lambda example: len(example.text.split()) > 20,
+    "has_digit": lambda example: any(c.isdigit() for c in example.text),
+}
+
+_METRICS = ["size", "accuracy", "precision", "recall", "F1_score",
+            "num_pairs", "pairwise_accuracy"]
+
+
+class SliceIndex(object):
+    """Integer codes of every slice field (and predicate) per example, so
+    that the metrics of all the slices of a field, or of an intersection of
+    fields, come from a single `np.bincount` over the predictions."""
+
+    def __init__(self, examples, fields=None, predicates=None):
+        self.examples = examples
+        self.codes = {}
+        self.categories = {}
+        for field in SLICE_FIELDS if fields is None else fields:
+            values = [getattr(example, field, None) for example in examples]
+            if all(value is None for value in values):
+                continue  # Not a field of this task.
+            self.add_field(field, values)
+        for name, predicate in (PREDICATES if predicates is None
+                                else predicates).items():
+            self.add_predicate(name, predicate)
+
+    def add_field(self, name, values):
+        categories, codes = np.unique(np.array([str(v) for v in values]),
+                                      return_inverse=True)
+        self.categories[name] = list(categories)
+        self.codes[name] = codes.astype(np.int64)
+
+    def add_predicate(self, name, predicate):
+        """Adds the slices `name=True` and `name=False` of a function of an
+        example."""
+        self.add_field(name, [bool(predicate(example))
+                              for example in self.examples])
+
+    def combined_codes(self, names):
+        """Codes of the intersections of the fields `names`, and the
+        category names of each code."""
+        codes = np.zeros(len(self.examples), dtype=np.int64)
+        for name in names:
+            codes = codes * len(self.categories[name]) + self.codes[name]
+        labels = [" & ".join("{}={}".format(name, value)
+                             for name, value in zip(names, values))
+                  for values in itertools.product(
+                      *[self.categories[name] for name in names])]
+        return codes, labels
+
+
+def pair_index(guids):
+    """Index of the complementary pair of every example (pairs are adjacent
+    examples sharing a guid, as `pairwise_accuracy` assumes), or -1."""
+    guids = np.asarray(guids)
+    pairs = np.full(len(guids), -1, dtype=np.int64)
+    first = np.arange(0, len(guids) - 1, 2)
+    paired = first[guids[first] == guids[first + 1]]
+    pairs[paired] = np.arange(len(paired))
+    pairs[paired + 1] = np.arange(len(paired))
+    return pairs
+
+
+def grouped_metrics(codes, num_groups, preds, labels, pairs=None):
+    """Metrics of every group of `codes` (0 .. num_groups - 1) at once.
+
+    A pair counts towards a group when both of its statements are in it.
+    """
+    def count(weights=None):
+        return np.bincount(codes, weights=weights, minlength=num_groups)
+
+    correct = (preds == labels).astype(np.float64)
+    size = count()
+    tp = count((preds == 1) & (labels == 1))
+    fp = count((preds == 1) & (labels == 0))
+    fn = count((preds == 0) & (labels == 1))
+    with np.errstate(divide="ignore", invalid="ignore"):
+        metrics = {
+            "size": size,
+            "accuracy": count(correct) / size,
+            "precision": tp / (tp + fp),
+            "recall": tp / (tp + fn),
+        }
+        metrics["F1_score"] = (2 * metrics["precision"] * metrics["recall"]
+                               / (metrics["precision"] + metrics["recall"]))
+
+        if pairs is not None and (pairs >= 0).any():
+            num_pairs = pairs.max() + 1
+            first = np.full(num_pairs, -1, dtype=np.int64)
+            second = np.full(num_pairs, -1, dtype=np.int64)
+            members = np.nonzero(pairs >= 0)[0]
+            # The first member of a pair comes first in the examples.
+            second[pairs[members]] = members
+            first[pairs[members[::-1]]] = members[::-1]
+            same_group = codes[first] == codes[second]
+            pair_correct = (correct[first] * correct[second])[same_group]
+            pair_codes = codes[first][same_group]
+            metrics["num_pairs"] = np.bincount(pair_codes,
+                                               minlength=num_groups)
+            metrics["pairwise_accuracy"] = np.bincount(
+                pair_codes, weights=pair_correct,
+                minlength=num_groups) / metrics["num_pairs"]
+    return metrics
+
+
+def slice_metrics(index, preds, labels, guids=None, max_order=2,
+                  min_size=1):
+    """Metrics of the whole split, of every slice, and of the intersections
+    of up to `max_order` slice fields.
+
+    Returns a list of `{"slice": ..., metric: value}` rows.
+    """
+    preds = np.asarray(preds)
+    labels = np.asarray(labels)
+    pairs = pair_index(guids) if guids is not None else None
+    rows = []
+
+    names = sorted(index.codes)
+    groupings = [()]
+    for order in range(1, max_order + 1):
+        groupings += list(itertools.combinations(names, order))
+    for grouping in groupings:
+        if grouping:
+            codes, slice_names = index.combined_codes(grouping)
+        else:
+            codes, slice_names = np.zeros(len(preds), dtype=np.int64), ["all"]
+        metrics = grouped_metrics(codes, len(slice_names), preds, labels,
+                                  pairs)
+        for code, slice_name in enumerate(slice_names):
+            if metrics["size"][code] < min_size:
+                continue
+            row = {"slice": slice_name}
+            for metric in _METRICS:
+                if metric in metrics:
+                    value = metrics[metric][code]
+                    if metric in ("size", "num_pairs"):
+                        row[metric] = int(value)
+                    else:
+                        row[metric] = None if np.isnan(value) else float(value)
+            rows.append(row)
+    return rows
+
+
+def log_slice_metrics(rows, max_rows=None):
+    logger.info("  %-50s %6s %8s %8s", "slice", "size", "accuracy",
+                "pairwise")
+    for row in rows[:max_rows]:
+        pairwise = row.get("pairwise_accuracy")
+        logger.info("  %-50s %6d %8.4f %8s", row["slice"][:50],
+                    row["size"], row["accuracy"],
+                    "-" if pairwise is None else "{:.4f}".format(pairwise))
+
+
+def save_predictions(path, preds, labels, guids):
+    """The predictions that slice metrics (and new predicates) are computed
+    from, without running the model again."""
+    np.savez(path, preds=np.asarray(preds), labels=np.asarray(labels),
+             guids=np.asarray(guids))
+
+
+def evaluate_slices(args, examples, preds, labels, guids, output_dir,
+                    data_split):
+    """Slice metrics of an evaluated split, saved with its predictions into
+    `output_dir`. Without `guids` there is no pairwise accuracy."""
+    examples = examples[:len(preds)]
+    index = SliceIndex(examples)
+    rows = slice_metrics(index, preds, labels, guids, args.slice_max_order,
+                         args.slice_min_size)
+    if guids is not None:
+        save_predictions(os.path.join(
+            output_dir, "predictions_{}.npz".format(data_split)),
+            preds, labels, guids)
+    with open(os.path.join(output_dir,
+                           "slice_metrics_{}.json".format(data_split)),
+              "w") as f:
+        json.dump(rows, f, indent=2)
+    logger.info("***** Slice metrics on split: %s (%d slices) *****",
+                data_split, len(rows))
+    log_slice_metrics(rows)
+    return rows
+
+
+if __name__ == "__main__":
+
+    import time
+    import argparse
+    from data_processing import data_processors
+
+    parser = argparse.ArgumentParser(
+        description="Slice metrics of saved predictions, with optional new "
+                    "predicates, without running the model.")
+    parser.add_argument("--predictions", required=True, type=str,
+                        help="A predictions_<split>.npz of an evaluation.")
+    parser.add_argument("--task_name", default="com2sense", type=str)
+    parser.add_argument("--data_dir", default="datasets/com2sense", type=str)
+    parser.add_argument("--split", default="dev", type=str)
+    parser.add_argument("--max_order", default=2, type=int)
+    parser.add_argument("--min_size", default=20, type=int)
+    parser.add_argument(
+        "--predicates", default=[], nargs="*",
+        help="name=expression slices, the expression is evaluated with "
+             "`example` in scope, e.g. 'negation=\" not \" in example.text'.")
+    parser.add_argument("--output_file", default=None, type=str)
+    cli_args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+
+    saved = np.load(cli_args.predictions)
+    processor = data_processors[cli_args.task_name](
+        data_dir=cli_args.data_dir)
+    examples = processor._read_data(split=cli_args.split)
+    examples = examples[:len(saved["preds"])]
+
+    predicates = dict(PREDICATES)
+    for definition in cli_args.predicates:
+        name, expression = definition.split("=", 1)
+        predicates[name] = (lambda expression: lambda example: eval(
+            expression, {}, {"example": example}))(expression)
+
+    start = time.time()
+    index = SliceIndex(examples, predicates=predicates)
+    rows = slice_metrics(index, saved["preds"], saved["labels"],
+                         saved["guids"], cli_args.max_order,
+                         cli_args.min_size)
+    logger.info("%d slices in %.3fs", len(rows), time.time() - start)
+    log_slice_metrics(rows)
+    if cli_args.output_file is not None:
+        with open(cli_args.output_file, "w") as f:
+            json.dump(rows, f, indent=2)
@@ -0,0 +1,338 @@
+""" Hyperparameter sweeps over `trainers.train`.
+
+Example:
+    python3 -m trainers.sweep \
+        --param learning_rate=1e-5,2e-5,5e-5 \
+        --param per_gpu_train_batch_size=4,8 \
+        -- \
+        --model_name_or_path bert-base-cased --task_name com2sense \
+        --data_dir datasets/com2sense --output_dir com2sense/sweep \
+        --do_train --evaluate_during_training --logging_steps 50 ...
+
+Everything after `--` is passed to every trial, the `--param` options
+override it per trial. Each trial runs in its own process with its own
+output directory `trial-{k}`, and all trials share one feature cache.
+"""
+
+import os
+import sys
+import json
+import math
+import time
+import random
+import logging
+import argparse
+import itertools
+import subprocess
+
+import numpy as np
+
+from .args import get_parser
+
+logger = logging.getLogger(__name__)
+
+
+def parse_param(spec):
+    """Parses `name=v1,v2,...` (choices) or `name=loguniform:low:high` /
+    `name=uniform:low:high` (ranges, random search only)."""
+    name, _, values = spec.partition("=")
+    if not values:
+        raise ValueError("Bad --param {}, expected name=values".format(spec))
+    if values.startswith(("loguniform:", "uniform:")):
+        kind, low, high = values.split(":")
+        return name, (kind, float(low), float(high))
+    return name, values.split(",")
+
+
+def expand_trials(params, search="grid", num_trials=None, seed=42):
+    """Returns the list of per-trial overrides, each a `{name: value}`."""
+    if search == "grid":
+        for name, values in params:
+            if isinstance(values, tuple):
+                raise ValueError("Range {} needs --search random".format(name))
+        names = [name for name, _ in params]
+        grid = itertools.product(*[values for _, values in params])
+        trials = [dict(zip(names, combo)) for combo in grid]
+        return trials[:num_trials] if num_trials else trials
+
+    rng = random.Random(seed)
+    trials = []
+    for _ in range(num_trials or 8):
+        overrides = {}
+        for name, values in params:
+            if isinstance(values, list):
+                overrides[name] = rng.choice(values)
+            elif values[0] == "loguniform":
+                overrides[name] = "{:.3g}".format(math.exp(rng.uniform(
+                    math.log(values[1]), math.log(values[2]))))
+            else:
+                overrides[name] = "{:.3g}".format(rng.uniform(values[1],
+                                                              values[2]))
+        trials.append(overrides)
+    return trials
+
+
+def trial_argv(parser, base_argv, overrides, output_dir):
+    """Command line arguments of one trial."""
+    flags = {action.dest: action for action in parser._actions}
+    argv = list(base_argv)
+    for name, value in overrides.items():
+        action = flags[name]
+        if action.nargs == 0:
+            # Boolean flags are swept with `true` / `false`.
+            if name in [a.lstrip("-") for a in argv]:
+                argv.remove("--" + name)
+            if value.lower() == "true":
+                argv.append("--" + name)
+        else:
+            argv += ["--" + name, value]
+    argv += ["--output_dir", output_dir, "--overwrite_output_dir"]
+    return argv
+
+
+def available_slots(args, base_args):
+    """One slot per device, or per `threads_per_trial` CPU cores."""
+    use_cuda = False
+    if not base_args.no_cuda:
+        try:
+            import torch
+            use_cuda = torch.cuda.is_available()
+        except ImportError:
+            pass
+
+    if use_cuda:
+        slots = [{"CUDA_VISIBLE_DEVICES": str(i)}
+                 for i in range(torch.cuda.device_count())]
+    else:
+        num_slots = max(1, (os.cpu_count() or 1) // args.threads_per_trial)
+        threads = str(args.threads_per_trial)
+        slots = [{"CUDA_VISIBLE_DEVICES": "", "OMP_NUM_THREADS": threads,
+                  "MKL_NUM_THREADS": threads} for _ in range(num_slots)]
+
+    if args.max_parallel > 0:
+        slots = slots[:args.max_parallel]
+    return slots
+
+
+def build_feature_caches(parser, base_argv, trials):
+    """Tokenizes the train and eval splits once per distinct tokenizer, so
+    that trials only ever read the cache. With `--dedupe_train`, the train
+    split is deduplicated as in `load_and_cache_examples` first."""
+    from transformers import AutoTokenizer
+    from data_processing import data_processors
+    from data_processing.feature_cache import load_or_build_features
+    from data_processing.near_duplicates import dedupe_examples
+
+    done = set()
+    for overrides in trials:
+        trial_args = parser.parse_args(
+            trial_argv(parser, base_argv, overrides, "unused"))
+        tokenizer_name = trial_args.tokenizer_name \
+                         or trial_args.model_name_or_path
+        dedupe = (trial_args.dedupe_train and (
+            trial_args.dedupe_threshold, tuple(trial_args.dedupe_against)))
+        key = (tokenizer_name, trial_args.task_name, trial_args.data_dir,
+               dedupe)
+        if key in done:
+            continue
+        done.add(key)
+
+        tokenizer = AutoTokenizer.from_pretrained(tokenizer_name)
+        processor = data_processors[trial_args.task_name](
+            data_dir=trial_args.data_dir, args=trial_args)
+        splits = ["train", trial_args.eval_split]
+        for split in ["dev" if s == "val" else s for s in splits]:
+            examples = processor._read_data(split=split)
+            if dedupe and split == "train":
+                against = {other: processor._read_data(split=other)
+                           for other in trial_args.dedupe_against}
+                examples = dedupe_examples(examples,
+                                           trial_args.dedupe_threshold,
+                                           against)
+            load_or_build_features([example.text for example in examples],
+                                   tokenizer, trial_args.feature_cache_dir,
+                                   trial_args.tokenization_workers)
+
+
+def read_history(output_dir, objective):
+    """Returns `[(step, value)]` of a trial's in-training evaluations."""
+    history_file = os.path.join(output_dir, "eval_history.jsonl")
+    history = []
+    if not os.path.isfile(history_file):
+        return history
+    with open(history_file) as reader:
+        for line in reader:
+            if not line.endswith("\n"):
+                break  # Partially written line.
+            record = json.loads(line)
+            if objective in record["results"]:
+                history.append((record["step"], record["results"][objective]))
+    return history
+
+
+class MedianPruner(object):
+    """Stops a trial whose objective is below the median of the other
+    trials at the same step (as in Optuna's median pruner)."""
+
+    def __init__(self, warmup_checks=3, min_trials=3):
+        self.warmup_checks = warmup_checks
+        self.min_trials = min_trials
+        self.values = {}  # step -> {trial_id: value}
+
+    def report(self, trial_id, history):
+        for step, value in history:
+            self.values.setdefault(step, {})[trial_id] = value
+
+    def should_prune(self, trial_id, history):
+        if len(history) < self.warmup_checks:
+            return False
+        step, value = history[-1]
+        others = [v for t, v in self.values.get(step, {}).items()
+                  if t != trial_id]
+        if len(others) < self.min_trials - 1:
+            return False
+        return value < np.median(others)
+
+
+def run_sweep(args, parser, base_argv):
+    base_args = parser.parse_args(base_argv)
+    sweep_dir = os.path.join(base_args.output_root, base_args.output_dir)
+    os.makedirs(sweep_dir, exist_ok=True)
+    if base_args.feature_cache_dir is None:
+        base_argv = base_argv + ["--feature_cache_dir",
+                                 os.path.join(sweep_dir, "feature_cache")]
+    if args.prune and "--evaluate_during_training" not in base_argv:
+        base_argv = base_argv + ["--evaluate_during_training"]
+
+    objective = args.objective
+    if objective is None:
+        objective = "{}_{}".format(
+            base_args.task_name, "pairwise_accuracy"
+            if base_args.task_name == "com2sense" else "accuracy")
+
+    params = [parse_param(spec) for spec in args.param]
+    for name, _ in params:
+        if name not in {action.dest for action in parser._actions}:
+            raise ValueError("{} is not an option of trainers/args.py"
+                             .format(name))
+    trials = expand_trials(params, args.search, args.num_trials, args.seed)
+    logger.info("Sweeping %d trials over %s", len(trials),
+                [name for name, _ in params])
+
+    build_feature_caches(parser, base_argv, trials)
+
+    slots = available_slots(args, base_args)
+    logger.info("Running up to %d trials in parallel", len(slots))
+
+    pruner = MedianPruner(args.prune_warmup_checks, args.prune_min_trials)
+    pending = list(enumerate(trials))
+    free_slots = list(range(len(slots)))
+    running = {}
+    records = {}
+
+    while pending or running:
+        while pending and free_slots:
+            trial_id, overrides = pending.pop(0)
+            slot = free_slots.pop(0)
+            output_dir = os.path.join(base_args.output_dir,
+                                      "trial-{}".format(trial_id))
+            trial_dir = os.path.join(base_args.output_root, output_dir)
+            os.makedirs(trial_dir, exist_ok=True)
+
+            env = dict(os.environ, TOKENIZERS_PARALLELISM="false")
+            env.update(slots[slot])
+            cmd = [sys.executable, "-m", "trainers.train"] \
+                + trial_argv(parser, base_argv, overrides, output_dir)
+            log_file = open(os.path.join(trial_dir, "train.log"), "w")
+            proc = subprocess.Popen(cmd, env=env, stdout=log_file,
+                                    stderr=subprocess.STDOUT)
+            running[trial_id] = (proc, slot, log_file, trial_dir)
+            records[trial_id] = {"trial": trial_id, "overrides": overrides,
+                                 "output_dir": trial_dir, "status": "running"}
+            logger.info("Started trial %d %s", trial_id, overrides)
+
+        time.sleep(args.poll_seconds)
+
+        for trial_id in list(running.keys()):
+            proc, slot, log_file, trial_dir = running[trial_id]
+            history = read_history(trial_dir, objective)
+            pruner.report(trial_id, history)
+            if history:
+                records[trial_id]["step"] = history[-1][0]
+                records[trial_id]["best"] = max(v for _, v in history)
+
+            status = None
+            if proc.poll() is not None:
+                status = "finished" if proc.returncode == 0 else "failed"
+            elif args.prune and pruner.should_prune(trial_id, history):
+                proc.terminate()
+                proc.wait()
+                status = "pruned"
+
+            if status is not None:
+                log_file.close()
+                del running[trial_id]
+                free_slots.append(slot)
+                records[trial_id]["status"] = status
+                logger.info("Trial %d %s, best %s = %s", trial_id, status,
+                            objective, records[trial_id].get("best"))
+
+    results = sorted(records.values(),
+                     key=lambda r: r.get("best", float("-inf")), reverse=True)
+    with open(os.path.join(sweep_dir, "sweep_results.json"), "w") as writer:
+        json.dump({"objective": objective, "trials": results}, writer,
+                  indent=2)
+
+    print("\nObjective: {}".format(objective))
+    print("{:>6} {:>10} {:>10}  {}".format("trial", "status", "best",
+                                           "overrides"))
+    for record in results:
+        print("{:>6} {:>10} {:>10}  {}".format(
+            record["trial"], record["status"],
+            "{:.4f}".format(record["best"]) if "best" in record else "-",
+            record["overrides"]))
+    return results
+
+
+def main():
+    argv = sys.argv[1:]
+    if "--" not in argv:
+        raise ValueError("Please pass the trainers.train arguments after `--`.")
+    split = argv.index("--")
+    sweep_argv, base_argv = argv[:split], argv[split + 1:]
+
+    sweep_parser = argparse.ArgumentParser()
+    sweep_parser.add_argument(
+        "--param", action="append", default=[],
+        help="name=v1,v2,... or name=loguniform:low:high, may be repeated.")
+    sweep_parser.add_argument("--search", default="grid",
+                              choices=["grid", "random"])
+    sweep_parser.add_argument("--num_trials", default=None, type=int,
+                              help="Number of random trials (or grid cap).")
+    sweep_parser.add_argument("--seed", default=42, type=int)
+    sweep_parser.add_argument("--max_parallel", default=0, type=int,
+                              help="If > 0: cap on concurrent trials.")
+    sweep_parser.add_argument("--threads_per_trial", default=4, type=int,
+                              help="CPU threads of each trial without GPUs.")
+    sweep_parser.add_argument("--objective", default=None, type=str,
+                              help="Eval metric to maximize, e.g. "
+                                   "com2sense_pairwise_accuracy.")
+    sweep_parser.add_argument("--prune", action="store_true",
+                              help="Stop trials below the running median.")
+    sweep_parser.add_argument("--prune_warmup_checks", default=3, type=int,
+                              help="Evaluations before a trial can be pruned.")
+    sweep_parser.add_argument("--prune_min_trials", default=3, type=int,
+                              help="Trials reporting a step before pruning it.")
+    sweep_parser.add_argument("--poll_seconds", default=5.0, type=float)
+    args = sweep_parser.parse_args(sweep_argv)
+
+    logging.basicConfig(
+        format="%(asctime)s - %(levelname)s - %(name)s -   %(message)s",
+        datefmt="%m/%d/%Y %H:%M:%S",
+        level=logging.INFO,
+    )
+    run_sweep(args, get_parser(), base_argv)
+
+
+if __name__ == "__main__":
+    main()
@@ -17,6 +17,7 @@
     Adapted from `examples/text-classification/run_xnli.py`"""
 
 import csv
+import copy
 import math
 import argparse
 import glob
@@ -31,36 +32,55 @@ from torch.utils.data import DataLoader, RandomSampler, SequentialSampler, Tenso
 from torch.utils.data.distributed import DistributedSampler
 from tqdm import tqdm, trange
 
-from transformers import (
-    WEIGHTS_NAME,
-    AdamW,
-    AutoConfig,
-    AutoModel,
-    AutoModelForSequenceClassification,
-    AutoModelForMaskedLM,
-    AutoTokenizer,
-    get_linear_schedule_with_warmup,
-    BertConfig, EncoderDecoderConfig, EncoderDecoderModel, BertForMaskedLM,
-)
+from transformers import get_linear_schedule_with_warmup
 
 from .args import get_args
-from data_processing import data_processors, data_classes
+from data_processing import data_processors, data_classes, \
+    MULTIPLE_CHOICE_TASKS
+from data_processing.feature_cache import load_or_build_features
+from data_processing.packing import PackedDataset
+from data_processing.near_duplicates import dedupe_examples
 from .mlm_utils import mask_tokens
 from .train_utils import pairwise_accuracy, evaluate_standard
-
-# Tensorboard utilities.
-try:
-    from torch.utils.tensorboard import SummaryWriter
-except ImportError:
-    from tensorboardX import SummaryWriter
-
-# Accuracy metrics.
-from sklearn.metrics import precision_score, recall_score, f1_score, accuracy_score
+from .periodic_eval import InTrainingEvaluator
+from .packing_utils import PACKING_MODEL_TYPES, packed_forward, \
+    packed_predictions
+from .memory_utils import fit_batch_size_to_memory
+from .optim import create_optimizer
+from .embedding_cache import train_linear_probe, linear_probe_predictions
+from .early_exit import add_exit_heads, early_exit_curve, exit_heads_loss, \
+    load_exit_heads, save_exit_heads, train_exit_heads
+from .checkpoints import SAFE_WEIGHTS_NAME, WEIGHTS_NAME, \
+    load_checkpoint_weights
+from .results_store import manifest_checkpoints, record_checkpoint, \
+    record_results, register_run
+from .slice_eval import SLICE_FIELDS, evaluate_slices
+from .seq_length import autotune_max_seq_length, model_length_limit
+from .compile_utils import compile_model, sequence_buckets, trim_batch
+from .attention import from_pretrained, check_padding_mask
+from .cpu_config import configure_cpu_execution, cpu_flags_given, \
+    dataloader_kwargs
+from .prediction_cache import cached_predictions
+from .example_stats import ExampleStats, HardExampleSampler, IndexedDataset, \
+    save_example_stats, update_example_stats
+from .adapters import ADAPTER_WEIGHTS_NAME, adapter_config_from_args, \
+    apply_adapters, is_adapter_checkpoint, load_adapter_config, \
+    load_adapters, merge_adapters, save_adapters
 
 # Loggers.
 logger = logging.getLogger(__name__)
 
 
+def summary_writer(comment):
+    """Tensorboard writer, imported only when training (it takes over a
+    second to import)."""
+    try:
+        from torch.utils.tensorboard import SummaryWriter
+    except ImportError:
+        from tensorboardX import SummaryWriter
+    return SummaryWriter(comment=comment)
+
+
 def set_seed(args):
     random.seed(args.seed)
     np.random.seed(args.seed)
@@ -74,13 +94,28 @@ def train(args, train_dataset, model, tokenizer):
     if args.local_rank in [-1, 0]:
         output_str = args.output_dir.split("/")[-1]
         comment_str = "_{}_{}".format(output_str, args.task_name)
-        tb_writer = SummaryWriter(comment=comment_str)
+        tb_writer = summary_writer(comment_str)
+
+    if args.auto_batch_size:
+        fit_batch_size_to_memory(args, model, train_dataset)
 
     args.train_batch_size = args.per_gpu_train_batch_size * max(1, args.n_gpu)
-    train_sampler = RandomSampler(train_dataset) if args.local_rank == -1 \
-        else DistributedSampler(train_dataset)
+    example_stats = None
+    if args.example_stats or args.hard_example_sampling:
+        # Batches carry their dataset positions, see `example_stats.py`.
+        example_stats = ExampleStats(len(train_dataset),
+                                     args.example_stats_decay)
+        train_dataset = IndexedDataset(train_dataset)
+    if args.hard_example_sampling:
+        train_sampler = HardExampleSampler(
+            example_stats, args.hard_example_warmup_epochs,
+            args.hard_example_min_weight)
+    else:
+        train_sampler = RandomSampler(train_dataset) \
+            if args.local_rank == -1 else DistributedSampler(train_dataset)
     train_dataloader = DataLoader(train_dataset, sampler=train_sampler,
-                                  batch_size=args.train_batch_size)
+                                  batch_size=args.train_batch_size,
+                                  **dataloader_kwargs(args))
 
     if args.max_steps > 0:
         t_total = args.max_steps
@@ -91,18 +126,7 @@ def train(args, train_dataset, model, tokenizer):
                   * args.num_train_epochs
 
     # Prepare optimizer and schedule (linear warmup and decay)
-    no_decay = ["bias", "LayerNorm.weight"]
-    optimizer_grouped_parameters = [
-        {
-            "params": [p for n, p in model.named_parameters()
-                       if not any(nd in n for nd in no_decay)],
-            "weight_decay": args.weight_decay,
-        },
-        {"params": [p for n, p in model.named_parameters()
-                    if any(nd in n for nd in no_decay)], "weight_decay": 0.0},
-    ]
-    optimizer = AdamW(optimizer_grouped_parameters, lr=args.learning_rate,
-                      eps=args.adam_epsilon)
+    optimizer = create_optimizer(args, model)
     scheduler = get_linear_schedule_with_warmup(
         optimizer, num_warmup_steps=args.warmup_steps,
         num_training_steps=t_total
@@ -180,6 +204,17 @@ def train(args, train_dataset, model, tokenizer):
         disable=args.local_rank not in [-1, 0]
     )
 
+    # Only evaluate when single GPU otherwise metrics may not average well.
+    evaluator = None
+    if (args.local_rank == -1 and args.evaluate_during_training
+        and args.training_phase != "pretrain"):
+        eval_dataset = load_and_cache_examples(args, args.task_name,
+                                               tokenizer, evaluate=True,
+                                               data_split=args.eval_split,
+                                               data_dir=args.data_dir)
+        evaluator = InTrainingEvaluator(args, eval_dataset)
+    stop_training = False
+
     set_seed(args)  # Added here for reproductibility.
 
     for _ in train_iterator:
@@ -195,6 +230,9 @@ def train(args, train_dataset, model, tokenizer):
 
             # Processes a batch.
             batch = tuple(t.to(args.device) for t in batch)
+            if args.compile_model:
+                # Only the warmed-up sequence lengths reach the model.
+                batch = trim_batch(batch, args.compile_buckets)
 
             inputs = {"input_ids": batch[0], "attention_mask": batch[1],
                       "labels": batch[3]}
@@ -219,16 +257,33 @@ def train(args, train_dataset, model, tokenizer):
             # Hint: See the HuggingFace transformers doc to properly get
             # the loss from the model outputs.
             # if args.training_phase == "pretrain":
-            output = model(inputs["input_ids"], 
-                    token_type_ids=inputs["token_type_ids"], 
-                    attention_mask=inputs["attention_mask"], 
-                    labels=inputs["labels"])
-            # else:
-            #     output = model(inputs["input_ids"], 
-            #             token_type_ids=inputs["token_type_ids"], 
-            #             attention_mask=inputs["attention_mask"], 
-            #             )
-            loss = output[0]
+            if args.pack_sequences:
+                # Packed rows carry their own positions and segments.
+                loss = packed_forward(model, batch)[0]
+            elif args.early_exit == "joint":
+                # The intermediate exits are trained along with the model.
+                output = model(inputs["input_ids"],
+                               token_type_ids=inputs["token_type_ids"],
+                               attention_mask=inputs["attention_mask"],
+                               labels=inputs["labels"],
+                               output_hidden_states=True)
+                loss = output.loss + exit_heads_loss(
+                    model, output.hidden_states, inputs["labels"])
+            else:
+                output = model(inputs["input_ids"], 
+                        token_type_ids=inputs["token_type_ids"], 
+                        attention_mask=inputs["attention_mask"], 
+                        labels=inputs["labels"])
+                # else:
+                #     output = model(inputs["input_ids"], 
+                #             token_type_ids=inputs["token_type_ids"], 
+                #             attention_mask=inputs["attention_mask"], 
+                #             )
+                loss = output[0]
+
+            if example_stats is not None:
+                update_example_stats(example_stats, batch, output.logits,
+                                     inputs["labels"], global_step)
             
             if args.n_gpu > 1:
                 # Applies mean() to average on multi-gpu parallel training.
@@ -259,6 +314,16 @@ def train(args, train_dataset, model, tokenizer):
                 model.zero_grad()
                 global_step += 1
 
+                if (evaluator is not None
+                    and evaluator.should_evaluate(global_step)):
+                    results, full_pass = evaluator.evaluate(model, global_step)
+                    tag = "eval_on_{}_{}" if full_pass \
+                          else "eval_subsample_on_{}_{}"
+                    for key, value in results.items():
+                        tb_writer.add_scalar(tag.format(args.eval_split, key),
+                                             value, global_step)
+                    stop_training = evaluator.stop_training
+
                 if (args.local_rank in [-1, 0] and args.logging_steps > 0
                     and global_step % args.logging_steps == 0):
                     # Log metrics
@@ -266,6 +331,7 @@ def train(args, train_dataset, model, tokenizer):
                         # Only evaluate when single GPU otherwise metrics may
                         # not average well
                         args.local_rank == -1 and args.evaluate_during_training
+                        and evaluator is None
                     ):
                         results = evaluate(args, model, tokenizer,
                                            data_split=args.eval_split)
@@ -290,11 +356,22 @@ def train(args, train_dataset, model, tokenizer):
                     model_to_save = (
                         model.module if hasattr(model, "module") else model
                     )  # Take care of distributed/parallel training
-                    model_to_save.save_pretrained(output_dir)
+                    if args.peft_mode != "none":
+                        # Only the adapter and head weights are trained.
+                        save_adapters(model_to_save, output_dir)
+                        model_to_save.config.save_pretrained(output_dir)
+                    else:
+                        model_to_save.save_pretrained(
+                            output_dir, safe_serialization=True)
+                    if args.early_exit != "none":
+                        save_exit_heads(model_to_save, output_dir)
+                    if example_stats is not None:
+                        save_example_stats(example_stats, output_dir)
                     tokenizer.save_pretrained(output_dir)
 
                     torch.save(args, os.path.join(output_dir,
                                "training_args.bin"))
+                    record_checkpoint(args, output_dir)
                     logger.info("Saving model checkpoint to %s", output_dir)
 
                     torch.save(optimizer.state_dict(), os.path.join(
@@ -310,19 +387,39 @@ def train(args, train_dataset, model, tokenizer):
                     # will be overwritten each time your model reaches a best
                     # thus far evaluation results on the dev set.
 
-            if args.max_steps > 0 and global_step > args.max_steps:
+            if (args.max_steps > 0 and global_step > args.max_steps) \
+                or stop_training:
                 epoch_iterator.close()
                 break
-        if args.max_steps > 0 and global_step > args.max_steps:
+        if (args.max_steps > 0 and global_step > args.max_steps) \
+            or stop_training:
             train_iterator.close()
             break
 
     if args.local_rank in [-1, 0]:
         tb_writer.close()
+        if example_stats is not None:
+            save_example_stats(example_stats, args.output_dir)
 
     return global_step, tr_loss / global_step
 
 
+def save_checkpoint(args, model, tokenizer, global_step):
+    """Saves a model trained outside of `train()` (a linear probe, early
+    exits) as a regular checkpoint, so that it can be evaluated and loaded
+    like the ones of `train()`."""
+    output_dir = os.path.join(args.output_dir,
+                              "checkpoint-{}".format(global_step))
+    os.makedirs(output_dir, exist_ok=True)
+    model.save_pretrained(output_dir, safe_serialization=True)
+    if args.early_exit != "none":
+        save_exit_heads(model, output_dir)
+    tokenizer.save_pretrained(output_dir)
+    torch.save(args, os.path.join(output_dir, "training_args.bin"))
+    record_checkpoint(args, output_dir)
+    logger.info("Saving model checkpoint to %s", output_dir)
+
+
 def evaluate(args, model, tokenizer, prefix="", data_split="test"):
 
     # Main evaluation loop.
@@ -336,7 +433,8 @@ def evaluate(args, model, tokenizer, prefix="", data_split="test"):
     # Note that DistributedSampler samples randomly
     eval_sampler = SequentialSampler(eval_dataset)
     eval_dataloader = DataLoader(eval_dataset, sampler=eval_sampler,
-                                 batch_size=args.eval_batch_size)
+                                 batch_size=args.eval_batch_size,
+                                 **dataloader_kwargs(args))
 
     # multi-gpu eval
     if args.n_gpu > 1 and not isinstance(model, torch.nn.DataParallel):
@@ -356,92 +454,116 @@ def evaluate(args, model, tokenizer, prefix="", data_split="test"):
 
     guids = []
 
-    for batch in tqdm(eval_dataloader, desc="Evaluating"):
-        model.eval()
-
-        batch = tuple(t.to(args.device) for t in batch)
-
-        if not args.do_train or (args.do_train and args.eval_split != "test"):
-            # guid = batch[-1].cpu().numpy()[0]
-            # guids.append(guid)
-            guid = list(batch[-1].cpu().numpy())
-            guids += guid
-
-        with torch.no_grad():
-            # Processes a batch.
-            inputs = {"input_ids": batch[0], "attention_mask": batch[1]}
-            if (args.do_train and len(batch) > 3) or (not args.do_train and len(batch) > 4):
-                has_label = True
-                inputs["labels"] = batch[3]
-
-            # Clears token type ids if using MLM-based models.
-            if args.model_type != "distilbert":
-                inputs["token_type_ids"] = (
-                    batch[2] if args.model_type in ["bert", "roberta"] \
-                             else None
-                )  # XLM and DistilBERT don't use segment_ids
-                inputs["token_type_ids"] = None
-
-            if args.training_phase == "pretrain":
-                masked_inputs, lm_labels = mask_tokens(
-                    inputs["input_ids"], tokenizer, args)
-                inputs["input_ids"] = masked_inputs
-                inputs["labels"] = lm_labels
-
-            ##################################################
-            # TODO: Evaluation Loop
-            # (1) Run forward and get the model outputs
+    if args.pack_sequences:
+        # Several examples per row, mapped back to the dataset order.
+        packed_dataset = PackedDataset.from_dataset(
+            eval_dataset, max_segments=args.max_segments_per_row)
+        preds, labels, eval_loss, nb_eval_steps = packed_predictions(
+            args, model, packed_dataset)
+        has_label = labels is not None
+        guids = [example.guid for example in eval_dataset.examples]
+    elif args.linear_probe:
+        # The head on cached encoder outputs, see `embedding_cache.py`.
+        preds, labels, eval_loss, nb_eval_steps = linear_probe_predictions(
+            args, model, eval_dataset)
+        has_label = labels is not None
+        guids = [example.guid for example in eval_dataset.examples]
+    elif args.prediction_cache and args.training_phase != "pretrain":
+        # Only texts not scored by this checkpoint before run the model.
+        preds, labels, eval_loss, nb_eval_steps = cached_predictions(
+            args, model, tokenizer, eval_dataset)
+        has_label = labels is not None
+        guids = [example.guid for example in eval_dataset.examples][
+            :len(preds)]
+    else:
+        for batch in tqdm(eval_dataloader, desc="Evaluating"):
+            model.eval()
 
-            if has_label or args.training_phase == "pretrain":
-                # (2) If label present or pretraining, compute the loss and prediction logits
-                # Label the loss as `eval_loss` and logits as `logits`
-                # Hint: See the HuggingFace transformers doc to properly get the loss
-                # AND the logits from the model outputs, it can simply be 
-                # indexing properly the outputs as tuples.
-                # Make sure to perform a `.mean()` on the eval loss and add it
-                # to the `eval_loss` variable.
-                outputs = model(inputs["input_ids"], 
-                    token_type_ids=inputs["token_type_ids"], 
-                    attention_mask=inputs["attention_mask"], 
-                    labels=inputs["labels"])
-                eval_loss += outputs[0].mean()
-                logits = outputs[1]
-                # print(outputs, eval_loss, logits)
+            batch = tuple(t.to(args.device) for t in batch)
+            if args.compile_model:
+                batch = trim_batch(batch, args.compile_buckets)
+
+            if not args.do_train or (args.do_train and args.eval_split != "test"):
+                # guid = batch[-1].cpu().numpy()[0]
+                # guids.append(guid)
+                guid = list(batch[-1].cpu().numpy())
+                guids += guid
+
+            with torch.no_grad():
+                # Processes a batch.
+                inputs = {"input_ids": batch[0], "attention_mask": batch[1]}
+                if (args.do_train and len(batch) > 3) or (not args.do_train and len(batch) > 4):
+                    has_label = True
+                    inputs["labels"] = batch[3]
+
+                # Clears token type ids if using MLM-based models.
+                if args.model_type != "distilbert":
+                    inputs["token_type_ids"] = (
+                        batch[2] if args.model_type in ["bert", "roberta"] \
+                                 else None
+                    )  # XLM and DistilBERT don't use segment_ids
+                    inputs["token_type_ids"] = None
+
+                if args.training_phase == "pretrain":
+                    masked_inputs, lm_labels = mask_tokens(
+                        inputs["input_ids"], tokenizer, args)
+                    inputs["input_ids"] = masked_inputs
+                    inputs["labels"] = lm_labels
+
+                ##################################################
+                # TODO: Evaluation Loop
+                # (1) Run forward and get the model outputs
+
+                if has_label or args.training_phase == "pretrain":
+                    # (2) If label present or pretraining, compute the loss and prediction logits
+                    # Label the loss as `eval_loss` and logits as `logits`
+                    # Hint: See the HuggingFace transformers doc to properly get the loss
+                    # AND the logits from the model outputs, it can simply be 
+                    # indexing properly the outputs as tuples.
+                    # Make sure to perform a `.mean()` on the eval loss and add it
+                    # to the `eval_loss` variable.
+                    outputs = model(inputs["input_ids"], 
+                        token_type_ids=inputs["token_type_ids"], 
+                        attention_mask=inputs["attention_mask"], 
+                        labels=inputs["labels"])
+                    eval_loss += outputs[0].mean()
+                    logits = outputs[1]
+                    # print(outputs, eval_loss, logits)
+                else:
+                    # (3) If labels not present, only compute the prediction logits
+                    # Label the logits as `logits`
+                    outputs = model(inputs["input_ids"], 
+                        token_type_ids=inputs["token_type_ids"], 
+                        attention_mask=inputs["attention_mask"])
+                    logits = outputs[0]
+
+                # (4) Convert logits into probability distribution and relabel as `logits`
+                # Hint: Refer to Softmax function
+
+                sm_fun = torch.nn.Softmax(dim=1)
+
+                logits = sm_fun(logits)
+                # logits = F.softmax(logits, dim=-1)
+
+                # End of TODO.
+                ##################################################
+
+            nb_eval_steps += 1
+
+            if preds is None:
+                preds = logits.detach().cpu().numpy()
+                if has_label:
+                    labels = inputs["labels"].detach().cpu().numpy()
             else:
-                # (3) If labels not present, only compute the prediction logits
-                # Label the logits as `logits`
-                outputs = model(inputs["input_ids"], 
-                    token_type_ids=inputs["token_type_ids"], 
-                    attention_mask=inputs["attention_mask"])
-                logits = outputs[0]
-
-            # (4) Convert logits into probability distribution and relabel as `logits`
-            # Hint: Refer to Softmax function
-
-            sm_fun = torch.nn.Softmax(dim=1)
-
-            logits = sm_fun(logits)
-            # logits = F.softmax(logits, dim=-1)
-
-            # End of TODO.
-            ##################################################
-
-        nb_eval_steps += 1
-
-        if preds is None:
-            preds = logits.detach().cpu().numpy()
-            if has_label:
-                labels = inputs["labels"].detach().cpu().numpy()
-        else:
-            preds = np.append(preds, logits.detach().cpu().numpy(), axis=0)
-            if has_label:
-                labels = np.append(labels,
-                    inputs["labels"].detach().cpu().numpy(), axis=0)
-
-        if args.max_eval_steps > 0 and nb_eval_steps >= args.max_eval_steps:
-            logging.info("Early stopping"
-                " evaluation at step: {}".format(args.max_eval_steps))
-            break
+                preds = np.append(preds, logits.detach().cpu().numpy(), axis=0)
+                if has_label:
+                    labels = np.append(labels,
+                        inputs["labels"].detach().cpu().numpy(), axis=0)
+
+            if args.max_eval_steps > 0 and nb_eval_steps >= args.max_eval_steps:
+                logging.info("Early stopping"
+                    " evaluation at step: {}".format(args.max_eval_steps))
+                break
 
     # Organize the predictions.
     preds = np.reshape(preds, (-1, preds.shape[-1]))
@@ -487,15 +609,21 @@ def evaluate(args, model, tokenizer, prefix="", data_split="test"):
 
         results.update(eval_acc_dict)
 
+    if has_label:
         output_eval_file = os.path.join(args.output_dir,
             prefix, "eval_results_split_{}.txt".format(data_split))
-
-    if has_label:
         with open(output_eval_file, "w") as writer:
             logger.info("***** Eval results {} on split: {} *****".format(prefix, data_split))
             for key in sorted(results.keys()):
                 logger.info("  %s = %s", key, str(results[key]))
                 writer.write("%s = %s\n" % (key, str(results[key])))
+        # Also recorded in the results database, see `results_store.py`.
+        record_results(args, os.path.join(args.output_dir, prefix),
+                       data_split, results)
+        if args.slice_eval and args.training_phase != "pretrain":
+            evaluate_slices(args, eval_dataset.examples, preds, labels,
+                            guids if len(guids) == len(preds) else None,
+                            os.path.join(args.output_dir, prefix), data_split)
 
     # Stores the prediction .txt file to the `args.output_dir`.
     if not has_label:
@@ -509,6 +637,17 @@ def evaluate(args, model, tokenizer, prefix="", data_split="test"):
     return results
 
 
+def example_fields(args, task):
+    """Fields of the examples a run uses, the processors skip the others
+    (e.g. the SemEval reasons). None for all of them."""
+    if task in MULTIPLE_CHOICE_TASKS:
+        return None
+    fields = ["guid", "text", "label"]
+    if args.slice_eval:
+        fields += SLICE_FIELDS
+    return fields
+
+
 def load_and_cache_examples(args, task, tokenizer, evaluate=False,
                             data_split="test", data_dir=None):
     if args.local_rank not in [-1, 0] and not evaluate:
@@ -516,7 +655,8 @@ def load_and_cache_examples(args, task, tokenizer, evaluate=False,
         # dataset, and the others will use the cache
         torch.distributed.barrier()
 
-    processor = data_processors[task](data_dir=args.data_dir, args=args)
+    processor = data_processors[task](data_dir=args.data_dir, args=args,
+                                      fields=example_fields(args, task))
 
     # Getting the examples.
     if data_split == "test" and evaluate:
@@ -536,10 +676,27 @@ def load_and_cache_examples(args, task, tokenizer, evaluate=False,
     logging.info("Number of {} examples in task {}: {}".format(
         data_split, task, len(examples)))
 
+    # Near-duplicate training statements, before their features are cached.
+    if args.dedupe_train and not evaluate:
+        against = {split: processor._read_data(split=split)
+                   for split in args.dedupe_against}
+        examples = dedupe_examples(examples, args.dedupe_threshold, against)
+
+    # Pre-tokenized features, shared by every run using the same tokenizer.
+    # Multiple-choice datasets tokenize statement/choice pairs themselves.
+    features = None
+    if args.feature_cache_dir is not None \
+            and task not in MULTIPLE_CHOICE_TASKS:
+        features = load_or_build_features([example.text
+                                           for example in examples],
+                                          tokenizer, args.feature_cache_dir,
+                                          args.tokenization_workers)
+
     # Defines the dataset.
     dataset = data_classes[task](examples, tokenizer,
                                  max_seq_length=args.max_seq_length,
-                                 seed=args.seed, args=args)
+                                 seed=args.seed, args=args,
+                                 features=features)
 
     if args.local_rank == 0 and not evaluate:
         # Make sure only the first process in distributed training process the
@@ -550,9 +707,21 @@ def load_and_cache_examples(args, task, tokenizer, evaluate=False,
 
 
 def main():
+    # Imported here: the auto classes pull in most of transformers (and
+    # sklearn through it), which light users of this module do not need.
+    from transformers import (
+        AutoConfig,
+        AutoModelForMultipleChoice,
+        AutoModelForSequenceClassification,
+        AutoTokenizer,
+    )
+
     torch.autograd.set_detect_anomaly(True)
     
     args = get_args()
+    if args.eval_subsample_size > 0 and args.full_eval_every < 1:
+        raise ValueError("--full_eval_every must be at least 1 with "
+                         "--eval_subsample_size.")
 
     # Writes the prefix to the output dir path.
     if args.output_root is not None:
@@ -610,10 +779,20 @@ def main():
         args.n_gpu,
         bool(args.local_rank != -1),
     )
+    # Threads, DataLoader workers and CPU pinning, before the tokenizer and
+    # model are loaded.
+    args.worker_cpus = []
+    if cpu_flags_given(args):
+        configure_cpu_execution(args)
 
     # Sets seed.
     set_seed(args)
 
+    # Records the run (and later its checkpoints and results) in the
+    # results database.
+    if args.local_rank in [-1, 0]:
+        args.run_id = register_run(args)
+
     # Loads pretrained model and tokenizer.
     if args.local_rank not in [-1, 0]:
         # Make sure only the first process in distributed training will
@@ -652,18 +831,57 @@ def main():
     # (2) Load tokenizer
     tokenizer = AutoTokenizer.from_pretrained(selected_model)
 
+    if args.auto_max_seq_length:
+        args.max_seq_length = autotune_max_seq_length(
+            args, tokenizer, model_length_limit(config, tokenizer))
+
+    # Adapter checkpoints only hold the trained weights, on top of the
+    # pretrained model they were trained from.
+    adapter_config = None
+    if is_adapter_checkpoint(selected_model):
+        adapter_config = load_adapter_config(selected_model)
+        args.peft_mode = adapter_config["peft_mode"]
+        selected_model = adapter_config["base_model"]
+
     if args.training_phase == "pretrain":
         # (3) Load MLM model if pretraining (Optional)
-        model = AutoModelForSequenceClassification.from_pretrained(selected_model)
+        model = from_pretrained(AutoModelForSequenceClassification,
+                                selected_model, args.attn_implementation)
         # Complete only if doing MLM pretraining for improving performance
+    elif args.task_name in MULTIPLE_CHOICE_TASKS:
+        # One score per (statement, choice) pair, softmaxed over the choices.
+        # A sequence classification checkpoint gets a fresh one-unit head.
+        model = from_pretrained(AutoModelForMultipleChoice, selected_model,
+                                args.attn_implementation,
+                                ignore_mismatched_sizes=True)
     else:
         # (4) Load sequence classification model otherwise
-        model = AutoModelForSequenceClassification.from_pretrained(selected_model) # https://huggingface.co/docs/transformers/model_doc/auto
+        # https://huggingface.co/docs/transformers/model_doc/auto
+        model = from_pretrained(AutoModelForSequenceClassification,
+                                selected_model, args.attn_implementation)
         # raise NotImplementedError("Please finish the TODO!")
 
     # End of TODO.
     ##################################################
 
+    if adapter_config is not None:
+        apply_adapters(model, adapter_config)
+        load_adapters(model, args.model_name_or_path)
+    elif args.peft_mode != "none":
+        apply_adapters(model, adapter_config_from_args(args, model))
+
+    if args.early_exit != "none":
+        add_exit_heads(model)
+        load_exit_heads(model, args.model_name_or_path)
+
+    if args.gradient_checkpointing:
+        # Recomputes the activations in backward instead of storing them.
+        model.gradient_checkpointing_enable()
+        if args.peft_mode != "none":
+            # The frozen embeddings would otherwise cut the gradients of the
+            # checkpointed layers.
+            model.enable_input_require_grads()
+
     # Loads models onto the device (gpu or cpu).
     model.to(args.device)
     print(model)
@@ -674,44 +892,126 @@ def main():
         return sum(p.numel() for p in model.parameters() if p.requires_grad)
     logger.info("!!! Number of Params: {} M".format(count_parameters(model)/float(1000000)))
 
+    if args.early_exit != "none" and (args.pack_sequences
+                                      or args.linear_probe):
+        raise ValueError("--early_exit needs the regular training loop.")
+
+    if args.linear_probe:
+        if args.training_phase == "pretrain" or args.pack_sequences:
+            raise ValueError("--linear_probe only trains the classification "
+                             "head, without sequence packing.")
+        args.eval_batch_size = args.per_gpu_eval_batch_size * max(1, args.n_gpu)
+        if args.embedding_cache_dir is None:
+            args.embedding_cache_dir = os.path.join(
+                args.feature_cache_dir or args.output_dir, "embeddings")
+
+    if args.pack_sequences and (args.model_type not in PACKING_MODEL_TYPES
+                                or args.training_phase == "pretrain"):
+        raise ValueError("--pack_sequences needs finetuning one of {}."
+                         .format(PACKING_MODEL_TYPES))
+
+    if args.task_name in MULTIPLE_CHOICE_TASKS:
+        if (args.training_phase == "pretrain" or args.pack_sequences
+                or args.linear_probe or args.early_exit != "none"
+                or args.prediction_cache or args.slice_eval
+                or args.dedupe_train):
+            raise ValueError("{} only supports the regular finetuning and "
+                             "evaluation loops.".format(args.task_name))
+        if args.score_average_method == "binary":
+            args.score_average_method = "macro"
+
+    if args.compile_model:
+        if (args.training_phase == "pretrain" or args.pack_sequences
+                or args.linear_probe or args.early_exit != "none"
+                or args.merge_adapters):
+            raise ValueError("--compile_model needs the regular finetuning "
+                             "and evaluation loops.")
+        # The longest bucket is always `max_seq_length`, so no batch is cut.
+        args.compile_buckets = sorted(
+            set(length for length in args.compile_buckets or
+                sequence_buckets(args.max_seq_length)
+                if length < args.max_seq_length) | {args.max_seq_length})
+        compile_model(model, args.compile_buckets, training=args.do_train,
+                      num_choices=num_labels
+                      if args.task_name in MULTIPLE_CHOICE_TASKS else None)
+
+    if (args.example_stats or args.hard_example_sampling) and (
+            args.pack_sequences or args.linear_probe
+            or args.training_phase == "pretrain"):
+        raise ValueError("--example_stats and --hard_example_sampling need "
+                         "the regular finetuning loop.")
+    if args.hard_example_sampling and args.local_rank != -1:
+        raise ValueError("--hard_example_sampling does not support "
+                         "distributed training, whose processes sample "
+                         "their shards with DistributedSampler.")
+
     # Training.
     if args.do_train:
         train_dataset = load_and_cache_examples(args, args.task_name,
                                                 tokenizer, data_split="train",
                                                 evaluate=False)
-        global_step, tr_loss = train(args, train_dataset, model, tokenizer)
+        if (args.attn_implementation != "default"
+                and args.task_name not in MULTIPLE_CHOICE_TASKS):
+            # The padded batches of our datasets must give the logits of
+            # the unpadded examples.
+            check_padding_mask(model, train_dataset)
+        if args.pack_sequences:
+            train_dataset = PackedDataset.from_dataset(
+                train_dataset, max_segments=args.max_segments_per_row)
+        if args.linear_probe:
+            global_step, tr_loss = train_linear_probe(args, model,
+                                                      train_dataset)
+            save_checkpoint(args, model, tokenizer, global_step)
+        else:
+            global_step, tr_loss = train(args, train_dataset, model,
+                                         tokenizer)
+        if args.early_exit == "post":
+            train_exit_heads(args, model, train_dataset)
+            save_checkpoint(args, model, tokenizer, global_step)
         logger.info(" global_step = %s, average loss = %s",
                     global_step, tr_loss)
 
     # Evaluation.
     results = {}
     if args.do_eval and args.local_rank in [-1, 0]:
+        weights_names = ([ADAPTER_WEIGHTS_NAME] if args.peft_mode != "none"
+                         else [SAFE_WEIGHTS_NAME, WEIGHTS_NAME])
+        # Checkpoints are indexed in the results database when they are
+        # saved, the directory is only crawled for runs from before that.
         checkpoints = [args.output_dir]
         if args.eval_all_checkpoints:
-            checkpoints = list(
-                os.path.dirname(c) for c in sorted(glob.glob(
-                    args.output_dir + "/**/" + WEIGHTS_NAME, recursive=True))
-            )
+            checkpoints = manifest_checkpoints(args)
+            if not checkpoints:
+                checkpoints = sorted(set(
+                    os.path.dirname(c) for name in weights_names
+                    for c in glob.glob(args.output_dir + "/**/" + name,
+                                       recursive=True)))
         else:
             assert args.iters_to_eval is not None, ("At least one"
                 " of `iter_to_eval` or `eval_all_checkpoints` should be set.")
-            checkpoints = []
-            for iter_to_eval in args.iters_to_eval:
-                checkpoints_curr = list(
-                    os.path.dirname(c) for c in sorted(glob.glob(
-                        args.output_dir + "/*-{}/".format(iter_to_eval)
-                        + WEIGHTS_NAME, recursive=True))
-                )
-                checkpoints += checkpoints_curr
+            checkpoints = manifest_checkpoints(args, args.iters_to_eval)
+            if not checkpoints:
+                for iter_to_eval in args.iters_to_eval:
+                    checkpoints_curr = sorted(set(
+                        os.path.dirname(c) for name in weights_names
+                        for c in glob.glob(args.output_dir + "/*-{}/".format(
+                            iter_to_eval) + name, recursive=True)))
+                    checkpoints += checkpoints_curr
 
         logger.info("\n\nEvaluate the following checkpoints: %s", checkpoints)
         for checkpoint in checkpoints:
             logger.info("\n\nEvaluate checkpoint: %s", checkpoint)
             global_step = checkpoint.split("-")[-1] if len(checkpoints) > 1 else ""
             prefix = checkpoint.split("/")[-1] if checkpoint.find("checkpoint") != -1 else ""
-            ckpt_path = os.path.join(checkpoint, "pytorch_model.bin")
-            model.load_state_dict(torch.load(ckpt_path))
+            if args.peft_mode != "none":
+                load_adapters(model, checkpoint)
+            else:
+                # Memory-mapped, see `checkpoints.py`.
+                load_checkpoint_weights(model, checkpoint)
             model.to(args.device)
+            eval_model = model
+            if args.merge_adapters:
+                eval_model = merge_adapters(copy.deepcopy(model))
 
             ##################################################
             # TODO: Make sure the eval_split is "test" if in
@@ -721,7 +1021,17 @@ def main():
             # End of TODO.
             ##################################################
 
-            result = evaluate(args, model, tokenizer, prefix=prefix, data_split=args.eval_split)
+            result = evaluate(args, eval_model, tokenizer, prefix=prefix, data_split=args.eval_split)
+            if args.early_exit != "none":
+                logger.info("Early exit trade-off on split: %s",
+                            args.eval_split)
+                eval_dataset = load_and_cache_examples(
+                    args, args.task_name, tokenizer, evaluate=True,
+                    data_split=args.eval_split, data_dir=args.data_dir)
+                early_exit_curve(args, eval_model, eval_dataset,
+                                 os.path.join(checkpoint,
+                                              "early_exit_curve_{}.json"
+                                              .format(args.eval_split)))
             result = dict((k + "_{}".format(global_step), v)
                            for k, v in result.items())
             results.update(result)
@@ -9,16 +9,6 @@ from typing import List, Optional, Union
 
 import tqdm
 import numpy as np
-from sklearn.metrics import precision_recall_fscore_support
-
-import torch
-from transformers import (
-    WEIGHTS_NAME,
-    AdamW,
-    AutoConfig,
-    AutoModelForMaskedLM,
-    AutoTokenizer,
-)
 
 def evaluate_standard(preds, labels, scoring_method):
 
@@ -31,6 +21,8 @@ def evaluate_standard(preds, labels, scoring_method):
     # and F1 score for the predictions and gold labels.
     # Please also make your sci-kit learn scores are computed
     # using `scoring_method` for the `average` argument.
+    # Imported here, sklearn takes about a second to import.
+    from sklearn.metrics import precision_recall_fscore_support
     acc = np.sum(labels==preds)/len(preds)
     prec, recall, f1, _ = precision_recall_fscore_support(labels, preds, average=scoring_method)
 